@@ -0,0 +1,261 @@
+#===========================================================================
+# archive.py
+#
+# Streaming zip and tar archives of timelapse sessions.
+#
+# Nothing is written to disk and memory use does not depend on the size of
+# the session. An archive is described as a sequence of pieces, each one
+# either a string of archive structure (headers, padding, directory) to
+# send as is, or a FileRange of member data for the caller to read and
+# send in chunks. Zip members are stored (no compression, JPEGs don't
+# compress) with a data descriptor, so the CRC is computed as the data
+# goes by, and ZIP64 records are used once offsets pass 4GB. The layout
+# of a tar is known up front, so any byte range of it can be produced,
+# which allows resumable downloads. Tar member names too long for ustar
+# get a GNU long name header before their own.
+#
+# 2016-10-22
+# Carter Nelson
+#===========================================================================
+import os
+import re
+import time
+import struct
+import zlib
+import collections
+
+TAR_BLOCK = 512
+TAR_RECORD = 20 * TAR_BLOCK
+TAR_LONGLINK = "././@LongLink"      # name of GNU long name headers
+ZIP64_LIMIT = 0xffffffff
+
+# a member of an archive
+Member = collections.namedtuple('Member', ['name', 'path', 'size', 'mtime'])
+
+class FileRange(object):
+    """Member data to be read from path, length bytes from offset. The
+    reader must pass the data to update() as it goes."""
+
+    def __init__(self, member, offset, length, update=None):
+        self.member = member
+        self.path = member.path
+        self.offset = offset
+        self.length = length
+        self._update = update
+
+    def update(self, data):
+        if not self._update == None:
+            self._update(data)
+
+def session_members(dir, name):
+    """Return list of Members for the files of a session directory, frames
+    in number order, then everything else. Partly written files are left
+    out."""
+    frames = []
+    others = []
+    for filename in os.listdir(dir):
+        path = os.path.join(dir, filename)
+        if filename.endswith(".part") or not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        member = Member(name + "/" + filename, path, st.st_size, int(st.st_mtime))
+        match = re.match(r".*_(\d+)\.jpg$", filename)
+        if match:
+            frames.append((int(match.group(1)), member))
+        else:
+            others.append((filename, member))
+    return [m for k, m in sorted(frames)] + [m for k, m in sorted(others)]
+
+def parse_range(header, size):
+    """Return (start, end), end not included, of a single "bytes=" Range
+    header for size bytes. Return None if it is not a single byte range,
+    so the whole thing is sent. Raises ValueError if it can't be
+    satisfied."""
+    match = re.match(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$", header)
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # suffix range, the last bytes
+        start, end = max(0, size - int(last)), size
+    else:
+        start = int(first)
+        if not last == "" and int(last) < start:
+            return None
+        end = size if last == "" else min(size, int(last) + 1)
+    if start >= size or start >= end:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+#--------------------------------------------------------------------
+# tar
+#--------------------------------------------------------------------
+class TarArchive(object):
+    """A ustar archive of members."""
+
+    content_type = 'application/x-tar'
+
+    def __init__(self, members):
+        self.members = members
+
+    def size(self, ):
+        """Return the size of the archive in bytes."""
+        total = sum(len(self.__headers(m)) + self.__padded(m.size)
+                    for m in self.members)
+        return self.__padded(total + 2 * TAR_BLOCK, TAR_RECORD)
+
+    def pieces(self, start=0, end=None):
+        """Generate the pieces of the archive from byte start up to, not
+        including, byte end."""
+        if end == None:
+            end = self.size()
+        pos = 0
+        for member in self.members:
+            headers = self.__headers(member)
+            for piece in self.__clip(pos, headers, start, end):
+                yield piece
+            pos += len(headers)
+            lo = max(start, pos)
+            hi = min(end, pos + member.size)
+            if lo < hi:
+                yield FileRange(member, lo - pos, hi - lo)
+            pos += member.size
+            pad = self.__padded(member.size) - member.size
+            for piece in self.__clip(pos, "\0" * pad, start, end):
+                yield piece
+            pos += pad
+            if pos >= end:
+                return
+        trailer = self.size() - pos
+        for piece in self.__clip(pos, "\0" * trailer, start, end):
+            yield piece
+
+    def __clip(self, pos, data, start, end):
+        """Return the part of data, which is at pos, between start and end."""
+        lo = max(start, pos) - pos
+        hi = min(end, pos + len(data)) - pos
+        if lo < hi:
+            return [data[lo:hi]]
+        return []
+
+    def __headers(self, member):
+        """Return the header blocks of a member, a GNU long name header and
+        its data first if the name doesn't fit ustar."""
+        name = member.name.encode('utf-8') if isinstance(member.name, unicode) \
+                                           else member.name
+        split = self.__split(name)
+        if not split == None:
+            prefix, name = split
+            return self.__header(name, member.size, member.mtime, prefix=prefix)
+        longname = name + "\0"
+        return self.__header(TAR_LONGLINK, len(longname), 0, kind="L") + \
+               longname.ljust(self.__padded(len(longname)), "\0") + \
+               self.__header(name[:100], member.size, member.mtime)
+
+    def __split(self, name):
+        """Return (prefix, name) to fit name in a ustar header, None if it
+        can't."""
+        if len(name) <= 100:
+            return "", name
+        for i, c in enumerate(name):
+            if c == "/" and i <= 155 and 0 < len(name) - i - 1 <= 100:
+                return name[:i], name[i + 1:]
+        return None
+
+    def __header(self, name, size, mtime, kind="0", prefix=""):
+        fields = [
+            name.ljust(100, "\0")[:100],
+            "%07o\0" % 0644,                    # mode
+            "%07o\0" % 0,                       # uid
+            "%07o\0" % 0,                       # gid
+            "%011o\0" % size,
+            "%011o\0" % mtime,
+            " " * 8,                            # checksum, for now
+            kind,                               # 0 regular file, L long name
+            "\0" * 100,                         # link name
+            "ustar\0" + "00",
+            "\0" * 32,                          # user name
+            "\0" * 32,                          # group name
+            "%07o\0" % 0,                       # device major
+            "%07o\0" % 0,                       # device minor
+            prefix.ljust(155, "\0")[:155],
+        ]
+        header = "".join(fields).ljust(TAR_BLOCK, "\0")
+        checksum = "%06o\0 " % (sum(ord(c) for c in header))
+        return header[:148] + checksum + header[156:]
+
+    def __padded(self, size, block=TAR_BLOCK):
+        return (size + block - 1) // block * block
+
+#--------------------------------------------------------------------
+# zip
+#--------------------------------------------------------------------
+class ZipArchive(object):
+    """A zip archive of members, stored uncompressed."""
+
+    content_type = 'application/zip'
+
+    def __init__(self, members):
+        self.members = members
+        self._crc = 0
+
+    def pieces(self, ):
+        """Generate the pieces of the archive."""
+        directory = []
+        pos = 0
+        for member in self.members:
+            name = member.name.encode('utf-8') if isinstance(member.name, unicode) \
+                                               else member.name
+            dostime, dosdate = self.__dos_time(member.mtime)
+            header = struct.pack("<IHHHHHIIIHH", 0x04034b50,
+                                 20,                # version needed
+                                 0x0808,            # data descriptor, utf-8
+                                 0,                 # stored
+                                 dostime, dosdate,
+                                 0, 0, 0,           # crc and sizes follow data
+                                 len(name), 0) + name
+            offset = pos
+            yield header
+            pos += len(header)
+            self._crc = 0
+            yield FileRange(member, 0, member.size, self.__update)
+            pos += member.size
+            crc = self._crc & 0xffffffff
+            yield struct.pack("<IIII", 0x08074b50, crc, member.size, member.size)
+            pos += 16
+            directory.append((name, dostime, dosdate, crc, member.size, offset))
+        cd_start = pos
+        for name, dostime, dosdate, crc, size, offset in directory:
+            extra = ""
+            if offset >= ZIP64_LIMIT:
+                extra = struct.pack("<HHQ", 0x0001, 8, offset)
+                offset = 0xffffffff
+            entry = struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50,
+                                (3 << 8) | 45,      # made by unix
+                                45 if extra else 20,
+                                0x0808, 0, dostime, dosdate, crc, size, size,
+                                len(name), len(extra), 0, 0, 0,
+                                0100644 << 16,      # file mode
+                                offset) + name + extra
+            yield entry
+            pos += len(entry)
+        cd_size = pos - cd_start
+        count = len(directory)
+        if count >= 0xffff or cd_start >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            yield struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0,
+                              count, count, cd_size, cd_start)
+            yield struct.pack("<IIQI", 0x07064b50, 0, pos, 1)
+            count = min(count, 0xffff)
+            cd_size = min(cd_size, 0xffffffff)
+            cd_start = 0xffffffff
+        yield struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count, count,
+                          cd_size, cd_start, 0)
+
+    def __update(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+
+    def __dos_time(self, mtime):
+        t = time.localtime(mtime)
+        dostime = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+        dosdate = (max(0, t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+        return dostime, dosdate
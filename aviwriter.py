@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#===========================================================================
+# aviwriter.py
+#
+# Assemble JPEG frames into a Motion-JPEG AVI file.
+#
+# The JPEG data is copied into the AVI unchanged, there is no decoding or
+# re-encoding. Frames are written straight to the file as they are added
+# and the idx1 index entries are spooled to a temporary file, so memory
+# use does not grow with the number of frames. The headers are patched
+# with the final counts when the file is closed. The file is written
+# under a temporary name and only renamed when complete.
+#
+# Plain AVI (not OpenDML), so output is limited to AVI_MAX_BYTES.
+#
+# 2016-09-03
+# Carter Nelson
+#===========================================================================
+import os
+import re
+import struct
+import tempfile
+
+AVI_FPS = 24                        # playback rate
+AVI_MAX_BYTES = 2**31 - 1           # RIFF sizes are 32 bit signed in practice
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+COPY_CHUNK = 64 * 1024
+
+def jpeg_size(data):
+    """Return (width, height) of JPEG data, read from its SOF marker."""
+    i = 2
+    while i < len(data) - 9:
+        if data[i] != '\xff':
+            i += 1
+            continue
+        marker = ord(data[i+1])
+        if marker in (0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+                      0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf):
+            height, width = struct.unpack(">HH", data[i+5:i+9])
+            return width, height
+        if marker == 0xff or marker == 0xd8 or 0xd0 <= marker <= 0xd7:
+            i += 1 if marker == 0xff else 2
+            continue
+        length, = struct.unpack(">H", data[i+2:i+4])
+        i += 2 + length
+    raise ValueError("no SOF marker found in JPEG data")
+
+class AVIWriter(object):
+    """A class for writing a Motion-JPEG AVI file one frame at a time."""
+
+    def __init__(self, filename, fps=AVI_FPS):
+        self.filename = filename
+        self.fps = fps
+        self.frames = 0
+        self.size = None
+        self._max_frame = 0
+        self._partname = filename + ".part"
+        self._file = open(self._partname, "wb")
+        self._index = tempfile.TemporaryFile()
+        self._movi_start = None
+        self._header_written = False
+
+    def add_frame(self, jpeg):
+        """Append JPEG data as the next frame. Returns False if the frame
+        would make the file too big, in which case it is not added."""
+        if not self._header_written:
+            self.size = jpeg_size(jpeg)
+            self.__write_header()
+        padded = len(jpeg) + (len(jpeg) & 1)
+        if self._file.tell() + 8 + padded + 16 * (self.frames + 1) + 8 > AVI_MAX_BYTES:
+            return False
+        offset = self._file.tell() - self._movi_start
+        self._file.write(struct.pack("<4sI", "00dc", len(jpeg)))
+        self._file.write(jpeg)
+        if len(jpeg) & 1:
+            self._file.write("\0")
+        self._index.write(struct.pack("<4sIII", "00dc", AVIIF_KEYFRAME,
+                                      offset, len(jpeg)))
+        self.frames += 1
+        self._max_frame = max(self._max_frame, len(jpeg))
+        return True
+
+    def close(self, ):
+        """Write the index, patch the headers and close the file."""
+        if self._file.closed:
+            return
+        if not self._header_written:
+            # no frames, nothing useful to write
+            self._file.close()
+            self._index.close()
+            os.remove(self._partname)
+            return
+        movi_end = self._file.tell()
+        self._file.write(struct.pack("<4sI", "idx1", 16 * self.frames))
+        self._index.seek(0)
+        while True:
+            entries = self._index.read(COPY_CHUNK)
+            if not entries:
+                break
+            self._file.write(entries)
+        riff_end = self._file.tell()
+        self._index.close()
+        # frame counts and sizes in the headers
+        self.__write_header()
+        # RIFF size
+        self._file.seek(4)
+        self._file.write(struct.pack("<I", riff_end - 8))
+        # movi LIST size, counted from the 'movi' fourcc
+        self._file.seek(self._movi_start - 4)
+        self._file.write(struct.pack("<I", movi_end - self._movi_start))
+        self._file.close()
+        os.rename(self._partname, self.filename)
+
+    def __write_header(self, ):
+        """Write (or rewrite) the hdrl LIST and the start of the movi LIST."""
+        width, height = self.size
+        usec_per_frame = int(1e6 / self.fps)
+        avih = struct.pack("<14I",
+                           usec_per_frame,
+                           self._max_frame * self.fps,      # max bytes per sec
+                           0,                               # padding granularity
+                           AVIF_HASINDEX,
+                           self.frames,                     # total frames
+                           0,                               # initial frames
+                           1,                               # streams
+                           self._max_frame,                 # suggested buffer size
+                           width,
+                           height,
+                           0, 0, 0, 0)                      # reserved
+        strh = struct.pack("<4s4sIHHIIIIIIIIhhhh",
+                           "vids",
+                           "MJPG",
+                           0,                               # flags
+                           0,                               # priority
+                           0,                               # language
+                           0,                               # initial frames
+                           1,                               # scale
+                           self.fps,                        # rate
+                           0,                               # start
+                           self.frames,                     # length
+                           self._max_frame,                 # suggested buffer size
+                           0xffffffff,                      # quality (default)
+                           0,                               # sample size
+                           0, 0, width, height)             # frame rect
+        strf = struct.pack("<IiiHH4sIiiII",
+                           40,                              # header size
+                           width,
+                           height,
+                           1,                               # planes
+                           24,                              # bit count
+                           "MJPG",
+                           width * height * 3,              # image size
+                           0, 0, 0, 0)
+        strl = "strl" + chunk("strh", strh) + chunk("strf", strf)
+        hdrl = "hdrl" + chunk("avih", avih) + list_chunk(strl)
+        self._file.seek(0)
+        self._file.write(struct.pack("<4sI4s", "RIFF", 0, "AVI "))
+        self._file.write(list_chunk(hdrl))
+        if not self._header_written:
+            self._file.write(struct.pack("<4sI4s", "LIST", 0, "movi"))
+            self._movi_start = self._file.tell() - 4
+            self._header_written = True
+
+def chunk(fourcc, data):
+    """Return a RIFF chunk."""
+    return struct.pack("<4sI", fourcc, len(data)) + data
+
+def list_chunk(data):
+    """Return a RIFF LIST chunk, data starts with the list type fourcc."""
+    return chunk("LIST", data)
+
+def frame_files(dir):
+    """Return the numbered JPEG files of a timelapse directory, in order."""
+    frames = []
+    for name in os.listdir(dir):
+        match = re.match(r".*_(\d+)\.jpg$", name)
+        if match:
+            frames.append((int(match.group(1)), os.path.join(dir, name)))
+    return [filename for number, filename in sorted(frames)]
+
+def assemble(dir, filename, fps=AVI_FPS):
+    """Assemble the frames of a timelapse directory into an AVI file. Return
+    the number of frames."""
+    writer = AVIWriter(filename, fps)
+    try:
+        for frame in frame_files(dir):
+            with open(frame, "rb") as file:
+                if not writer.add_frame(file.read()):
+                    break
+    finally:
+        writer.close()
+    return writer.frames
+
+#--------------------------------------------------------------------
+# M A I N
+#--------------------------------------------------------------------
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 3:
+        print "usage: aviwriter.py <timelapse dir> <output.avi> [fps]"
+        sys.exit(1)
+    fps = int(sys.argv[3]) if len(sys.argv) > 3 else AVI_FPS
+    print "{0} frames".format(assemble(sys.argv[1], sys.argv[2], fps))
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+#===========================================================================
+# benchmark.py
+#
+# Benchmarks that run without camera hardware, using the simulated
+# backends in simhw.py. Results are written as JSON, so runs can be
+# compared before deploying.
+#
+#   python benchmark.py                      # all benchmarks, to stdout
+#   python benchmark.py -o before.json       # to a file
+#   python benchmark.py -b mjpeg -b capture  # only some
+#   python benchmark.py --sim capture_time=0.8 --sim spi_time=0.004
+#
+# Benchmarks:
+#   * timelapse = interval jitter of a still mode TimeLapser
+#   * mjpeg     = MJPEG fps per client, with N clients
+#   * capture   = /capture latency through the web server
+#   * histogram = histogram overlay render cost
+#   * status    = websocket status publish throughput, N subscribers
+#
+# 2016-09-24
+# Carter Nelson
+#===========================================================================
+import os
+import sys
+import time
+import json
+import math
+import socket
+import shutil
+import tempfile
+import threading
+import argparse
+import urllib2
+
+import simhw
+simhw.install()
+
+import campi
+import timelapser
+import mjpegger
+import metrics
+
+BENCHMARKS = ['timelapse', 'mjpeg', 'capture', 'histogram', 'status']
+
+def stats(values):
+    """Return dictionary of summary statistics for a list of numbers."""
+    if not values:
+        return {'count':0}
+    n = len(values)
+    mean = sum(values) / float(n)
+    ordered = sorted(values)
+    return {
+        'count' : n,
+        'mean'  : mean,
+        'stdev' : math.sqrt(sum((v - mean)**2 for v in values) / n),
+        'min'   : ordered[0],
+        'p50'   : ordered[n // 2],
+        'p95'   : ordered[min(n - 1, int(math.ceil(0.95 * n)) - 1)],
+        'max'   : ordered[-1],
+    }
+
+class FrameLog(object):
+    """Stands in for the session index, recording when frames were taken."""
+
+    def __init__(self, ):
+        self.times = []
+
+    def add_session(self, *args):
+        pass
+
+    def add_frame(self, session, number, filename, timestamp, size,
+                  exposure_speed=None):
+        self.times.append(timestamp)
+
+def bench_timelapse(camera, args):
+    """Run a still mode timelapse and measure interval jitter."""
+    log = FrameLog()
+    tl = timelapser.TimeLapser(kwargs={
+        'camera'        : camera,
+        'delta_time'    : args.delta_time,
+        'total_imgs'    : args.frames,
+        'mode'          : 'still',
+        'index'         : log,
+        })
+    tl.start()
+    tl.join()
+    intervals = [b - a for a, b in zip(log.times, log.times[1:])]
+    lateness = [t - (log.times[0] + i * args.delta_time)
+                    for i, t in enumerate(log.times)]
+    return {
+        'delta_time'    : args.delta_time,
+        'frames'        : len(log.times),
+        'interval'      : stats(intervals),
+        'jitter'        : stats([abs(i - args.delta_time) for i in intervals]),
+        'lateness'      : stats(lateness),
+        'write_stalls'  : tl.writer.write_stalls,
+    }
+
+def bench_mjpeg(camera, args):
+    """Connect N clients to the MJPEG stream and measure fps per client."""
+    camera.mjpegstream_start(port=args.mjpeg_port)
+    counts = [0] * args.clients
+    first = [None] * args.clients
+    stop = threading.Event()
+    def client(i):
+        sock = socket.create_connection(("127.0.0.1", args.mjpeg_port))
+        sock.sendall("GET / HTTP/1.0\r\n\r\n")
+        boundary = "--" + mjpegger.BOUNDARY
+        tail = ""
+        try:
+            while not stop.is_set():
+                data = sock.recv(65536)
+                if not data:
+                    break
+                data = tail + data
+                n = data.count(boundary)
+                if n and first[i] == None:
+                    first[i] = time.time()
+                counts[i] += n
+                tail = data[-len(boundary):]
+        finally:
+            sock.close()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    start = time.time()
+    for t in threads:
+        t.daemon = True
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    elapsed = time.time() - start
+    camera.mjpegstream_stop()
+    fps = [counts[i] / (elapsed - (first[i] - start)) if first[i] else 0.0
+                for i in range(args.clients)]
+    return {
+        'clients'       : args.clients,
+        'duration'      : elapsed,
+        'fps'           : stats(fps),
+        'first_frame'   : stats([f - start for f in first if f]),
+    }
+
+def bench_capture(camera, args):
+    """Time POSTs to /capture, and fetching the preview, through the web
+    server running on its own thread."""
+    import tornado.httpserver
+    import tornado.ioloop
+    import camera_server
+    camera_server.camera = camera
+    server = tornado.httpserver.HTTPServer(camera_server.MainServerApp())
+    server.listen(args.http_port, address="127.0.0.1")
+    loop = tornado.ioloop.IOLoop.instance()
+    thread = threading.Thread(target=loop.start)
+    thread.daemon = True
+    thread.start()
+    base = "http://127.0.0.1:{0}".format(args.http_port)
+    capture_times = []
+    preview_times = []
+    try:
+        for i in range(args.captures):
+            start = time.time()
+            resp = json.loads(urllib2.urlopen(base + "/capture", "{}").read())
+            capture_times.append(time.time() - start)
+            start = time.time()
+            urllib2.urlopen(base + resp['urls']['screen']).read()
+            preview_times.append(time.time() - start)
+    finally:
+        loop.add_callback(loop.stop)
+        thread.join()
+        server.stop()
+    return {
+        'capture'   : stats(capture_times),
+        'preview'   : stats(preview_times),
+    }
+
+def bench_histogram(camera, args):
+    """Time the histogram overlay, with the capture itself subtracted."""
+    results = {}
+    for name, size in (('full', (1920,1080)), ('screen', (960,540))):
+        times = []
+        for i in range(args.captures):
+            before = campi.ENCODE_TIME.snapshot().get(('histogram',), {'sum':0.0})
+            camera.capture_with_histogram(None, size=size)
+            after = campi.ENCODE_TIME.snapshot()[('histogram',)]
+            times.append(after['sum'] - before['sum'])
+        results[name] = stats(times)
+    return results
+
+def bench_status(camera, args):
+    """Publish timelapse status to N subscribers as fast as possible."""
+    import camera_server
+    class Subscriber(object):
+        def __init__(self, ):
+            self.messages = 0
+        def write_message(self, message):
+            self.messages += 1
+    class Timelapse(object):
+        count = 0
+        def get_status(self, ):
+            self.count += 1
+            return {'image_count': self.count, 'wait_time': 1.0,
+                    'remaining_time': 100.0, 'finish_time': 1.5e9,
+                    'is_alive': True,
+                    'total_imgs': 1000}
+    camera_server.camera = camera
+    hub = camera_server.StatusHub()
+    hub.heartbeat = float('inf')
+    hub.subscribers = set(Subscriber() for i in range(args.clients))
+    saved = camera_server.timelapse
+    camera_server.timelapse = Timelapse()
+    try:
+        start = time.time()
+        updates = 0
+        while time.time() - start < args.duration:
+            hub.update()
+            updates += 1
+        elapsed = time.time() - start
+    finally:
+        camera_server.timelapse = saved
+    sent = sum(s.messages for s in hub.subscribers)
+    return {
+        'subscribers'       : args.clients,
+        'updates_per_sec'   : updates / elapsed,
+        'messages_per_sec'  : sent / elapsed,
+    }
+
+def parse_sim(values):
+    """Parse --sim name=value options."""
+    config = {}
+    for value in values:
+        name, _, number = value.partition("=")
+        config[name] = None if number == "None" else float(number)
+    return config
+
+#--------------------------------------------------------------------
+# M A I N
+#--------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hardware free benchmarks.")
+    parser.add_argument("-b", "--benchmark", action="append", choices=BENCHMARKS,
+                        help="benchmark to run, can be repeated (default all)")
+    parser.add_argument("-o", "--output", help="JSON results file (default stdout)")
+    parser.add_argument("--sim", action="append", default=[],
+                        help="simulation setting name=value, see simhw.CONFIG")
+    parser.add_argument("--frames", type=int, default=20,
+                        help="timelapse frames")
+    parser.add_argument("--delta-time", type=float, default=1.0,
+                        help="timelapse interval, secs")
+    parser.add_argument("--clients", type=int, default=4,
+                        help="MJPEG clients / status subscribers")
+    parser.add_argument("--duration", type=float, default=5.0,
+                        help="secs to run the MJPEG and status benchmarks")
+    parser.add_argument("--captures", type=int, default=5,
+                        help="captures for the capture and histogram benchmarks")
+    parser.add_argument("--mjpeg-port", type=int, default=18081)
+    parser.add_argument("--http-port", type=int, default=18080)
+    args = parser.parse_args()
+
+    simhw.configure(**parse_sim(args.sim))
+    here = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="campi_bench_")
+    os.chdir(workdir)
+    try:
+        camera = campi.Campi()
+        results = {}
+        for name in args.benchmark or BENCHMARKS:
+            print >>sys.stderr, "running {0}...".format(name)
+            results[name] = globals()["bench_"+name](camera, args)
+        camera.camera_close()
+    finally:
+        os.chdir(here)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'time'      : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime()),
+        'python'    : sys.version.split()[0],
+        'sim'       : simhw.CONFIG,
+        'args'      : vars(args),
+        'results'   : results,
+        'metrics'   : metrics.summarize(),
+    }
+    if args.output == None:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2, sort_keys=True)
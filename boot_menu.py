@@ -9,7 +9,6 @@
 # 2014-4-23
 # Carter Nelson
 #===========================================================================
-import time
 import os
 
 import campi
@@ -58,25 +57,30 @@ def update_menu():
 #===========================
 # MAIN
 #===========================
+update_menu()
 while True:
-    button_state = camera.get_buttons()
-    if (button_state[campi.BTN_UP]):
+    event = camera.get_button_event()
+    if event.kind not in (campi.BTN_PRESS, campi.BTN_REPEATED):
+        continue
+    if (event.btn == campi.BTN_UP):
         selection -= 1
         if (selection<1):
             selection = 4
-    if (button_state[campi.BTN_DOWN]):
+    if (event.btn == campi.BTN_DOWN):
         selection += 1
         if (selection>4):
             selection = 1
-    if (button_state[campi.BTN_SEL]):
+    if (event.btn == campi.BTN_SEL):
         print 'selection = %i' % selection
         if (selection==1):
             # start access point and time lapse web server
             camera.disp_msg(' access point '+\
                             ' starting.... ')            
             os.system('python /home/pi/start_ap.py')
-            os.system('cd /home/pi/rpi-camera')
-            os.system('python /home/pi/rpi-camera/camera_server.py')
+            # run the server in this process, reusing the campi
+            os.chdir(os.path.dirname(os.path.abspath(__file__)))
+            import camera_server
+            camera_server.main(camera)
         if (selection==2):
             # start home wifi
             camera.disp_msg(' home wifi    '+\
@@ -89,6 +93,6 @@ while True:
             # do nothing, just exit
             pass
         camera.disp_msg('     DONE')
+        camera.disp_flush()
         exit()
-    update_menu()    
-    time.sleep(0.1)
+    update_menu()
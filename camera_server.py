@@ -4,48 +4,179 @@
 #
 # Web interface.
 #
+# Run directly, or call main() to start the server in-process with an
+# already created Campi (see boot_menu.py). Use --headless to run without
+# the LCD.
+#
 # 2015-04-06
 # Carter Nelson
 #===========================================================================
 import os
+import sys
 import time
 import json
+import errno
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import tornado.gen
 import tornado.httpserver
+import tornado.ioloop
 import tornado.websocket
 import tornado.web
 import tornado.escape
+import tornado.iostream
 
 import campi
 import timelapser
+import previewcache
+import sessionindex
+import aviwriter
+import metrics
+import storage
+import exposure
+import archive
+import scheduler
 
 ROOT_DIR = os.getcwd()
 PORT = 8080
+VIDEO_MODE_DELTA = 1.0      # timelapse intervals below this use video mode,
+                            # 0 is stills back to back
+MAKE_VIDEO = True           # build timelapse AVI as frames are captured, not
+                            # with retention, the AVI would keep every frame
+DOWNLOAD_CHUNK = 256 * 1024 # bytes per write when sending files
+STATUS_PERIOD = 500         # timelapse status sample period, ms
+STATUS_HEARTBEAT = 10       # secs between full timelapse status messages
+STORAGE_ROOTS = ['/media/usb', ROOT_DIR]    # first mounted one is used for frames
+RAMP_SHUTTER_FRACTION = 0.5 # exposure ramp shutter limit, fraction of delta_time
+H264_MAX_PENDING = 8        # H.264 messages unsent before a viewer is resynced
+
+# the campi, created by main()
+camera = None
+
+REQUEST_TIME = metrics.histogram('http_request_seconds',
+                                 'Time to handle a request, by handler and status',
+                                 ['handler', 'status'])
+H264_RESYNCS = metrics.counter('h264_resyncs_total',
+                               'H.264 viewers that fell behind and were restarted '
+                               'at a key frame')
+
+# H.264 live view websockets
+h264_viewers = set()
 
-camera = campi.Campi()
-camera.set_cam_config("resolution",(1920, 1080))
-camera.LCD_LED_On()
+# AVIs being assembled for download, by file name, only used on the IOLoop
+video_builds = {}
 
-# timelapse control thread
+# timelapse control thread, checked and started under the lock, as the
+# scheduler starts them too
 timelapse = None
+timelapse_lock = threading.Lock()
+
+# scheduled timelapse jobs, created by main()
+jobs = None
+
+# recent previews
+previews = previewcache.PreviewCache()
+
+# index of timelapse sessions, created by main()
+index = None
+
+# blocking work is kept off the IOLoop, camera work is done in order by a
+# single worker
+CAMERA_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+BLOCKING_EXECUTOR = ThreadPoolExecutor(max_workers=2)
 
 # global config
 config = {'delta_time':0,
           'total_imgs':0,
           'shutter_speed':0,
           'iso':0,
+          'change_threshold':0,
+          'retain_frames':0,
+          'exposure_ramp':0,
         }
 
+def new_storage(options=None):
+    """Return a StorageManager for a timelapse with the current config, or
+    with options."""
+    options = config if options == None else options
+    store = storage.StorageManager(storage.select_root(STORAGE_ROOTS),
+                                   retain_frames=options['retain_frames'],
+                                   copies=2 if makes_video(options) else 1)
+    store.estimated_frame_bytes = storage.estimate_frame_bytes(
+                                            camera.settings['resolution'],
+                                            camera.settings['quality'])
+    return store
+
+def makes_video(options):
+    """Return True if a timelapse with options builds an AVI."""
+    return MAKE_VIDEO and not options['retain_frames']
+
+def timelapse_running():
+    """Return True if a timelapse is running."""
+    return not timelapse == None and timelapse.is_alive() and \
+           not timelapse.finished
+
+def fit_error(store, total_imgs):
+    """Return why total_imgs frames won't fit in store, None if they will."""
+    prediction = store.predict(total_imgs)
+    if prediction['fits']:
+        return None
+    return "{0} images need {1} bytes, {2} free on {3}".format(
+                total_imgs, prediction['needed_bytes'],
+                prediction['free_bytes'], prediction['root'])
+
+def start_timelapse(options, store):
+    """Start and return a timelapse with options, as in config."""
+    if 0 < options['delta_time'] < VIDEO_MODE_DELTA:
+        mode = 'video'
+    else:
+        mode = 'still'
+    ramp = None
+    if options['exposure_ramp'] and mode == 'still':
+        max_shutter = options['delta_time'] * RAMP_SHUTTER_FRACTION * 1e6
+        ramp = {'max_shutter': int(min(exposure.MAX_SHUTTER, max_shutter))}
+    tl = timelapser.TimeLapser(kwargs={
+        'camera': camera,
+        'delta_time': options['delta_time'],
+        'total_imgs': options['total_imgs'],
+        'mode': mode,
+        'index': index,
+        'make_video': makes_video(options),
+        'change_threshold': options['change_threshold'],
+        'storage': store,
+        'ramp': ramp,
+        'on_finish': None if jobs == None else jobs.notify,
+        })
+    tl.start()
+    return tl
+
+def run_job(job, start, end):
+    """Scheduler runner, start the timelapse of a job. Return None if a
+    timelapse is already running, raise IOError if it won't fit."""
+    global timelapse
+    options = dict(config)
+    options.update(job.options)
+    if not job.options.get('total_imgs'):
+        options['total_imgs'] = scheduler.frames_between(start, end,
+                                                         options['delta_time'])
+    with timelapse_lock:
+        if timelapse_running():
+            return None
+        store = new_storage(options)
+        error = fit_error(store, options['total_imgs'])
+        if not error == None:
+            raise IOError(errno.ENOSPC, error)
+        print "Starting scheduled timelapse {0}.".format(job.id)
+        timelapse = start_timelapse(options, store)
+        return timelapse
+
 class MainHandler(tornado.web.RequestHandler):
     """Handler for server root."""
    
     def get(self, ):
         print "Root get."
-        tl_running = False
-        if not timelapse == None:
-            if timelapse.is_alive():
-                tl_running = True
-        if tl_running:
+        if timelapse_running():
             print "timelapse"
             self.render("timelapse.html")
         else:
@@ -57,25 +188,15 @@ class TimelapseHandler(tornado.web.RequestHandler):
         
     def get(self, ):
         global timelapse
-        if not timelapse == None:
-            if not timelapse.is_alive():
-                timelapse = None
-        if timelapse == None:
-            print "Starting timelapse."
-            self.__start_timelapse()
+        with timelapse_lock:
+            if not timelapse_running():
+                store = new_storage()
+                error = fit_error(store, config['total_imgs'])
+                if not error == None:
+                    raise tornado.web.HTTPError(507, error)
+                print "Starting timelapse."
+                timelapse = start_timelapse(config, store)
         self.render("timelapse.html")
-              
-    def __start_timelapse(self, ):
-        global timelapse
-        if not timelapse == None:
-            if timelapse.t.is_alive():
-                return
-        timelapse = timelapser.TimeLapser(kwargs={
-            'camera': camera,
-            'delta_time': config['delta_time'],
-            'total_imgs': config['total_imgs'],
-            })
-        timelapse.start()
         
     def __stop_timelapse(self, ):
         global timelapse
@@ -83,27 +204,73 @@ class TimelapseHandler(tornado.web.RequestHandler):
             timelapse.stop()
             timelapse = None
             
-class TimelapseStatusHandler(tornado.websocket.WebSocketHandler):
-    """Serve up timelapse status via websocket."""
-    
-    def initialize(self, ):
-        self.status_loop = None
+class StatusHub(object):
+    """Samples the timelapse status once per period and publishes it to all
+    websocket subscribers. Only the fields that changed are sent, with the
+    full status resent every heartbeat secs."""
     
-    def open(self, ):
-        """Callback for when websocket is opened."""
-        self.status_loop = tornado.ioloop.PeriodicCallback(self.send_status, 500)
-        self.status_loop.start()
-    
-    def on_close(self, ):
-        """Callback for when websocket is closed."""
-        if not self.status_loop == None:
-            self.status_loop.stop()
-            self.status_loop = None
+    def __init__(self, period=STATUS_PERIOD, heartbeat=STATUS_HEARTBEAT):
+        self.period = period
+        self.heartbeat = heartbeat
+        self.subscribers = set()
+        self.status = {}
+        self.last_full = 0
+        self.loop = None
+        
+    def subscribe(self, subscriber):
+        """Add subscriber and send it the full current status."""
+        self.subscribers.add(subscriber)
+        if self.status:
+            subscriber.write_message(json.dumps(self.status))
+        if self.loop == None:
+            self.loop = tornado.ioloop.PeriodicCallback(self.update, self.period)
+            self.loop.start()
     
-    def send_status(self, ):
+    def unsubscribe(self, subscriber):
+        """Remove subscriber. Sampling stops when there are none left."""
+        self.subscribers.discard(subscriber)
+        if not self.subscribers and not self.loop == None:
+            self.loop.stop()
+            self.loop = None
+            
+    def update(self, ):
+        """Sample timelapse status and publish any changes."""
         if timelapse == None:
             return
+        status = self.__sample()
+        delta = dict((k, v) for k, v in status.iteritems()
+                        if self.status.get(k) != v)
+        now = time.time()
+        if now - self.last_full >= self.heartbeat:
+            message = status
+            self.last_full = now
+        elif delta:
+            message = delta
+        else:
+            return
+        if 'image_count' in delta or 'is_alive' in delta:
+            self.__update_display(status)
+        self.status = status
+        self.publish(json.dumps(message))
+        
+    def publish(self, message):
+        """Send an already serialized message to all subscribers."""
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.write_message(message)
+            except tornado.websocket.WebSocketClosedError:
+                self.unsubscribe(subscriber)
+        
+    def __sample(self, ):
+        """Return timelapse status with times rounded to whole secs, so
+        that they only change once a second."""
         status = timelapse.get_status()
+        for k in ('wait_time', 'remaining_time', 'finish_time'):
+            if not status.get(k) == None:
+                status[k] = int(round(status[k]))
+        return status
+    
+    def __update_display(self, status):
         if status['is_alive']:
             camera.disp_msg('  Timelapse   '+\
                             '  running...  '+\
@@ -114,15 +281,28 @@ class TimelapseStatusHandler(tornado.websocket.WebSocketHandler):
         else:
             camera.disp_msg('  Timelapse   '+\
                             '    DONE      ')            
-        self.write_message(json.dumps(status))
+
+status_hub = StatusHub()
+            
+class TimelapseStatusHandler(tornado.websocket.WebSocketHandler):
+    """Serve up timelapse status via websocket."""
+    
+    def open(self, ):
+        """Callback for when websocket is opened."""
+        status_hub.subscribe(self)
+    
+    def on_close(self, ):
+        """Callback for when websocket is closed."""
+        status_hub.unsubscribe(self)
 
 class TimelapseCancelHandler(tornado.web.RequestHandler):
     """Cancel timelapse if running and redirect to configuration."""
     
+    @tornado.gen.coroutine
     def get(self, ):
         if not timelapse == None:
             timelapse.stop();
-            timelapse.join();
+            yield BLOCKING_EXECUTOR.submit(timelapse.join)
             self.redirect("/");
     
 class AjaxConfig(tornado.web.RequestHandler):
@@ -138,7 +318,7 @@ class AjaxConfig(tornado.web.RequestHandler):
         
     def __process_json(self, json_data):
         try:
-            config['delta_time'] = int(json_data['delta_time'])
+            config['delta_time'] = max(0.0, float(json_data['delta_time']))
         except ValueError:
             pass
         try:
@@ -153,12 +333,25 @@ class AjaxConfig(tornado.web.RequestHandler):
             config['iso'] = int(json_data['iso'])
         except ValueError:
             pass
-        resp_data = config
+        try:
+            config['change_threshold'] = float(json_data.get('change_threshold', 0))
+        except ValueError:
+            pass
+        try:
+            config['retain_frames'] = max(0, int(json_data.get('retain_frames', 0)))
+        except ValueError:
+            pass
+        try:
+            config['exposure_ramp'] = int(json_data.get('exposure_ramp', 0))
+        except ValueError:
+            pass
+        resp_data = dict(config)
         resp_data['total_time'] = self.__total_time_str()
+        resp_data['storage'] = new_storage().predict(config['total_imgs'])
         return json.dumps(resp_data)
     
     def __total_time_str(self, ):
-        total_secs = config['delta_time'] * config['total_imgs']
+        total_secs = int(config['delta_time'] * config['total_imgs'])
         hours = total_secs / 3600
         minutes = (total_secs % 3600) / 60
         seconds = total_secs % 60
@@ -167,49 +360,376 @@ class AjaxConfig(tornado.web.RequestHandler):
 class AjaxCapture(tornado.web.RequestHandler):
     """Handle AJAX for image capture."""
 
+    @tornado.gen.coroutine
     def post(self, ):
+        # optional JSON body, {"stack":count, "stack_mode":mode}, to stack
+        # frames for the image, see stacker.py
+        try:
+            json_data = json.loads(self.request.body or '{}')
+            stack = int(json_data.get('stack', 1))
+            stack_mode = json_data.get('stack_mode', 'mean')
+        except (ValueError, TypeError, AttributeError) as e:
+            raise tornado.web.HTTPError(400, str(e))
         print "Capturing image."
-        filename = 'static/preview.jpg'
-        camera.capture_with_histogram(filename)
-        url = "{0}?{1}".format(filename, time.time())  # prevent using cached image
-        resp = {'url':url}
+        size = previewcache.PREVIEW_SIZES['full']
+        try:
+            image = yield CAMERA_EXECUTOR.submit(camera.capture_with_histogram,
+                                                 None, size=size, stack=stack,
+                                                 stack_mode=stack_mode)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        preview_id = yield BLOCKING_EXECUTOR.submit(previews.add, image)
+        urls = previews.urls(preview_id)
+        resp = {'url':urls['screen'], 'urls':urls}
         self.write(json.dumps(resp))
 
+class PreviewHandler(tornado.web.RequestHandler):
+    """Serve cached preview images, with conditional GET support."""
+    
+    def get(self, preview_id, size):
+        entry = previews.get(preview_id, size)
+        if entry == None:
+            raise tornado.web.HTTPError(404)
+        data, etag = entry
+        self.set_header('Content-Type', 'image/jpeg')
+        self.set_header('Cache-Control', 'private, max-age=3600')
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(data)
+
+class GalleryHandler(tornado.web.RequestHandler):
+    """Handler for the timelapse gallery page."""
+    
+    def get(self, ):
+        self.render("gallery.html")
+
+def page_arguments(handler, per_page, max_per_page):
+    """Return (page, per_page) from a request's arguments, clamped to
+    range. Raises HTTPError 400 if they are not integers."""
+    try:
+        page = int(handler.get_argument('page', 1))
+        per_page = int(handler.get_argument('per_page', per_page))
+    except ValueError:
+        raise tornado.web.HTTPError(400, "page and per_page must be integers")
+    return max(1, page), max(1, min(max_per_page, per_page))
+
+class SessionsAPI(tornado.web.RequestHandler):
+    """Paginated JSON list of timelapse sessions, from the index."""
+    
+    @tornado.gen.coroutine
+    def get(self, ):
+        page, per_page = page_arguments(self, 20, 100)
+        total, sessions = yield BLOCKING_EXECUTOR.submit(index.get_sessions,
+                                                         page, per_page)
+        self.write(json.dumps({'page':page, 'per_page':per_page,
+                               'total':total, 'sessions':sessions}))
+
+class FramesAPI(tornado.web.RequestHandler):
+    """Paginated JSON list of frames of a timelapse session, from the index."""
+    
+    @tornado.gen.coroutine
+    def get(self, session):
+        page, per_page = page_arguments(self, 50, 500)
+        total, frames = yield BLOCKING_EXECUTOR.submit(index.get_frames,
+                                                       session, page, per_page)
+        for frame in frames:
+            del frame['filename']
+            frame['thumb_url'] = "/thumb/{0}/{1}".format(session, frame['number'])
+            frame['url'] = "/frame/{0}/{1}".format(session, frame['number'])
+        self.write(json.dumps({'page':page, 'per_page':per_page,
+                               'total':total, 'frames':frames}))
+
+class ScheduleAPI(tornado.web.RequestHandler):
+    """JSON list of scheduled timelapse jobs. POST a job to add it, DELETE
+    /api/schedule/<id> to cancel one."""
+
+    def get(self, ):
+        self.write(json.dumps({'jobs':jobs.get_jobs()}))
+
+    def post(self, ):
+        try:
+            job = scheduler.Job.from_dict(json.loads(self.request.body))
+        except (ValueError, TypeError) as e:
+            raise tornado.web.HTTPError(400, str(e))
+        jobs.add(job)
+        self.set_status(201)
+        self.write(json.dumps(job.to_dict()))
+
+    def delete(self, job_id):
+        job = jobs.cancel(int(job_id))
+        if job == None:
+            raise tornado.web.HTTPError(404)
+        self.write(json.dumps(job.to_dict()))
+
+class ThumbHandler(tornado.web.RequestHandler):
+    """Serve frame thumbnails from the index."""
+    
+    @tornado.gen.coroutine
+    def get(self, session, number):
+        thumb = yield BLOCKING_EXECUTOR.submit(index.get_thumbnail,
+                                               session, int(number))
+        if thumb == None:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', 'image/jpeg')
+        self.set_header('Cache-Control', 'max-age=86400')
+        self.write(thumb)
+
+class FrameHandler(tornado.web.RequestHandler):
+    """Serve full size timelapse frames."""
+    
+    @tornado.gen.coroutine
+    def get(self, session, number):
+        frame = yield BLOCKING_EXECUTOR.submit(index.get_frame,
+                                               session, int(number))
+        if frame == None:
+            raise tornado.web.HTTPError(404)
+        data = yield BLOCKING_EXECUTOR.submit(read_file, frame['filename'])
+        self.set_header('Content-Type', 'image/jpeg')
+        self.set_header('Cache-Control', 'max-age=86400')
+        self.write(data)
+
+class VideoHandler(tornado.web.RequestHandler):
+    """Download a timelapse session as a Motion-JPEG AVI. The AVI is
+    assembled from the frames if it does not already exist."""
+    
+    @tornado.gen.coroutine
+    def get(self, name):
+        session = yield BLOCKING_EXECUTOR.submit(index.get_session, name)
+        if session == None:
+            raise tornado.web.HTTPError(404)
+        if not timelapse == None and timelapse.is_alive() and \
+           timelapse.timelapse_name == name:
+            raise tornado.web.HTTPError(409, "timelapse still running")
+        filename = os.path.join(session['dir'], name+".avi")
+        if not os.path.exists(filename):
+            # one assembly per AVI, later requests wait for it
+            future = video_builds.get(filename)
+            if future == None:
+                future = BLOCKING_EXECUTOR.submit(aviwriter.assemble,
+                                                  session['dir'], filename)
+                video_builds[filename] = future
+            try:
+                yield future
+            finally:
+                if video_builds.get(filename) is future:
+                    del video_builds[filename]
+        self.set_header('Content-Type', 'video/x-msvideo')
+        self.set_header('Content-Disposition',
+                        'attachment; filename="{0}.avi"'.format(name))
+        self.set_header('Content-Length', os.path.getsize(filename))
+        with open(filename, "rb") as file:
+            while True:
+                data = yield BLOCKING_EXECUTOR.submit(file.read, DOWNLOAD_CHUNK)
+                if not data:
+                    break
+                self.write(data)
+                yield self.flush()
+
+class ArchiveHandler(tornado.web.RequestHandler):
+    """Download all the files of a timelapse session as a zip or tar,
+    built on the fly (see archive.py). Tar downloads can be resumed with
+    Range requests."""
+    
+    @tornado.gen.coroutine
+    def get(self, name, kind):
+        session = yield BLOCKING_EXECUTOR.submit(index.get_session, name)
+        if session == None:
+            raise tornado.web.HTTPError(404)
+        if not timelapse == None and timelapse.is_alive() and \
+           timelapse.timelapse_name == name:
+            raise tornado.web.HTTPError(409, "timelapse still running")
+        members = yield BLOCKING_EXECUTOR.submit(archive.session_members,
+                                                 session['dir'], name)
+        if kind == 'tar':
+            arc = archive.TarArchive(members)
+            pieces = self.__tar_range(arc)
+            if pieces == None:
+                return
+        else:
+            arc = archive.ZipArchive(members)
+            pieces = arc.pieces()
+        self.set_header('Content-Type', arc.content_type)
+        self.set_header('Content-Disposition',
+                        'attachment; filename="{0}.{1}"'.format(name, kind))
+        try:
+            for piece in pieces:
+                if isinstance(piece, str):
+                    self.write(piece)
+                    continue
+                yield self.flush()
+                yield self.__send_file(piece)
+            yield self.flush()
+        except tornado.iostream.StreamClosedError:
+            # client went away
+            pass
+    
+    def __tar_range(self, arc):
+        """Set the headers for the requested range of the tar and return
+        its pieces, or None if the range can not be satisfied."""
+        size = arc.size()
+        self.set_header('Accept-Ranges', 'bytes')
+        request_range = None
+        range_header = self.request.headers.get('Range')
+        try:
+            if range_header:
+                request_range = archive.parse_range(range_header, size)
+        except ValueError:
+            self.set_status(416)
+            self.set_header('Content-Range', 'bytes */{0}'.format(size))
+            return None
+        if request_range == None:
+            self.set_header('Content-Length', size)
+            return arc.pieces()
+        start, end = request_range
+        self.set_status(206)
+        self.set_header('Content-Range',
+                        'bytes {0}-{1}/{2}'.format(start, end - 1, size))
+        self.set_header('Content-Length', end - start)
+        return arc.pieces(start, end)
+    
+    @tornado.gen.coroutine
+    def __send_file(self, piece):
+        """Send a member's data, one chunk in memory at a time, waiting
+        for each chunk to be sent before reading the next."""
+        with open(piece.path, "rb") as file:
+            file.seek(piece.offset)
+            remaining = piece.length
+            while remaining > 0:
+                data = yield BLOCKING_EXECUTOR.submit(file.read,
+                                                      min(DOWNLOAD_CHUNK, remaining))
+                if not data:
+                    raise IOError("{0} is shorter than expected".format(piece.path))
+                remaining -= len(data)
+                piece.update(data)
+                self.write(data)
+                yield self.flush()
+
+def read_file(filename):
+    """Return contents of file."""
+    with open(filename, "rb") as file:
+        return file.read()
+
 class AjaxSetDate(tornado.web.RequestHandler):
     """Handle AJAX for setting time and date."""
 
+    @tornado.gen.coroutine
     def post(self, ):
         print "Setting date."
         json_data = json.loads(self.request.body)
-        os.system('date -s "{}"'.format(json_data['date']))
+        yield BLOCKING_EXECUTOR.submit(os.system,
+                                       'date -s "{}"'.format(json_data['date']))
+        if not jobs == None:
+            jobs.clock_changed()
 
 class MJPEGStream(tornado.web.RequestHandler):
     """Handler for serving a MJPEG stream."""
     
+    @tornado.gen.coroutine
     def post(self, ):
         print "mjpegstream post"
         json_data = json.loads(self.request.body)
         command = json_data['command']
         resp = {}
         if "START" in command.upper():
-            camera.mjpegstream_start()
+            yield CAMERA_EXECUTOR.submit(camera.mjpegstream_start)
             addr = self.request.host.partition(":")[0]
             resp['url'] = "http://" + addr + ":8081/"
             print "START"
         elif "STOP" in command.upper():
-            camera.mjpegstream_stop()
+            yield CAMERA_EXECUTOR.submit(camera.mjpegstream_stop)
             print "STOP"
         self.write(json.dumps(resp))
         
+class H264StreamHandler(tornado.websocket.WebSocketHandler):
+    """Serve the H.264 live view via websocket. The first message is JSON
+    with the codecs string, then binary messages with the init segment and
+    a MP4 fragment per frame, or with ?format=h264 raw H.264 (Annex B). The
+    camera records while there are viewers. A viewer that falls behind
+    skips ahead to the next key frame."""
+    
+    def open(self, ):
+        """Callback for when websocket is opened."""
+        self.format = self.get_argument('format', 'mp4')
+        if self.format not in ('mp4', 'h264'):
+            self.close()
+            return
+        self.stream = None
+        self.token = None
+        self.pending = 0
+        self.resyncing = False
+        self.codec_sent = False
+        self.loop = tornado.ioloop.IOLoop.current()
+        h264_viewers.add(self)
+        self.loop.add_future(CAMERA_EXECUTOR.submit(camera.h264stream_start),
+                             self.__started)
+    
+    def on_close(self, ):
+        """Callback for when websocket is closed."""
+        if self not in h264_viewers:
+            return
+        h264_viewers.discard(self)
+        if not self.token == None:
+            self.stream.unsubscribe(self.token)
+        if not h264_viewers:
+            CAMERA_EXECUTOR.submit(camera.h264stream_stop)
+    
+    def __started(self, future):
+        if self not in h264_viewers:
+            return
+        self.stream = future.result()
+        self.token = self.stream.subscribe(self.__on_data, self.format)
+    
+    def __on_data(self, data, key):
+        """Called on the encoder thread, hand over to the IOLoop."""
+        self.loop.add_callback(self.__send, data, key)
+    
+    def __send(self, data, key):
+        if self not in h264_viewers:
+            return
+        if self.resyncing:
+            if not key:
+                return
+            self.resyncing = False
+        elif self.pending >= H264_MAX_PENDING:
+            # can't keep up, drop frames until the next key frame
+            self.resyncing = True
+            self.stream.resync(self.token)
+            H264_RESYNCS.inc()
+            return
+        try:
+            if not self.codec_sent:
+                self.write_message(json.dumps({'codec' : self.stream.codec(),
+                                               'format': self.format}))
+                self.codec_sent = True
+            future = self.write_message(data, binary=True)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        if not future == None:
+            self.pending += 1
+            future.add_done_callback(self.__sent)
+    
+    def __sent(self, future):
+        self.pending -= 1
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serve metrics in the Prometheus text format."""
+    
+    def get(self, ):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.render())
+
 class PowerDownHandler(tornado.web.RequestHandler):
     """Handler for powering down the system."""
     
+    @tornado.gen.coroutine
     def get(self, ):
         self.render("powerdown.html")
         camera.disp_msg("BYE BYE")
         print "BYE BYE"
-        time.sleep(5)
-        os.system("sudo halt")
+        yield tornado.gen.sleep(5)
+        yield BLOCKING_EXECUTOR.submit(os.system, "sudo halt")
         
 class MainServerApp(tornado.web.Application):
     """Main Server application."""
@@ -222,9 +742,21 @@ class MainServerApp(tornado.web.Application):
             (r"/cancel",            TimelapseCancelHandler),
             (r"/ajaxconfig",        AjaxConfig),
             (r"/capture",           AjaxCapture),
+            (r"/preview/(\w+)/(\w+)", PreviewHandler),
+            (r"/gallery",           GalleryHandler),
+            (r"/api/sessions",      SessionsAPI),
+            (r"/api/sessions/(\w+)/frames", FramesAPI),
+            (r"/api/schedule",      ScheduleAPI),
+            (r"/api/schedule/(\d+)", ScheduleAPI),
+            (r"/thumb/(\w+)/(\d+)", ThumbHandler),
+            (r"/frame/(\w+)/(\d+)", FrameHandler),
+            (r"/video/(\w+)\.avi",  VideoHandler),
+            (r"/archive/(\w+)\.(zip|tar)", ArchiveHandler),
             (r"/mjpegstream",       MJPEGStream),   
+            (r"/h264stream",        H264StreamHandler),
             (r"/setdate",           AjaxSetDate),
             (r"/powerdown",         PowerDownHandler),   
+            (r"/metrics",           MetricsHandler),
         ]
         
         settings = {
@@ -233,14 +765,33 @@ class MainServerApp(tornado.web.Application):
         }
         
         tornado.web.Application.__init__(self, handlers, **settings)
+        
+    def log_request(self, handler):
+        """Record request latency, then log as usual."""
+        REQUEST_TIME.observe(handler.request.request_time(),
+                             handler=type(handler).__name__,
+                             status=handler.get_status())
+        tornado.web.Application.log_request(self, handler)
 
 #--------------------------------------------------------------------
 # M A I N 
 #--------------------------------------------------------------------
-if __name__ == '__main__':
-    tornado.httpserver.HTTPServer(MainServerApp()).listen(PORT)
-    print "Server started on port {0}.".format(PORT)
+def main(cam=None, port=PORT, headless=False):
+    """Start the server and run the IOLoop. If cam is None, a new Campi is
+    created."""
+    global camera, jobs, index
+    camera = cam if not cam == None else campi.Campi(headless=headless)
+    index = sessionindex.SessionIndex(os.path.join(ROOT_DIR, sessionindex.INDEX_FILE))
+    camera.set_cam_config("resolution",(1920, 1080))
+    jobs = scheduler.Scheduler(run_job)
+    jobs.start()
+    tornado.httpserver.HTTPServer(MainServerApp()).listen(port)
+    print "Server started on port {0}.".format(port)
+    camera.LCD_LED_On()
     camera.disp_msg('              '+\
                     '    SERVER    '+\
                     '    STARTED   ') 
     tornado.ioloop.IOLoop.instance().start()
+
+if __name__ == '__main__':
+    main(headless='--headless' in sys.argv[1:])
@@ -19,8 +19,15 @@
 import io
 import os
 import time
+import threading
+import contextlib
+import collections
+import itertools
+import heapq
+import Queue
 from fractions import Fraction
 
+import numpy as np
 import Image
 import ImageDraw
 import ImageFont
@@ -30,7 +37,11 @@ import Adafruit_Nokia_LCD as LCD
 import Adafruit_GPIO.SPI as SPI
 
 from picamera import PiCamera
+import picamera.array
 import mjpegger
+import h264mux
+import metrics
+import stacker
 
 # GPIO pins for 5 way navigation switch
 BTN_UP              =   19      # Up
@@ -40,6 +51,16 @@ BTN_RIGHT           =   20      # Right
 BTN_SEL             =   21      # Select (push)
 BUTTONS = [BTN_UP, BTN_DOWN, BTN_LEFT, BTN_RIGHT, BTN_SEL]
 
+# Button event handling
+BTN_DEBOUNCE        =   0.02    # secs, edges closer than this are bounce
+BTN_LONG_PRESS      =   1.0     # secs held before a long press event
+BTN_REPEAT          =   0.25    # secs between repeat events while held
+BTN_PRESS           =   'press'
+BTN_RELEASE         =   'release'
+BTN_LONG            =   'long'
+BTN_REPEATED        =   'repeat'
+ButtonEvent = collections.namedtuple('ButtonEvent', ['btn', 'kind', 'time'])
+
 # GPIO pins for Nokia LCD display control
 LCD_DC              =   23      # Nokia LCD display D/C
 LCD_RST             =   24      # Nokia LCD displat Reset
@@ -48,22 +69,339 @@ LCD_SPI_DEVICE      =   0       # Hardware SPI device (determines chip select pi
 LCD_LED             =   22      # LCD LED enable pin (HIGH=ON, LOW=OFF)
 LCD_CONTRAST        =   50      # LCD contrast 0-100
 
-# Load fonts
-FONT_SMALL = ImageFont.load_default()
-FONT_LARGE = ImageFont.truetype("5Identification-Mono.ttf",12)
+# Camera session
+CAMERA_IDLE_TIMEOUT =   30      # secs of inactivity before camera is closed
+MJPEG_START_TIMEOUT =   5       # secs to wait for MJPEG server to start
+
+# Camera splitter ports
+PORT_VIDEO_CAPTURE  =   0       # video port captures (previews, video timelapse)
+PORT_MJPEG          =   (1,2,3) # MJPEG live view recordings, one per tier
+PORT_H264           =   1       # H.264 live view, in place of the MJPEG stream
+
+# H.264 live view
+H264_RESIZE         =   (1280,720)
+H264_BITRATE        =   2000000 # bits/sec
+H264_PROFILE        =   'baseline'
+H264_INTRA_PERIOD   =   150     # frames, viewers joining request a key frame
+
+# Camera properties, in the order they are applied. framerate and
+# exposure_mode must be set before shutter_speed.
+CAMERA_PROPERTIES = ['framerate', 'resolution', 'exposure_mode', 'iso',
+                     'awb_mode', 'shutter_speed', 'brightness', 'contrast',
+                     'sharpness', 'saturation', 'hflip', 'vflip']
+# properties that reconfigure the camera ports
+RECONFIGURE_PROPERTIES = ['framerate', 'resolution']
+# properties that must be reapplied when another one changes
+DEPENDENT_PROPERTIES = {'framerate'     : ['shutter_speed'],
+                        'exposure_mode' : ['shutter_speed']}
+
+# Camera access priorities, lower goes first
+PRIORITY_TIMELAPSE  =   0
+PRIORITY_CAPTURE    =   1
+PRIORITY_PREVIEW    =   2
+
+# Metrics
+CAMERA_OPEN_TIME    = metrics.histogram('campi_camera_open_seconds',
+                                        'Time to open the camera')
+CAMERA_WAIT_TIME    = metrics.histogram('campi_camera_wait_seconds',
+                                        'Time waiting for the camera broker')
+SETTING_APPLY_TIME  = metrics.histogram('campi_setting_apply_seconds',
+                                        'Time to set a camera property',
+                                        ['property'])
+CAPTURE_TIME        = metrics.histogram('campi_capture_seconds',
+                                        'Time to capture, camera wait excluded',
+                                        ['kind'])
+ENCODE_TIME         = metrics.histogram('campi_encode_seconds',
+                                        'Time to render and encode an image',
+                                        ['kind'])
+LCD_PUSH_TIME       = metrics.histogram('campi_lcd_push_seconds',
+                                        'Time to push an image to the LCD over SPI')
+LCD_UPDATES         = metrics.counter('campi_lcd_updates_total',
+                                      'LCD images submitted, by what happened to them',
+                                      ['result'])
 
-# Image draw buffer for writing to LCD display
-LCD_IMAGE = Image.new('1', (LCD.LCDWIDTH, LCD.LCDHEIGHT))
-LCD_DRAW  = ImageDraw.Draw(LCD_IMAGE)
+# Fonts, loaded on first use
+FONT_FILE  = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "5Identification-Mono.ttf")
+FONT_CACHE = {}
+FONT_SMALL = None               # PIL default font
+FONT_LARGE = 12                 # TrueType font size
+def get_font(size=FONT_SMALL):
+    """Return the TrueType font at the specified size, loading it only once.
+    If size is None, the PIL default font is returned."""
+    if size not in FONT_CACHE:
+        if size == None:
+            FONT_CACHE[size] = ImageFont.load_default()
+        else:
+            FONT_CACHE[size] = ImageFont.truetype(FONT_FILE, size)
+    return FONT_CACHE[size]
 
 # Display locations
 WHOLE_SCREEN    = ((0,0),(LCD.LCDWIDTH, LCD.LCDHEIGHT))
 BIG_MSG         = (0,12)         
 
+class DisplayThread(threading.Thread):
+    """Thread to push images to the LCD display. Only the most recent image
+    is kept, so updates from several callers are coalesced, and the SPI
+    transfer is skipped if the image matches what is already displayed.
+    """
+    
+    def __init__(self, disp):
+        threading.Thread.__init__(self, name="DisplayThread")
+        self.daemon = True
+        self._disp = disp
+        self._pending = None
+        self._shown = None
+        self._busy = False
+        self._condition = threading.Condition()
+        self.pushes = 0
+        self.skipped = 0
+        self.coalesced = 0
+        
+    def submit(self, image):
+        """Queue image for display, replacing any image not yet displayed."""
+        with self._condition:
+            if not self._pending == None:
+                self.coalesced += 1
+                LCD_UPDATES.inc(result='coalesced')
+            self._pending = image.copy()
+            self._condition.notify_all()
+            
+    def flush(self, timeout=1.0):
+        """Wait up to timeout secs for all submitted images to be handled."""
+        end_time = time.time() + timeout
+        with self._condition:
+            while not self._pending == None or self._busy:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+        
+    def run(self, ):
+        while True:
+            with self._condition:
+                while self._pending == None:
+                    self._condition.wait()
+                image = self._pending
+                self._pending = None
+                self._busy = True
+            # tobytes() from Pillow 2, tostring() on old PIL
+            tobytes = getattr(image, 'tobytes', None) or image.tostring
+            data = tobytes()
+            if data == self._shown:
+                self.skipped += 1
+                LCD_UPDATES.inc(result='skipped')
+            else:
+                with LCD_PUSH_TIME.time():
+                    self._disp.image(image)
+                    self._disp.display()
+                self._shown = data
+                self.pushes += 1
+                LCD_UPDATES.inc(result='pushed')
+            with self._condition:
+                self._busy = False
+                self._condition.notify_all()
+
+class CameraBroker(object):
+    """Owns the single PiCamera and shares it between clients.
+    
+    The camera is kept open between uses, so sensor init and AWB/AE
+    convergence are only paid once, and closed after an idle timeout.
+    Clients that can use the camera as it is configured share it, each on
+    its own port (still port, or a splitter port of the video port).
+    Clients that need the camera to themselves, or a different sensor mode
+    (which can only be set at init), get exclusive access. They wait for
+    the shared clients to finish, and any recorders are paused while they
+    have the camera. Waiting clients are served in priority order.
+    """
+    
+    def __init__(self, idle_timeout=CAMERA_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.camera = None
+        self.sensor_mode = None
+        self._condition = threading.Condition()
+        self._users = 0
+        self._exclusive = False
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._recorders = collections.OrderedDict()
+        self._recorders_paused = False
+        self._idle_timer = None
+        self._last_used = None
+        self._init = {}
+        self.applied = {}
+    
+    @contextlib.contextmanager
+    def session(self, sensor_mode=None, priority=PRIORITY_CAPTURE, exclusive=False,
+                init=None):
+        """Provide the camera for the duration of a with block. If sensor_mode
+        is None, the camera is used in whatever mode it is already in. If the
+        camera has to be opened, it is opened with the properties in init."""
+        with CAMERA_WAIT_TIME.time():
+            camera, exclusive = self.__acquire(sensor_mode, priority, exclusive, init)
+        try:
+            yield camera
+        finally:
+            self.__release(exclusive)
+    
+    def add_recorder(self, name, start, stop, sensor_mode=0, priority=PRIORITY_PREVIEW,
+                     init=None):
+        """Add a long running recorder. start(camera) and stop(camera) are
+        called to start and stop its recording, including whenever it is
+        paused and resumed for an exclusive client."""
+        camera, exclusive = self.__acquire(sensor_mode, priority, False, init)
+        try:
+            with self._condition:
+                self._recorders[name] = (start, stop, sensor_mode)
+                if not self._recorders_paused:
+                    start(camera)
+        finally:
+            self.__release(exclusive)
+    
+    def remove_recorder(self, name):
+        """Stop and remove a recorder."""
+        with self._condition:
+            if name not in self._recorders:
+                return
+            start, stop, sensor_mode = self._recorders.pop(name)
+            if not self._recorders_paused and not self.camera == None:
+                stop(self.camera)
+            self.__check_idle()
+            self._condition.notify_all()
+    
+    def close(self, ):
+        """Close the camera if nobody is using it. Return True if closed."""
+        with self._condition:
+            if self._users or self._exclusive or self._recorders:
+                return False
+            self.__close()
+            return True
+    
+    def is_open(self, ):
+        """Return True if the camera is open, False otherwise."""
+        return not self.camera == None
+        
+    def __acquire(self, sensor_mode, priority, exclusive, init=None):
+        with self._condition:
+            self.__cancel_idle_timer()
+            ticket = (priority, next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    ready, exclusive = self.__can_acquire(ticket, sensor_mode, exclusive)
+                    if ready:
+                        break
+                    self._condition.wait()
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+            if exclusive:
+                self._exclusive = True
+                self.__pause_recorders()
+            else:
+                self._users += 1
+            if self.camera == None or \
+               (not sensor_mode == None and sensor_mode != self.sensor_mode):
+                self.__open(0 if sensor_mode == None else sensor_mode, init)
+            self._condition.notify_all()
+            return self.camera, exclusive
+    
+    def __can_acquire(self, ticket, sensor_mode, exclusive):
+        """Return (ready, exclusive) for a waiting client. A sensor mode change
+        makes the client exclusive."""
+        if self._exclusive or self._waiting[0] != ticket:
+            return False, exclusive
+        if not self.camera == None and not sensor_mode == None and \
+           sensor_mode != self.sensor_mode:
+            exclusive = True
+        if exclusive:
+            return self._users == 0, exclusive
+        return True, exclusive
+            
+    def __release(self, exclusive):
+        with self._condition:
+            if exclusive:
+                self._exclusive = False
+                self.__resume_recorders()
+            else:
+                self._users -= 1
+            self._last_used = time.time()
+            self.__check_idle()
+            self._condition.notify_all()
+    
+    def __pause_recorders(self, ):
+        if self._recorders_paused or self.camera == None or not self._recorders:
+            return
+        for start, stop, sensor_mode in self._recorders.values():
+            stop(self.camera)
+        self._recorders_paused = True
+    
+    def __resume_recorders(self, ):
+        if not self._recorders_paused:
+            return
+        self._recorders_paused = False
+        if not self._recorders:
+            return
+        sensor_mode = self._recorders.values()[0][2]
+        if self.camera == None or sensor_mode != self.sensor_mode:
+            self.__open(sensor_mode)
+        for start, stop, sensor_mode in self._recorders.values():
+            start(self.camera)
+            
+    def __open(self, sensor_mode, init=None):
+        """Open the camera. Properties in init (resolution, framerate) are
+        passed to the constructor, so they cost no extra reconfiguration.
+        If init is None, the last init is used."""
+        self.__close()
+        if not init == None:
+            self._init = dict(init)
+        with CAMERA_OPEN_TIME.time():
+            self.camera = PiCamera(sensor_mode=sensor_mode, **self._init)
+        self.sensor_mode = sensor_mode
+        self.applied = dict(self._init)
+        
+    def __close(self, ):
+        self.__cancel_idle_timer()
+        if not self.camera == None:
+            self.camera.close()
+        self.camera = None
+        self.sensor_mode = None
+        self.applied = {}
+        
+    def __check_idle(self, ):
+        """Start idle timer if nobody is using the camera."""
+        if self._users or self._exclusive or self._recorders:
+            return
+        if self.camera == None or self.idle_timeout == None:
+            return
+        self.__cancel_idle_timer()
+        self._idle_timer = threading.Timer(self.idle_timeout, self.__idle_timeout)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+    
+    def __idle_timeout(self, ):
+        """Close the camera if it has not been used since the timer started."""
+        with self._condition:
+            if self._last_used == None:
+                return
+            if time.time() - self._last_used >= self.idle_timeout:
+                self.close()
+        
+    def __cancel_idle_timer(self, ):
+        if not self._idle_timer == None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
 class Campi():
-    """A class to provide an interface to the campi hardware."""
+    """A class to provide an interface to the campi hardware.
+    
+    Nothing is initialized until it is first used: the display on the first
+    display call, the GPIO on the first button or LED call, and the camera
+    on the first capture. With headless=True there is no display and the
+    display calls do nothing.
+    """
         
-    def __init__(self):
+    def __init__(self, headless=False):
         """Constructor."""
         self.settings = {}
         self.settings['sensor_mode'] = 0               # 0 (auto), 2 (1-15fps), 3 (0.1666-1fps) (see doc)
@@ -80,36 +418,77 @@ class Campi():
         self.settings['hvflip'] = (True, True)         # horizontal/vertical flip
         self.settings['quality'] = 100                 # 0 - 100, applies only to JPGs
         self.settings['awb_gains'] = None
- 
-        self._disp = LCD.PCD8544(LCD_DC,
-                                 LCD_RST,
-                                 spi=SPI.SpiDev(LCD_SPI_PORT,
-                                                LCD_SPI_DEVICE,
-                                                max_speed_hz=4000000)
-                                 )
-        self._disp.begin(contrast=LCD_CONTRAST)
-        self._disp.clear()
-        self._disp.display()
+        
+        self.headless = headless
+        self._hw_lock = threading.Lock()
+        self._disp = None
+        self._disp_thread = None
+        self._gpio = None
         
         self._mjpegger = None
+        self._h264 = None
         
-        self._gpio = GPIO
-        self._gpio.setwarnings(False)
-        self._gpio.setmode(GPIO.BCM)
-        for B in BUTTONS:
-            GPIO.setup(B, GPIO.IN , pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(LCD_LED, GPIO.OUT, initial=GPIO.LOW)
+        self._broker = CameraBroker()
+        self._apply_lock = threading.Lock()
+        self.apply_times = {}
+        
+        self._btn_lock = threading.Lock()
+        self._btn_state = {}
+        self._btn_edge_time = {}
+        self._btn_events = Queue.Queue()
+        self._btn_callbacks = []
+        self._btn_latency = {'count':0, 'total':0.0, 'max':0.0}
+    
+    def __get_display(self, ):
+        """Return the display thread, setting up the LCD on first use.
+        Returns None if headless."""
+        if self.headless:
+            return None
+        with self._hw_lock:
+            if self._disp_thread == None:
+                self._disp = LCD.PCD8544(LCD_DC,
+                                         LCD_RST,
+                                         spi=SPI.SpiDev(LCD_SPI_PORT,
+                                                        LCD_SPI_DEVICE,
+                                                        max_speed_hz=4000000)
+                                         )
+                self._disp.begin(contrast=LCD_CONTRAST)
+                self._disp.clear()
+                self._disp.display()
+                self._disp_thread = DisplayThread(self._disp)
+                self._disp_thread.start()
+            return self._disp_thread
+    
+    def __get_gpio(self, ):
+        """Return the GPIO module, setting up the pins on first use."""
+        with self._hw_lock:
+            if self._gpio == None:
+                GPIO.setwarnings(False)
+                GPIO.setmode(GPIO.BCM)
+                for B in BUTTONS:
+                    GPIO.setup(B, GPIO.IN , pull_up_down=GPIO.PUD_UP)
+                if not self.headless:
+                    GPIO.setup(LCD_LED, GPIO.OUT, initial=GPIO.LOW)
+                for B in BUTTONS:
+                    self._btn_state[B] = GPIO.input(B) == 0
+                    self._btn_edge_time[B] = 0
+                    GPIO.add_event_detect(B, GPIO.BOTH, callback=self.__button_edge)
+                self._gpio = GPIO
+            return self._gpio
   
     #---------------------------------------------------------------
     #                   C  A  M  E  R  A
     #---------------------------------------------------------------        
     def capture(self, filename):
         """Capture an image using current settings and save to the specified
-        filename.
+        filename. A file like object can also be supplied, in which case a
+        JPEG is written to it.
         """
-        with PiCamera(sensor_mode=self.settings['sensor_mode']) as camera:
+        format = None if isinstance(filename, basestring) else 'jpeg'
+        with self.__session(self.settings['sensor_mode']) as camera:
             camera = self.__update_camera(camera=camera)
-            camera.capture(filename, quality=self.settings['quality'])
+            with CAPTURE_TIME.time(kind='still'):
+                camera.capture(filename, format, quality=self.settings['quality'])
             self.__update_settings(camera)
                                                                    
     def capture_stream(self, ios=None, size=(400,225)):
@@ -117,28 +496,129 @@ class Campi():
         also be specified."""
         if ios == None:
             return
-        with PiCamera(sensor_mode=5) as camera:
+        with self.__session(priority=PRIORITY_PREVIEW) as camera:
             camera = self.__update_camera(camera=camera, use_video_port=True)
-            camera.capture(ios, 'jpeg', use_video_port=True, resize=size)
+            with CAPTURE_TIME.time(kind='stream'):
+                camera.capture(ios, 'jpeg', use_video_port=True, resize=size,
+                               splitter_port=PORT_VIDEO_CAPTURE)
+    
+    def capture_video_frames(self, framerate=Fraction(30,1), settle_time=2):
+        """Generator that yields JPEG frames captured continuously from the
+        video port at the specified frame rate. Exposure and white balance
+        are allowed to settle and then locked, so all frames match. The
+        camera is held until the generator is closed.
+        """
+        with self.__session(0, PRIORITY_TIMELAPSE, exclusive=True) as camera:
+            camera = self.__update_camera(camera=camera)
+            self.__set_camera(camera, 'framerate', framerate)
+            if self.settings['shutter_speed'] == 0:
+                time.sleep(settle_time)
+                self.__set_camera(camera, 'shutter_speed', camera.exposure_speed)
+                self.__set_camera(camera, 'exposure_mode', 'off')
+            gains = camera.awb_gains
+            self.__set_camera(camera, 'awb_mode', 'off')
+            camera.awb_gains = gains
+            stream = io.BytesIO()
+            for foo in camera.capture_continuous(stream, 'jpeg',
+                                                 use_video_port=True,
+                                                 splitter_port=PORT_VIDEO_CAPTURE,
+                                                 quality=self.settings['quality']):
+                yield stream.getvalue()
+                stream.seek(0)
+                stream.truncate()
+    
+    def camera_close(self, ):
+        """Close the camera, if open and not in use."""
+        self._broker.close()
+    
+    def camera_is_open(self, ):
+        """Return True if the camera is open, False otherwise."""
+        return self._broker.is_open()
     
-    def mjpegstream_start(self, port=8081, resize=(640,360)):
-        """Start thread to serve MJPEG stream on specified port."""
+    def get_apply_times(self, ):
+        """Return dictionary of how long each camera property took to set,
+        as {property: {count, total, last, max}} in seconds."""
+        with self._apply_lock:
+            return dict((p, dict(t)) for p, t in self.apply_times.iteritems())
+    
+    def mjpegstream_start(self, port=8081, tiers=mjpegger.TIERS):
+        """Start thread to serve MJPEG stream on specified port. Each quality
+        tier, (name, resize, quality), is recorded on its own splitter port
+        while it has viewers, so stills and timelapses can run while the
+        stream is up."""
         if not self._mjpegger == None:
             return
-        camera = self.__update_camera(camera=PiCamera(sensor_mode=5))        
-        kwargs = {'camera':camera, 'port':port, 'resize':resize}
+        self.h264stream_stop()
+        def start_capture(frames, tier):
+            name, resize, quality = tiers[tier]
+            def start_recording(camera):
+                self.__update_camera(camera=camera, use_video_port=True)
+                camera.start_recording(frames, 'mjpeg', resize=resize,
+                                       quality=quality,
+                                       splitter_port=PORT_MJPEG[tier])
+            def stop_recording(camera):
+                camera.stop_recording(splitter_port=PORT_MJPEG[tier])
+            self._broker.add_recorder('mjpeg_'+name, start_recording,
+                                      stop_recording,
+                                      init=self.__camera_init(True))
+        def stop_capture(tier):
+            self._broker.remove_recorder('mjpeg_'+tiers[tier][0])
+        kwargs = {'port':port,
+                  'tiers':tiers,
+                  'start_capture':start_capture,
+                  'stop_capture':stop_capture}
         self._mjpegger = mjpegger.MJPEGThread(kwargs=kwargs)
         self._mjpegger.start()
-        while not self._mjpegger.streamRunning:
-            pass
+        self._mjpegger.started.wait(MJPEG_START_TIMEOUT)
     
     def mjpegstream_stop(self, ):
         """Stop the MJPEG stream, if running."""
         if not self._mjpegger == None:
             if self._mjpegger.is_alive():
                 self._mjpegger.stop()
+                # its recordings must be stopped before the ports are reused
+                self._mjpegger.join(MJPEG_START_TIMEOUT)
             self._mjpegger = None
                 
+    def h264stream_start(self, resize=H264_RESIZE, bitrate=H264_BITRATE):
+        """Start recording H.264 for the live view, in place of the MJPEG
+        stream. Return the h264mux.H264Broadcast to subscribe to."""
+        if not self._h264 == None:
+            return self._h264
+        self.mjpegstream_stop()
+        def request_key_frame():
+            camera = self._broker.camera
+            if camera == None:
+                return
+            try:
+                camera.request_key_frame(splitter_port=PORT_H264)
+            except picamera.PiCameraError:
+                # not recording right now, e.g. paused for a capture, the
+                # recording starts with a key frame when it resumes
+                pass
+        stream = h264mux.H264Broadcast(framerate=float(self.settings['framerate']),
+                                       request_key_frame=request_key_frame)
+        def start_recording(camera):
+            self.__update_camera(camera=camera, use_video_port=True)
+            camera.start_recording(stream, 'h264', resize=resize,
+                                   bitrate=bitrate,
+                                   profile=H264_PROFILE,
+                                   intra_period=H264_INTRA_PERIOD,
+                                   inline_headers=True,
+                                   splitter_port=PORT_H264)
+        def stop_recording(camera):
+            camera.stop_recording(splitter_port=PORT_H264)
+        self._broker.add_recorder('h264', start_recording, stop_recording,
+                                  init=self.__camera_init(True))
+        self._h264 = stream
+        return stream
+    
+    def h264stream_stop(self, ):
+        """Stop the H.264 live view, if running."""
+        if not self._h264 == None:
+            self._broker.remove_recorder('h264')
+            self._h264 = None
+    
     def mjpgstream_is_alive(self, ):
         """Return True if stream is running, False otherwise."""
         if self._mjpegger == None:
@@ -146,18 +626,99 @@ class Campi():
         else:
             return self._mjpegger.is_alive()
                         
-    def capture_with_histogram(self, filename, fill=False):
-        """Capture an image with histogram overlay and save to specified file.
-        If fill=True, the area under the histogram curves will be filled.
+    def capture_luma(self, size=(64,48)):
+        """Capture a small luminance (Y) sample from the video port and return
+        it as a 2D numpy array. Much cheaper than a full capture."""
+        fw = (size[0] + 31) // 32 * 32      # YUV buffers are padded
+        fh = (size[1] + 15) // 16 * 16
+        stream = io.BytesIO()
+        with self.__session(self.settings['sensor_mode']) as camera:
+            camera = self.__update_camera(camera=camera)
+            with CAPTURE_TIME.time(kind='luma'):
+                camera.capture(stream, 'yuv', use_video_port=True, resize=size,
+                               splitter_port=PORT_VIDEO_CAPTURE)
+            self.settings['exposure_speed'] = camera.exposure_speed
+        y = np.frombuffer(stream.getvalue(), dtype=np.uint8, count=fw*fh)
+        return y.reshape(fh, fw)[:size[1], :size[0]]
+    
+    def capture_array(self, ):
+        """Capture an image using current settings and return it as a numpy
+        RGB array. Nothing is encoded or written to disk."""
+        with self.__session(self.settings['sensor_mode']) as camera:
+            camera = self.__update_camera(camera=camera)
+            output = picamera.array.PiRGBArray(camera)
+            with CAPTURE_TIME.time(kind='array'):
+                camera.capture(output, 'rgb')
+            self.__update_settings(camera)
+        return output.array
+                        
+    def capture_stacked(self, filename, count=8, mode='mean', sigma=stacker.SIGMA,
+                        use_video_port=False):
+        """Capture count frames with the current settings, stack them and
+        save the result to the specified filename, which can also be a file
+        like object. If filename is None, the PIL image is returned instead.
+        Frames are stacked as they arrive, see stacker.py for the modes.
+        Stacking count frames at the (6 sec max) shutter speed gives a
+        synthetic exposure count times as long.
         """
-        # capture then open in PIL image
-        hname = 'hist_' + time.strftime("%H%M%S", time.localtime()) + '.jpg'
-        self.capture(hname)
-        im_in   = Image.open(hname)
-        im_out  = Image.new('RGBA', im_in.size)
-        im_out.paste(im_in)
+        rgb = self.__capture_stack(count, mode, sigma, use_video_port)
+        encode_start = time.time()
+        image = Image.fromarray(rgb)
+        if filename == None:
+            ENCODE_TIME.observe(time.time() - encode_start, kind='stack')
+            return image
+        image.save(filename, 'JPEG', quality=self.settings['quality'])
+        ENCODE_TIME.observe(time.time() - encode_start, kind='stack')
+
+    def __capture_stack(self, count, mode, sigma, use_video_port=False):
+        """Capture count frames and return them stacked, as a numpy RGB
+        array. Raises ValueError, before capturing, for a bad count or mode."""
+        stack = stacker.Stacker(mode, sigma)
+        if count < 1 or (mode == 'sigma' and count > stacker.MAX_SIGMA_FRAMES):
+            raise ValueError("can't stack {0} frames in {1} mode".format(count, mode))
+        with self.__session(self.settings['sensor_mode']) as camera:
+            camera = self.__update_camera(camera=camera,
+                                          use_video_port=use_video_port)
+            output = picamera.array.PiRGBArray(camera)
+            frames = camera.capture_continuous(output, 'rgb',
+                                               use_video_port=use_video_port)
+            try:
+                capture_start = time.time()
+                for foo in frames:
+                    CAPTURE_TIME.observe(time.time() - capture_start, kind='stack')
+                    stack.add(output.array)
+                    output.truncate(0)
+                    if stack.count >= count:
+                        break
+                    capture_start = time.time()
+            finally:
+                frames.close()
+            self.__update_settings(camera)
+        return stack.result()
+                        
+    def capture_with_histogram(self, filename, fill=False, size=None, stack=1,
+                               stack_mode='mean'):
+        """Capture an image with histogram overlay and save to specified file,
+        which can also be a file like object. If filename is None, the PIL
+        image is returned instead. If fill=True, the area under the histogram
+        curves will be filled. If size=(width,height) is supplied, the overlay
+        is rendered at that size instead of full resolution. If stack is more
+        than 1, that many frames are stacked in stack_mode for the image.
+        """
+        # capture to memory, histogram is computed on the full image
+        if stack > 1:
+            rgb = self.__capture_stack(stack, stack_mode, stacker.SIGMA)
+        else:
+            rgb = self.capture_array()
+        render_start = time.time()
+        hist = np.bincount((rgb.reshape(-1,3) +
+                            np.array((0,256,512), dtype=np.uint16)).ravel(),
+                           minlength=768).reshape(3,256)
+        im_out = Image.fromarray(rgb)
+        if not size == None:
+            im_out = im_out.resize(size, Image.BILINEAR)
         width, height = im_out.size
-        draw = ImageDraw.Draw(im_out)
+        draw = ImageDraw.Draw(im_out, 'RGBA')
 
         # add rule of thirds lines
         x1 = width/3
@@ -169,20 +730,12 @@ class Campi():
         draw.line([(0,y1),(width,y1)], width=3)
         draw.line([(0,y2),(width,y2)], width=3)
         
-        # compute histogram, scaled for image size
-        hist = im_in.histogram()
-        rh = hist[0:256]
-        gh = hist[256:512]
-        bh = hist[512:768]
-        xs = float(width)/float(256)
-        ys = float(height)/float(max(hist))
-        rl=[]
-        gl=[]
-        bl=[]
-        for i in xrange(256):
-            rl.append((int(i*xs),height-int(rh[i]*ys)))
-            gl.append((int(i*xs),height-int(gh[i]*ys)))
-            bl.append((int(i*xs),height-int(bh[i]*ys)))        
+        # compute histogram curves, scaled for image size
+        xs = (np.arange(256) * width / 256).tolist()
+        ys = (height - hist * height / hist.max()).tolist()
+        rl = zip(xs, ys[0])
+        gl = zip(xs, ys[1])
+        bl = zip(xs, ys[2])
         
         # draw it
         lw = int((0.01*max(im_out.size)))
@@ -197,8 +750,8 @@ class Campi():
         draw.line(gl, fill='green', width=lw)
         draw.line(bl, fill='blue', width=lw)
         
-        # add image info
-        font = ImageFont.truetype("5Identification-Mono.ttf",72)
+        # add image info, font scaled for image size (72pt at 1920 wide)
+        font = get_font(max(12, 72 * width / 1920))
         fw,fh = font.getsize(" ")
         lines = []
         lines.append("EXP MODE %s" % self.settings['exposure_mode'])
@@ -213,9 +766,12 @@ class Campi():
             draw.text((10,10+N*fh), line, font=font)
             N += 1
 
-        # save it and clean up
-        im_out.save(filename, quality=95)
-        os.remove(hname)
+        # save it
+        if filename == None:
+            ENCODE_TIME.observe(time.time() - render_start, kind='histogram')
+            return im_out
+        im_out.save(filename, 'JPEG', quality=95)
+        ENCODE_TIME.observe(time.time() - render_start, kind='histogram')
         
     def set_cam_config(self, setting=None, value=None):
         """Set the specified camera setting to the supplied value."""
@@ -267,10 +823,47 @@ class Campi():
             # auto mode, so just set it
             self.settings['framerate'] = value 
             
+    def __session(self, sensor_mode=None, priority=PRIORITY_CAPTURE,
+                  exclusive=False, use_video_port=False):
+        """Return a broker session that opens the camera, if needed, with the
+        current resolution and framerate."""
+        return self._broker.session(sensor_mode, priority, exclusive,
+                                    self.__camera_init(use_video_port))
+    
+    def __camera_init(self, use_video_port=False):
+        """Return the properties to open the camera with."""
+        values = self.__camera_values(use_video_port)
+        return dict((k, values[k]) for k in RECONFIGURE_PROPERTIES)
+    
+    def __camera_values(self, use_video_port=False):
+        """Return dictionary of camera property values for the current
+        settings. Basically a mapping of this class's member variables to the
+        ones used by the picamera module."""
+        values = {
+            'framerate'     : self.settings['framerate'],
+            'resolution'    : self.settings['resolution'],
+            'exposure_mode' : self.settings['exposure_mode'],
+            'iso'           : self.settings['iso'],
+            'awb_mode'      : self.settings['awb_mode'],
+            'shutter_speed' : self.settings['shutter_speed'],
+            'brightness'    : self.settings['brightness'],
+            'contrast'      : self.settings['contrast'],
+            'sharpness'     : self.settings['sharpness'],
+            'saturation'    : self.settings['saturation'],
+            'hflip'         : self.settings['hvflip'][0],
+            'vflip'         : self.settings['hvflip'][1],
+        }
+        if use_video_port:
+            values['framerate'] = Fraction(30,1)
+            values['exposure_mode'] = 'auto'
+        return values
+    
     def __update_camera(self, camera=None, use_video_port=False):
         """Update the Raspberry Pi Camera Module with the current settings.
-        Basically a mapping of this class's member variables to the ones used
-        by the picamera module.
+        Only the properties that differ from what the camera already has are
+        set, in CAMERA_PROPERTIES order. Properties that reconfigure the
+        camera ports are set together, first, and are passed to the camera
+        constructor when it is opened, so they are usually free.
         """
         if not isinstance(camera, PiCamera):
             return
@@ -284,23 +877,37 @@ class Campi():
         camera.sensor_mode = self.settings['sensor_mode']
         """
         #---
-        camera.framerate = self.settings['framerate']             # set this before shutter_speed
-        camera.exposure_mode = self.settings['exposure_mode']     # set this before shutter_speed
-        camera.resolution = self.settings['resolution']
-        camera.iso =  self.settings['iso']
-        camera.awb_mode = self.settings['awb_mode']
-        camera.shutter_speed = self.settings['shutter_speed']
-        camera.brightness = self.settings['brightness']
-        camera.constrast = self.settings['contrast']
-        camera.sharpness = self.settings['sharpness']
-        camera.saturation = self.settings['saturation']
-        camera.hflip = self.settings['hvflip'][0]
-        camera.vflip = self.settings['hvflip'][1]
-        if use_video_port:
-            camera.framerate = Fraction(30,1)
-            camera.exposure_mode = 'auto'
+        values = self.__camera_values(use_video_port)
+        with self._apply_lock:
+            applied = self._broker.applied
+            changed = set(p for p in CAMERA_PROPERTIES
+                            if p not in applied or applied[p] != values[p])
+            for p in list(changed):
+                changed.update(DEPENDENT_PROPERTIES.get(p, []))
+            if camera.recording:
+                # can not reconfigure while the broker has a recording
+                # running, so leave these be
+                changed.difference_update(RECONFIGURE_PROPERTIES)
+            for p in CAMERA_PROPERTIES:
+                if p in changed:
+                    self.__set_camera(camera, p, values[p])
         return camera
     
+    def __set_camera(self, camera, prop, value):
+        """Set a camera property, keeping track of the value and how long it
+        took to set."""
+        start = time.time()
+        setattr(camera, prop, value)
+        elapsed = time.time() - start
+        SETTING_APPLY_TIME.observe(elapsed, property=prop)
+        self._broker.applied[prop] = value
+        times = self.apply_times.setdefault(prop, {'count':0, 'total':0.0,
+                                                   'last':0.0, 'max':0.0})
+        times['count'] += 1
+        times['total'] += elapsed
+        times['last'] = elapsed
+        times['max'] = max(times['max'], elapsed)
+    
     def __update_settings(self, camera=None):
         """Update dictionary of settings with actual values from supplied
         camera object."""
@@ -325,64 +932,87 @@ class Campi():
     #---------------------------------------------------------------
     def LCD_LED_On(self):
         """Enable power to LCD display."""
-        self._gpio.output(LCD_LED, GPIO.HIGH)
+        if self.headless:
+            return
+        self.__get_gpio().output(LCD_LED, GPIO.HIGH)
         
     def LCD_LED_Off(self):
         """Disable power to LCD display."""
-        self._gpio.output(LCD_LED, GPIO.LOW)
+        if self.headless:
+            return
+        self.__get_gpio().output(LCD_LED, GPIO.LOW)
         
     def disp_clear(self):
         """Clear the display."""
-        self._disp.clear()
-        self._disp.display()
+        self.disp_image(self.__new_lcd_image())
     
     def disp_image(self, image):
-        """Display the supplied image."""
-        self._disp.image(image)
-        self._disp.display()
+        """Display the supplied image. This returns immediately, the image is
+        sent to the display by the display thread."""
+        disp_thread = self.__get_display()
+        if not disp_thread == None:
+            disp_thread.submit(image)
+        
+    def disp_flush(self, timeout=1.0):
+        """Wait for pending display updates to finish."""
+        if not self._disp_thread == None:
+            self._disp_thread.flush(timeout)
         
     def get_lcd_size(self):
         """Return the width and height of the LCD screen as a tuple."""
         return (LCD.LCDWIDTH, LCD.LCDHEIGHT)
     
-    def disp_msg(self, msg, font=FONT_SMALL):
+    def disp_msg(self, msg, font=None):
         """Display the supplied message on the screen. An optional
         font can be supplied.
         """
+        if self.headless:
+            return
+        if font == None:
+            font = get_font(FONT_SMALL)
         fw,fh = font.getsize(" ")    # font width and height
         cx = LCD.LCDWIDTH / fw       # max characters per line
         cy = LCD.LCDHEIGHT / fh      # max number of lines
 
         lines = [ msg[i:i+cx] for i in range(0, len(msg), cx) ]
         
-        LCD_DRAW.rectangle(WHOLE_SCREEN, outline=255, fill=255)
+        image = self.__new_lcd_image()
+        draw = ImageDraw.Draw(image)
         y = 0
         for line in lines:
-            LCD_DRAW.text((0,y), line, font=FONT_SMALL)
+            draw.text((0,y), line, font=font)
             y += fh
-        self.disp_image(LCD_IMAGE)
+        self.disp_image(image)
         
     def disp_big_msg(self, msg, location=BIG_MSG):
         """Display the supplied message on the screen using large text.
         An optional location can be specified.
         """
-        LCD_DRAW.rectangle(WHOLE_SCREEN, outline=255, fill=255)
-        LCD_DRAW.text(location, msg, font=FONT_LARGE)
-        self.disp_image(LCD_IMAGE)
+        if self.headless:
+            return
+        image = self.__new_lcd_image()
+        draw = ImageDraw.Draw(image)
+        draw.text(location, msg, font=get_font(FONT_LARGE))
+        self.disp_image(image)
+        
+    def __new_lcd_image(self, ):
+        """Return a new blank image for drawing to the LCD display."""
+        return Image.new('1', (LCD.LCDWIDTH, LCD.LCDHEIGHT), 255)
                
     #---------------------------------------------------------------
     #                  B  U  T  T  O  N  S
     #---------------------------------------------------------------
     def __get_raw_button(self, btn=None):
         """Return the state of all buttons or specified button."""
+        gpio = self.__get_gpio()
         if (btn==None):
-            return (self._gpio.input(BTN_UP),
-                    self._gpio.input(BTN_DOWN),
-                    self._gpio.input(BTN_LEFT),
-                    self._gpio.input(BTN_RIGHT),
-                    self._gpio.input(BTN_SEL))     
+            return (gpio.input(BTN_UP),
+                    gpio.input(BTN_DOWN),
+                    gpio.input(BTN_LEFT),
+                    gpio.input(BTN_RIGHT),
+                    gpio.input(BTN_SEL))     
         elif (btn in BUTTONS):
-            return self._gpio.input(btn)
+            return gpio.input(btn)
         else:
             return None
             
@@ -402,6 +1032,100 @@ class Campi():
         for B in BUTTONS:
             state[B] = self.is_pressed(B)
         return state
+    
+    def add_button_callback(self, callback):
+        """Register a function to be called with each ButtonEvent. Callbacks
+        are called from the GPIO event thread, so should return quickly."""
+        self.__get_gpio()
+        with self._btn_lock:
+            self._btn_callbacks.append(callback)
+            
+    def remove_button_callback(self, callback):
+        """Unregister a button callback."""
+        with self._btn_lock:
+            if callback in self._btn_callbacks:
+                self._btn_callbacks.remove(callback)
+    
+    def get_button_event(self, timeout=None):
+        """Return the next ButtonEvent, waiting up to timeout secs (forever if
+        None). Returns None if there was no event."""
+        self.__get_gpio()
+        try:
+            event = self._btn_events.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+        self.__record_latency(event)
+        return event
+    
+    def clear_button_events(self, ):
+        """Discard any queued button events."""
+        while not self._btn_events.empty():
+            self._btn_events.get_nowait()
+        
+    def get_button_stats(self, ):
+        """Return press-to-handler latency stats in secs."""
+        with self._btn_lock:
+            count = self._btn_latency['count']
+            return {
+                'count' : count,
+                'mean'  : self._btn_latency['total'] / count if count else 0,
+                'max'   : self._btn_latency['max'],
+            }
+    
+    def __button_edge(self, btn):
+        """GPIO callback for button edges. Does software debounce and
+        generates press and release events."""
+        now = time.time()
+        pressed = self.is_pressed(btn)
+        with self._btn_lock:
+            if pressed == self._btn_state[btn]:
+                return
+            if now - self._btn_edge_time[btn] < BTN_DEBOUNCE:
+                return
+            self._btn_state[btn] = pressed
+            self._btn_edge_time[btn] = now
+        if pressed:
+            self.__button_event(ButtonEvent(btn, BTN_PRESS, now))
+            self.__start_hold_timer(btn, now, BTN_LONG_PRESS, BTN_LONG)
+        else:
+            self.__button_event(ButtonEvent(btn, BTN_RELEASE, now))
+        
+    def __start_hold_timer(self, btn, press_time, delay, kind):
+        timer = threading.Timer(delay, self.__button_held,
+                                [btn, press_time, kind])
+        timer.daemon = True
+        timer.start()
+        
+    def __button_held(self, btn, press_time, kind):
+        """Timer callback for long press and repeat. Only fires if the
+        button has been held since press_time."""
+        with self._btn_lock:
+            if self._btn_edge_time[btn] != press_time:
+                return
+            if not self.is_pressed(btn):
+                # missed the release edge
+                self._btn_state[btn] = False
+                return
+        self.__button_event(ButtonEvent(btn, kind, time.time()))
+        self.__start_hold_timer(btn, press_time, BTN_REPEAT, BTN_REPEATED)
+        
+    def __button_event(self, event):
+        """Dispatch event to callbacks, or queue it if there are none."""
+        with self._btn_lock:
+            callbacks = list(self._btn_callbacks)
+        if not callbacks:
+            self._btn_events.put(event)
+            return
+        for callback in callbacks:
+            callback(event)
+        self.__record_latency(event)
+            
+    def __record_latency(self, event):
+        latency = time.time() - event.time
+        with self._btn_lock:
+            self._btn_latency['count'] += 1
+            self._btn_latency['total'] += latency
+            self._btn_latency['max'] = max(self._btn_latency['max'], latency)
    
 #--------------------------------------------------------------------
 # M A I N 
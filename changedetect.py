@@ -0,0 +1,59 @@
+#===========================================================================
+# changedetect.py
+#
+# Change detection for skipping near identical timelapse frames.
+#
+# Each candidate frame is represented by a small luminance sample, which
+# is compared with the sample of the last kept frame. If the mean absolute
+# difference is below a threshold the frame is skipped, but at least one
+# frame in every max_skip+1 is kept so static scenes are thinned out
+# rather than dropped. Every decision is logged to a CSV sidecar file.
+#
+# 2016-09-10
+# Carter Nelson
+#===========================================================================
+import numpy as np
+
+DIFF_THRESHOLD = 2.0    # mean absolute luma difference, 0-255
+MAX_SKIP = 9            # max consecutive frames skipped
+
+class ChangeDetector(object):
+    """A class for deciding if a timelapse frame differs enough to keep."""
+
+    def __init__(self, threshold=DIFF_THRESHOLD, max_skip=MAX_SKIP, logfile=None):
+        self.threshold = threshold
+        self.max_skip = max_skip
+        self.reference = None
+        self.skipped = 0
+        self.total_skipped = 0
+        self._log = None
+        if not logfile == None:
+            self._log = open(logfile, "w")
+            self._log.write("candidate,time,diff,kept\n")
+
+    def check(self, luma, candidate=None, timestamp=None):
+        """Return (keep, diff) for a frame with the supplied luma sample, a 2D
+        uint8 numpy array. The decision is logged if there is a log file."""
+        if self.reference is None:
+            diff = None
+            keep = True
+        else:
+            diff = float(np.abs(luma.astype(np.int16) - self.reference).mean())
+            keep = diff >= self.threshold or self.skipped >= self.max_skip
+        if keep:
+            self.reference = luma.astype(np.int16)
+            self.skipped = 0
+        else:
+            self.skipped += 1
+            self.total_skipped += 1
+        if not self._log == None:
+            self._log.write("{0},{1},{2},{3}\n".format(
+                candidate, timestamp, "" if diff == None else "%.3f" % diff,
+                int(keep)))
+        return keep, diff
+
+    def close(self, ):
+        """Close the log file."""
+        if not self._log == None:
+            self._log.close()
+            self._log = None
@@ -0,0 +1,113 @@
+#===========================================================================
+# clock.py
+#
+# Monotonic time and waiting, for schedules that must not be thrown off
+# when the system time is set. The Pi has no real time clock, so the time
+# is usually set by the browser (see AjaxSetDate) after the server starts,
+# and time.time() jumps.
+#
+#   * monotonic() = secs from an arbitrary start, from clock_gettime
+#                   CLOCK_MONOTONIC (Python 2 has no time.monotonic)
+#   * Waker       = like threading.Event, but wait() sleeps in the kernel
+#                   (select on a pipe) for the whole timeout. Event.wait
+#                   in Python 2 polls, and its timeout follows time.time()
+#   * wall_time() = the wall clock time of a monotonic time
+#
+# 2016-11-05
+# Carter Nelson
+#===========================================================================
+import os
+import time
+import errno
+import select
+import threading
+import ctypes
+import ctypes.util
+
+CLOCK_MONOTONIC = 1     # from <linux/time.h>
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _clock_gettime():
+    """Return libc clock_gettime(), or None if not available."""
+    for name in ("c", "rt"):
+        try:
+            lib = ctypes.CDLL(ctypes.util.find_library(name), use_errno=True)
+            func = lib.clock_gettime
+        except (OSError, AttributeError):
+            continue
+        func.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        return func
+    return None
+CLOCK_GETTIME = _clock_gettime()
+
+def monotonic():
+    """Return secs from an arbitrary start, not affected by setting the
+    system time. Falls back to time.time() if clock_gettime is missing."""
+    if CLOCK_GETTIME == None:
+        return time.time()
+    t = _timespec()
+    if not CLOCK_GETTIME(CLOCK_MONOTONIC, ctypes.byref(t)) == 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return t.tv_sec + t.tv_nsec * 1e-9
+
+def wall_time(mono):
+    """Return the wall clock time, as from time.time(), of a monotonic time,
+    with the system time as it is now."""
+    return mono + time.time() - monotonic()
+
+class Waker(object):
+    """An event to sleep on until a timeout or deadline, or until set()."""
+
+    def __init__(self, ):
+        self._read, self._write = os.pipe()
+        self._set = False
+        self._lock = threading.Lock()
+
+    def set(self, ):
+        """Wake up anyone waiting, and any later wait returns at once, until
+        clear() is called."""
+        with self._lock:
+            if not self._set and not self._write == None:
+                self._set = True
+                os.write(self._write, "x")
+
+    def clear(self, ):
+        with self._lock:
+            if self._set:
+                os.read(self._read, 1)
+                self._set = False
+
+    def is_set(self, ):
+        return self._set
+
+    def wait(self, timeout=None):
+        """Sleep until set or for timeout secs. Return True if set."""
+        if self._set or self._read == None:
+            return self._set
+        try:
+            select.select([self._read], [], [], timeout)
+        except select.error as e:
+            if not e.args[0] == errno.EINTR:
+                raise
+        return self._set
+
+    def wait_until(self, deadline):
+        """Sleep until set or until the monotonic deadline. Return True if
+        set."""
+        while not self._set:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            self.wait(remaining)
+        return self._set
+
+    def close(self, ):
+        """Release the pipe."""
+        with self._lock:
+            if not self._read == None:
+                os.close(self._read)
+                os.close(self._write)
+                self._read = self._write = None
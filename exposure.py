@@ -0,0 +1,148 @@
+#===========================================================================
+# exposure.py
+#
+# Exposure ramping for day to night (and night to day) timelapses.
+#
+# Each interval the scene is metered from a small luminance sample (see
+# Campi.capture_luma) taken at the current settings. The error from the
+# target brightness, in EV, is damped and limited to a max step per
+# interval, and the new exposure is split into shutter speed first, then
+# ISO. Settings go through Campi.set_cam_config, so the sensor mode and
+# framerate follow the shutter speed as usual. To keep the camera from
+# being reopened back and forth, the 1 sec sensor mode boundary is only
+# crossed once the exposure is well past it.
+#
+# 2016-10-15
+# Carter Nelson
+#===========================================================================
+import math
+
+import numpy as np
+
+TARGET_LUMA = 110           # target mean luma, 0-255
+CLIP_LUMA = 250             # highlights clip above this
+CLIP_PERCENTILE = 99        # percentile checked for clipping
+GAMMA = 2.2                 # luma is gamma encoded
+DEADBAND_EV = 1/6.0         # errors smaller than this are ignored
+MAX_STEP_EV = 1/3.0         # max change per interval
+DAMPING = 0.5               # fraction of the error corrected per interval
+EV_STEP = 1/6.0             # exposures are rounded to this, fewer changes
+MIN_SHUTTER = 100           # usecs
+MAX_SHUTTER = 6000000       # usecs, sensor max
+MODE_BOUNDARY = 1000000     # usecs, sensor mode 2/3 boundary
+HYSTERESIS_EV = 1/3.0       # past the boundary before switching mode
+ISO_STEPS = (100, 200, 320, 400, 500, 640, 800)
+
+def meter(luma):
+    """Return dictionary of luminance stats for a 2D uint8 luma sample."""
+    hist = np.bincount(luma.ravel(), minlength=256)
+    cdf = np.cumsum(hist)
+    total = cdf[-1]
+    def percentile(p):
+        return int(np.searchsorted(cdf, total * p / 100.0))
+    return {
+        'mean'  : float(np.dot(hist, np.arange(256))) / total,
+        'p05'   : percentile(5),
+        'p50'   : percentile(50),
+        'p99'   : percentile(CLIP_PERCENTILE),
+    }
+
+class ExposureRamp(object):
+    """A class for smoothly adjusting exposure to the scene brightness."""
+
+    def __init__(self, target=TARGET_LUMA, min_shutter=MIN_SHUTTER,
+                 max_shutter=MAX_SHUTTER, max_iso=ISO_STEPS[-1],
+                 max_step=MAX_STEP_EV, damping=DAMPING, logfile=None):
+        self.target = target
+        self.min_shutter = min_shutter
+        self.max_shutter = min(max_shutter, MAX_SHUTTER)
+        self.iso_steps = [iso for iso in ISO_STEPS if iso <= max_iso]
+        self.max_step = max_step
+        self.damping = damping
+        self.shutter_speed = None
+        self.iso = None
+        self.exposure = None        # shutter usecs * iso / 100
+        self.last_meter = None
+        self.last_error = None
+        self.changes = 0
+        self._log = None
+        if not logfile == None:
+            self._log = open(logfile, "w")
+            self._log.write("time,mean,p99,error_ev,shutter_speed,iso\n")
+
+    def start(self, camera, luma=None):
+        """Start from the camera's current exposure, e.g. what auto exposure
+        settled on. If a luma sample taken at that exposure is supplied, the
+        whole error is corrected at once, without damping or step limit."""
+        shutter = camera.settings['shutter_speed'] or \
+                  camera.settings.get('exposure_speed') or 10000
+        iso = camera.settings['iso'] or self.iso_steps[0]
+        self.exposure = shutter * iso / 100.0
+        if not luma is None:
+            stats = meter(luma)
+            self.exposure *= (self.target / max(1.0, stats['mean'])) ** GAMMA
+            self.exposure = max(self.min_shutter * self.iso_steps[0] / 100.0,
+                                min(self.max_shutter * self.iso_steps[-1] / 100.0,
+                                    self.exposure))
+        self.shutter_speed, self.iso = self.__split(self.exposure)
+
+    def update(self, luma, timestamp=None):
+        """Meter the luma sample and compute the next exposure. Return True
+        if the settings changed."""
+        stats = meter(luma)
+        self.last_meter = stats
+        error = GAMMA * math.log(self.target / max(1.0, stats['mean']), 2)
+        if error > 0 and stats['p99'] >= CLIP_LUMA:
+            # highlights already clipping, don't brighten further
+            error = 0
+        self.last_error = error
+        changed = False
+        if abs(error) >= DEADBAND_EV:
+            step = max(-self.max_step, min(self.max_step, error * self.damping))
+            exposure = self.exposure * 2 ** step
+            # the wanted exposure is kept even if the settings don't change,
+            # so it can work its way past the sensor mode hysteresis
+            self.exposure = max(self.min_shutter * self.iso_steps[0] / 100.0,
+                                min(self.max_shutter * self.iso_steps[-1] / 100.0,
+                                    exposure))
+            # round to EV_STEP
+            ev = round(math.log(self.exposure, 2) / EV_STEP) * EV_STEP
+            shutter, iso = self.__split(2 ** ev)
+            if not (shutter, iso) == (self.shutter_speed, self.iso):
+                self.shutter_speed, self.iso = shutter, iso
+                self.changes += 1
+                changed = True
+        if not self._log == None:
+            self._log.write("{0},{1:.1f},{2},{3:.3f},{4},{5}\n".format(
+                    timestamp, stats['mean'], stats['p99'], error,
+                    self.shutter_speed, self.iso))
+        return changed
+
+    def apply(self, camera):
+        """Set the camera to the current exposure."""
+        camera.set_cam_config('iso', self.iso)
+        camera.set_cam_config('shutter_speed', self.shutter_speed)
+
+    def close(self, ):
+        """Close the log file."""
+        if not self._log == None:
+            self._log.close()
+            self._log = None
+
+    def __split(self, exposure):
+        """Return (shutter, iso) for an exposure, lowest ISO that reaches
+        it within the shutter limit."""
+        for iso in self.iso_steps:
+            shutter = exposure * 100.0 / iso
+            if shutter <= self.max_shutter:
+                break
+        shutter = int(max(self.min_shutter, min(self.max_shutter, shutter)))
+        # sensor mode hysteresis
+        if not self.shutter_speed == None:
+            upper = MODE_BOUNDARY * 2 ** HYSTERESIS_EV
+            lower = MODE_BOUNDARY * 2 ** -HYSTERESIS_EV
+            if self.shutter_speed <= MODE_BOUNDARY < shutter < upper:
+                shutter = MODE_BOUNDARY
+            elif lower < shutter <= MODE_BOUNDARY < self.shutter_speed:
+                shutter = MODE_BOUNDARY + 1
+        return shutter, iso
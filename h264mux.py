@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+#===========================================================================
+# h264mux.py
+#
+# Muxes the camera's H.264 byte stream into fragmented MP4 for live view in
+# a browser (Media Source Extensions).
+#
+# The encoder writes an Annex B byte stream, NAL units separated by start
+# codes, in pieces of any size. NALReader splits it into NAL units,
+# AccessUnits groups those into frames, and FMP4Muxer wraps each frame in
+# its own fragment (moof + mdat), after an init segment (ftyp + moov) built
+# from the SPS and PPS. Nothing is decoded or re-encoded, it is all pure
+# Python, and it can be run on a recorded stream with no camera:
+#   python h264mux.py <recording.h264> <output.mp4> [fps]
+#
+# H264Broadcast is the file like output the camera records into. It muxes
+# each frame once and passes it to all subscribers, either as MP4 fragments
+# or as raw H.264 (Annex B). A new subscriber, or one that fell behind and
+# had frames dropped, gets the cached SPS/PPS (or init segment) and then
+# starts at the next key frame, which is requested from the encoder so it
+# does not have to wait for the next intra period.
+#
+# Frames are timestamped with the monotonic clock (see clock.py), so
+# setting the system time doesn't throw off the fragment times.
+#
+# Frames are only known to be complete when the first NAL unit of the next
+# one arrives, so the live stream is one frame behind the encoder.
+#
+# 2016-10-29
+# Carter Nelson
+#===========================================================================
+import sys
+import struct
+import threading
+
+import clock
+
+START_CODE      = "\x00\x00\x01"
+NAL_SLICE       = 1         # coded slice, non IDR
+NAL_IDR         = 5         # coded slice, IDR (key frame)
+NAL_SEI         = 6
+NAL_SPS         = 7
+NAL_PPS         = 8
+NAL_AUD         = 9         # access unit delimiter
+TIMESCALE       = 90000     # MP4 time units per sec
+TRACK_ID        = 1
+KEY_FLAGS       = 0x02000000    # sample depends on no other
+NON_KEY_FLAGS   = 0x01010000    # depends on others, not a sync sample
+MATRIX          = struct.pack(">9I", 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+# profiles whose SPS has chroma format and bit depth fields
+HIGH_PROFILES   = (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135)
+
+def nal_type(nal):
+    """Return the type of a NAL unit."""
+    return ord(nal[0]) & 0x1f
+
+def unescape(data):
+    """Return data with the emulation prevention bytes removed."""
+    return data.replace("\x00\x00\x03", "\x00\x00")
+
+class BitReader(object):
+    """Reads bits and Exp-Golomb codes, most significant bit first."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def bits(self, n):
+        value = 0
+        for i in xrange(n):
+            byte = ord(self.data[self.pos >> 3])
+            value = (value << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+    def ue(self):
+        zeros = 0
+        while self.bits(1) == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        value = self.ue()
+        if value & 1:
+            return (value + 1) // 2
+        return -(value // 2)
+
+def parse_sps(nal):
+    """Return dictionary of what the muxer needs from a SPS NAL unit:
+    profile, constraints, level, chroma format, bit depths, and the frame
+    size after cropping."""
+    r = BitReader(unescape(nal[1:]))
+    sps = {'profile'        : r.bits(8),
+           'constraints'    : r.bits(8),
+           'level'          : r.bits(8),
+           'chroma_format'  : 1,
+           'bit_depth_luma' : 8,
+           'bit_depth_chroma' : 8}
+    r.ue()                                  # seq_parameter_set_id
+    if sps['profile'] in HIGH_PROFILES:
+        sps['chroma_format'] = r.ue()
+        if sps['chroma_format'] == 3:
+            r.bits(1)                       # separate_colour_plane_flag
+        sps['bit_depth_luma'] = r.ue() + 8
+        sps['bit_depth_chroma'] = r.ue() + 8
+        r.bits(1)                           # qpprime_y_zero_transform_bypass_flag
+        if r.bits(1):                       # seq_scaling_matrix_present_flag
+            for i in xrange(8 if sps['chroma_format'] != 3 else 12):
+                if r.bits(1):
+                    size = 16 if i < 6 else 64
+                    last = scale = 8
+                    for j in xrange(size):
+                        if not scale == 0:
+                            scale = (last + r.se()) % 256
+                        last = scale if not scale == 0 else last
+    r.ue()                                  # log2_max_frame_num_minus4
+    poc_type = r.ue()
+    if poc_type == 0:
+        r.ue()                              # log2_max_pic_order_cnt_lsb_minus4
+    elif poc_type == 1:
+        r.bits(1)
+        r.se()
+        r.se()
+        for i in xrange(r.ue()):
+            r.se()
+    r.ue()                                  # max_num_ref_frames
+    r.bits(1)                               # gaps_in_frame_num_allowed_flag
+    width_mbs = r.ue() + 1
+    height_units = r.ue() + 1
+    frame_mbs_only = r.bits(1)
+    if not frame_mbs_only:
+        r.bits(1)                           # mb_adaptive_frame_field_flag
+    r.bits(1)                               # direct_8x8_inference_flag
+    crop = (0, 0, 0, 0)
+    if r.bits(1):
+        crop = (r.ue(), r.ue(), r.ue(), r.ue())
+    sub_width, sub_height = {0:(1, 1), 1:(2, 2), 2:(2, 1), 3:(1, 1)}[sps['chroma_format']]
+    if sps['chroma_format'] == 0:
+        sub_width = sub_height = 1
+    sub_height *= 2 - frame_mbs_only
+    sps['width'] = width_mbs * 16 - sub_width * (crop[0] + crop[1])
+    sps['height'] = (2 - frame_mbs_only) * height_units * 16 - \
+                    sub_height * (crop[2] + crop[3])
+    return sps
+
+class NALReader(object):
+    """Splits an Annex B byte stream, fed in pieces of any size, into NAL
+    units. Anything before the first start code is skipped."""
+
+    def __init__(self, ):
+        self._buf = ""
+        self._synced = False
+
+    def feed(self, data):
+        """Return list of the NAL units completed by data."""
+        # a start code may straddle the pieces, search back a little
+        resume = max(0, len(self._buf) - 2)
+        buf = self._buf + data
+        nals = []
+        if not self._synced:
+            first = buf.find(START_CODE)
+            if first < 0:
+                self._buf = buf[-2:]
+                return nals
+            buf = buf[first:]
+            resume = 0
+            self._synced = True
+        pos = len(START_CODE)
+        while True:
+            next = buf.find(START_CODE, max(pos, resume))
+            if next < 0:
+                break
+            self.__append(nals, buf[pos:next])
+            pos = next + len(START_CODE)
+        self._buf = buf[pos - len(START_CODE):]
+        return nals
+
+    def flush(self, ):
+        """Return list with the last NAL unit, which has no start code after
+        it, e.g. at the end of a file."""
+        nals = []
+        if self._synced:
+            self.__append(nals, self._buf[len(START_CODE):])
+        self._buf = ""
+        self._synced = False
+        return nals
+
+    def __append(self, nals, nal):
+        # zero bytes at the end belong to the next (4 byte) start code
+        nal = nal.rstrip("\x00")
+        if nal:
+            nals.append(nal)
+
+class AccessUnits(object):
+    """Groups NAL units into access units, i.e. frames."""
+
+    def __init__(self, ):
+        self._nals = []
+        self._slices = False
+
+    def add(self, nal):
+        """Add a NAL unit. Return the previous access unit, as a list of NAL
+        units, if this one starts a new one, else None."""
+        kind = nal_type(nal)
+        done = None
+        if self._slices and self.__starts_unit(nal, kind):
+            done = self._nals
+            self._nals = []
+            self._slices = False
+        self._nals.append(nal)
+        if kind in (NAL_SLICE, NAL_IDR):
+            self._slices = True
+        return done
+
+    def flush(self, ):
+        """Return the last access unit, None if there is none."""
+        done = self._nals if self._slices else None
+        self._nals = []
+        self._slices = False
+        return done
+
+    def __starts_unit(self, nal, kind):
+        if kind in (NAL_AUD, NAL_SEI, NAL_SPS, NAL_PPS) or 14 <= kind <= 18:
+            return True
+        if kind in (NAL_SLICE, NAL_IDR):
+            # first_mb_in_slice is 0, its ue(v) code is a single 1 bit
+            return len(nal) > 1 and ord(nal[1]) & 0x80
+        return False
+
+def is_key(unit):
+    """Return True if the access unit is a key frame."""
+    return any(nal_type(nal) == NAL_IDR for nal in unit)
+
+def box(kind, *payload):
+    """Return an MP4 box."""
+    data = "".join(payload)
+    return struct.pack(">I4s", 8 + len(data), kind) + data
+
+def full_box(kind, version, flags, *payload):
+    """Return an MP4 full box."""
+    return box(kind, struct.pack(">I", (version << 24) | flags), *payload)
+
+class FMP4Muxer(object):
+    """Builds fragmented MP4, one fragment per frame."""
+
+    def __init__(self, sps, pps, framerate=30):
+        self.sps = sps
+        self.pps = pps
+        self.info = parse_sps(sps)
+        self.default_duration = int(round(TIMESCALE / float(framerate)))
+        self.sequence = 0
+        self._base = None
+        self._last = None
+        self._duration = self.default_duration
+
+    def codec(self, ):
+        """Return the RFC 6381 codecs string, for MediaSource."""
+        return "avc1.{0:02x}{1:02x}{2:02x}".format(self.info['profile'],
+                                                   self.info['constraints'],
+                                                   self.info['level'])
+
+    def init_segment(self, ):
+        """Return the init segment, ftyp and moov."""
+        width, height = self.info['width'], self.info['height']
+        ftyp = box("ftyp", "iso5", struct.pack(">I", 512), "iso5", "iso6", "mp41")
+        mvhd = full_box("mvhd", 0, 0,
+                        struct.pack(">IIII", 0, 0, TIMESCALE, 0),
+                        struct.pack(">IH", 0x10000, 0x100), "\0" * 10,
+                        MATRIX, "\0" * 24,
+                        struct.pack(">I", TRACK_ID + 1))
+        tkhd = full_box("tkhd", 0, 3,
+                        struct.pack(">IIIII", 0, 0, TRACK_ID, 0, 0), "\0" * 8,
+                        struct.pack(">HHHH", 0, 0, 0, 0),
+                        MATRIX,
+                        struct.pack(">II", width << 16, height << 16))
+        mdhd = full_box("mdhd", 0, 0,
+                        struct.pack(">IIIIHH", 0, 0, TIMESCALE, 0, 0x55c4, 0))
+        hdlr = full_box("hdlr", 0, 0,
+                        struct.pack(">I4s", 0, "vide"), "\0" * 12, "VideoHandler\0")
+        vmhd = full_box("vmhd", 0, 1, "\0" * 8)
+        dinf = box("dinf", full_box("dref", 0, 0, struct.pack(">I", 1),
+                                    full_box("url ", 0, 1)))
+        stbl = box("stbl",
+                   full_box("stsd", 0, 0, struct.pack(">I", 1), self.__avc1()),
+                   full_box("stts", 0, 0, struct.pack(">I", 0)),
+                   full_box("stsc", 0, 0, struct.pack(">I", 0)),
+                   full_box("stsz", 0, 0, struct.pack(">II", 0, 0)),
+                   full_box("stco", 0, 0, struct.pack(">I", 0)))
+        mdia = box("mdia", mdhd, hdlr, box("minf", vmhd, dinf, stbl))
+        mvex = box("mvex", full_box("trex", 0, 0,
+                                    struct.pack(">IIIII", TRACK_ID, 1, 0, 0, 0)))
+        moov = box("moov", mvhd, box("trak", tkhd, mdia), mvex)
+        return ftyp + moov
+
+    def fragment(self, unit, timestamp=None):
+        """Return a fragment, moof and mdat, for an access unit. timestamp
+        is in secs, from a clock that doesn't go back (clock.monotonic). If
+        None, frames are default_duration apart. Otherwise the frame's
+        duration is taken to be the last interval."""
+        if timestamp == None:
+            decode_time = 0 if self._last == None else self._last + self.default_duration
+        else:
+            if self._base == None:
+                self._base = timestamp
+            decode_time = int(round((timestamp - self._base) * TIMESCALE))
+        if not self._last == None and decode_time > self._last:
+            self._duration = decode_time - self._last
+        self._last = decode_time
+        data = "".join(struct.pack(">I", len(nal)) + nal for nal in unit
+                       if nal_type(nal) not in (NAL_AUD, NAL_SPS, NAL_PPS))
+        flags = KEY_FLAGS if is_key(unit) else NON_KEY_FLAGS
+        self.sequence += 1
+        moof = self.__moof(decode_time, len(data), flags, 0)
+        moof = self.__moof(decode_time, len(data), flags, len(moof) + 8)
+        return moof + box("mdat", data)
+
+    def __moof(self, decode_time, size, flags, data_offset):
+        trun = full_box("trun", 0, 0x000701,    # offset, duration, size, flags
+                        struct.pack(">IiIII", 1, data_offset,
+                                    self._duration, size, flags))
+        traf = box("traf",
+                   full_box("tfhd", 0, 0x020000,    # base is moof
+                            struct.pack(">I", TRACK_ID)),
+                   full_box("tfdt", 1, 0, struct.pack(">Q", decode_time)),
+                   trun)
+        return box("moof", full_box("mfhd", 0, 0, struct.pack(">I", self.sequence)),
+                   traf)
+
+    def __avc1(self, ):
+        info = self.info
+        avcc = struct.pack(">BBBBBBH", 1, info['profile'], info['constraints'],
+                           info['level'], 0xff, 0xe1, len(self.sps)) + self.sps + \
+               struct.pack(">BH", 1, len(self.pps)) + self.pps
+        if info['profile'] in HIGH_PROFILES:
+            avcc += struct.pack(">BBBB", 0xfc | info['chroma_format'],
+                                0xf8 | (info['bit_depth_luma'] - 8),
+                                0xf8 | (info['bit_depth_chroma'] - 8), 0)
+        return box("avc1", "\0" * 6, struct.pack(">H", 1), "\0" * 16,
+                   struct.pack(">HHII", info['width'], info['height'],
+                               0x480000, 0x480000),
+                   "\0" * 4, struct.pack(">H", 1), "\0" * 32,
+                   struct.pack(">Hh", 0x18, -1),
+                   box("avcC", avcc))
+
+class H264Broadcast(object):
+    """File like output for the H.264 encoder, muxed once per frame and
+    passed to all subscribers. request_key_frame() is called when a
+    subscriber needs a key frame to start from."""
+
+    def __init__(self, framerate=30, request_key_frame=None):
+        self.framerate = framerate
+        self.request_key_frame = request_key_frame
+        self.sps = None
+        self.pps = None
+        self.muxer = None
+        self.frames = 0
+        self.key_frames = 0
+        self._reader = NALReader()
+        self._units = AccessUnits()
+        self._subscribers = {}
+        self._tokens = 0
+        self._lock = threading.Lock()
+
+    def write(self, buf):
+        for nal in self._reader.feed(buf):
+            # the unit this completes belongs to the headers before this NAL
+            unit = self._units.add(nal)
+            if not unit == None:
+                self.__publish(unit, clock.monotonic())
+            kind = nal_type(nal)
+            if kind == NAL_SPS and not nal == self.sps:
+                self.sps = nal
+                self.muxer = None
+            elif kind == NAL_PPS and not nal == self.pps:
+                self.pps = nal
+                self.muxer = None
+        return len(buf)
+
+    def flush(self, ):
+        pass
+
+    def subscribe(self, callback, format='mp4'):
+        """Add a subscriber. callback(data, key) is called, on the encoder's
+        thread, with each message: the init segment (mp4) or SPS/PPS (h264)
+        then a frame, key is True for those that can be started from. Return
+        a token for resync() and unsubscribe()."""
+        if format not in ('mp4', 'h264'):
+            raise ValueError("format must be mp4 or h264")
+        with self._lock:
+            self._tokens += 1
+            self._subscribers[self._tokens] = {'callback' : callback,
+                                               'format'   : format,
+                                               'waiting'  : True,
+                                               'muxer'    : None}
+            token = self._tokens
+        self.__key_frame()
+        return token
+
+    def resync(self, token):
+        """Stop sending to a subscriber until the next key frame, e.g. after
+        it fell behind and had frames dropped."""
+        with self._lock:
+            if token in self._subscribers:
+                self._subscribers[token]['waiting'] = True
+        self.__key_frame()
+
+    def unsubscribe(self, token):
+        """Remove a subscriber."""
+        with self._lock:
+            self._subscribers.pop(token, None)
+
+    def codec(self, ):
+        """Return the codecs string, None until the SPS has been seen."""
+        if self.sps == None:
+            return None
+        return FMP4Muxer(self.sps, self.pps or "", self.framerate).codec()
+
+    def __key_frame(self, ):
+        if not self.request_key_frame == None:
+            self.request_key_frame()
+
+    def __publish(self, unit, timestamp):
+        key = is_key(unit)
+        self.frames += 1
+        if key:
+            self.key_frames += 1
+        if self.muxer == None:
+            if not key or self.sps == None or self.pps == None:
+                # nothing can be sent until there is a key frame and headers
+                return
+            self.muxer = FMP4Muxer(self.sps, self.pps, self.framerate)
+        # who to send to is decided, and waiting cleared, under the lock, so
+        # a resync() from another thread is not lost
+        sends = []
+        with self._lock:
+            for sub in self._subscribers.values():
+                if sub['waiting'] and not key:
+                    continue
+                sends.append((sub, sub['waiting']))
+                sub['waiting'] = False
+        fragment = None
+        annexb = None
+        for sub, waiting in sends:
+            if sub['format'] == 'mp4':
+                if fragment == None:
+                    fragment = self.muxer.fragment(unit, timestamp)
+                if not sub['muxer'] is self.muxer:
+                    # new subscriber, or new SPS/PPS, this is a key frame
+                    sub['callback'](self.muxer.init_segment(), True)
+                    sub['muxer'] = self.muxer
+                sub['callback'](fragment, key)
+            else:
+                if annexb == None:
+                    annexb = "".join(START_CODE + nal for nal in unit)
+                if waiting and not any(nal_type(n) == NAL_SPS for n in unit):
+                    sub['callback'](START_CODE + self.sps + START_CODE + self.pps +
+                                    annexb, True)
+                else:
+                    sub['callback'](annexb, key)
+        if fragment == None:
+            # keep the muxer's timeline going even with no mp4 subscribers
+            self.muxer.fragment(unit, timestamp)
+
+def mux_file(infile, outfile, framerate=30):
+    """Mux a recorded H.264 byte stream into a fragmented MP4 file. Frames
+    before the first key frame are skipped. Return the number of frames."""
+    reader = NALReader()
+    units = AccessUnits()
+    sps = pps = None
+    muxer = None
+    frames = 0
+    with open(infile, "rb") as fin, open(outfile, "wb") as fout:
+        while True:
+            data = fin.read(65536)
+            nals = reader.feed(data) if data else reader.flush()
+            done = []
+            for nal in nals:
+                if nal_type(nal) == NAL_SPS and sps == None:
+                    sps = nal
+                elif nal_type(nal) == NAL_PPS and pps == None:
+                    pps = nal
+                unit = units.add(nal)
+                if not unit == None:
+                    done.append(unit)
+            if not data:
+                unit = units.flush()
+                if not unit == None:
+                    done.append(unit)
+            for unit in done:
+                if muxer == None:
+                    if sps == None or pps == None or not is_key(unit):
+                        continue
+                    muxer = FMP4Muxer(sps, pps, framerate)
+                    fout.write(muxer.init_segment())
+                fout.write(muxer.fragment(unit))
+                frames += 1
+            if not data:
+                break
+    return frames
+
+#--------------------------------------------------------------------
+# M A I N
+#--------------------------------------------------------------------
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print "usage: python h264mux.py <recording.h264> <output.mp4> [fps]"
+        sys.exit(1)
+    fps = float(sys.argv[3]) if len(sys.argv) > 3 else 30
+    print "{0} frames".format(mux_file(sys.argv[1], sys.argv[2], fps))
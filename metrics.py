@@ -0,0 +1,235 @@
+#===========================================================================
+# metrics.py
+#
+# Counters and latency histograms for the hot paths.
+#
+# Metrics live in a process wide registry and are created on first use,
+# so any module can do:
+#
+#       metrics.histogram('campi_capture_seconds', 'Capture time').observe(t)
+#
+# The registry renders itself in the Prometheus text format (the /metrics
+# endpoint of camera_server) and can summarize what happened between two
+# snapshots (the timelapse _info.txt).
+#
+# 2016-09-17
+# Carter Nelson
+#===========================================================================
+import threading
+import contextlib
+import time
+
+# histogram bucket upper bounds, secs
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _label_key(labelnames, labels):
+    """Return label values as a tuple, in labelnames order."""
+    if not sorted(labels) == sorted(labelnames):
+        raise ValueError("expected labels {0}, got {1}".format(
+                                            list(labelnames), labels.keys()))
+    return tuple(str(labels[name]) for name in labelnames)
+
+def _format_labels(labelnames, key, extra=None):
+    """Return a Prometheus label set, {a="1",b="2"}, or '' if none."""
+    pairs = zip(labelnames, key)
+    if not extra == None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, value.replace('\\', '\\\\')
+                                                         .replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+class Counter(object):
+    """A monotonically increasing count, optionally split by labels."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the count."""
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Return the current count."""
+        with self._lock:
+            return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def snapshot(self, ):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self, ):
+        lines = []
+        for key, value in sorted(self.snapshot().iteritems()):
+            lines.append("{0}{1} {2}".format(self.name,
+                                             _format_labels(self.labelnames, key),
+                                             _format_value(value)))
+        return lines
+
+    def summarize(self, before):
+        lines = []
+        for key, value in sorted(self.snapshot().iteritems()):
+            value -= before.get(key, 0)
+            if value:
+                lines.append("{0}{1} = {2}".format(
+                                self.name, _format_labels(self.labelnames, key), value))
+        return lines
+
+class Histogram(object):
+    """Distribution of observed values, typically latencies in secs,
+    optionally split by labels."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """Record a value."""
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry == None:
+                entry = self._values[key] = {'count':0, 'sum':0.0, 'max':0.0,
+                                             'buckets':[0]*len(self.buckets)}
+            entry['count'] += 1
+            entry['sum'] += value
+            entry['max'] = max(entry['max'], value)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['buckets'][i] += 1
+                    break
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe how long the with block takes."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def snapshot(self, ):
+        with self._lock:
+            return dict((key, dict(entry, buckets=list(entry['buckets'])))
+                            for key, entry in self._values.iteritems())
+
+    def render(self, ):
+        lines = []
+        for key, entry in sorted(self.snapshot().iteritems()):
+            total = 0
+            for bound, count in zip(self.buckets, entry['buckets']):
+                total += count
+                lines.append("{0}_bucket{1} {2}".format(
+                        self.name,
+                        _format_labels(self.labelnames, key, ('le', _format_value(bound))),
+                        total))
+            labels = _format_labels(self.labelnames, key)
+            lines.append("{0}_sum{1} {2}".format(self.name, labels,
+                                                 _format_value(entry['sum'])))
+            lines.append("{0}_count{1} {2}".format(self.name, labels, entry['count']))
+        return lines
+
+    def summarize(self, before):
+        lines = []
+        for key, entry in sorted(self.snapshot().iteritems()):
+            old = before.get(key, {'count':0, 'sum':0.0,
+                                   'buckets':[0]*len(self.buckets)})
+            count = entry['count'] - old['count']
+            if count == 0:
+                continue
+            buckets = [a - b for a, b in zip(entry['buckets'], old['buckets'])]
+            lines.append("{0}{1} = count {2}, mean {3:.4f}, p95 <= {4}".format(
+                            self.name, _format_labels(self.labelnames, key),
+                            count, (entry['sum'] - old['sum']) / count,
+                            self.__quantile_bound(buckets, count, 0.95)))
+        return lines
+
+    def __quantile_bound(self, buckets, count, q):
+        """Return the upper bound of the bucket holding quantile q."""
+        total = 0
+        for bound, n in zip(self.buckets, buckets):
+            total += n
+            if total >= q * count:
+                return _format_value(bound)
+        return "+Inf"
+
+class Registry(object):
+    """A collection of metrics."""
+
+    def __init__(self, ):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help="", labelnames=()):
+        """Return the named counter, creating it if needed."""
+        return self.__get(Counter, name, help, labelnames)
+
+    def histogram(self, name, help="", labelnames=(), buckets=LATENCY_BUCKETS):
+        """Return the named histogram, creating it if needed."""
+        return self.__get(Histogram, name, help, labelnames, buckets)
+
+    def render(self, ):
+        """Return all metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, metric in sorted(self.__metrics()):
+            lines.append("# HELP {0} {1}".format(name, metric.help))
+            lines.append("# TYPE {0} {1}".format(name, metric.kind))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self, ):
+        """Return the current state of all metrics, for summarize()."""
+        return dict((name, metric.snapshot()) for name, metric in self.__metrics())
+
+    def summarize(self, before=None, prefix=""):
+        """Return list of human readable lines describing what changed since
+        the before snapshot, for metrics whose name starts with prefix."""
+        if before == None:
+            before = {}
+        lines = []
+        for name, metric in sorted(self.__metrics()):
+            if name.startswith(prefix):
+                lines.extend(metric.summarize(before.get(name, {})))
+        return lines
+
+    def __get(self, cls, name, help, labelnames, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric == None:
+                metric = self._metrics[name] = cls(name, help, labelnames, *args)
+            elif not isinstance(metric, cls):
+                raise ValueError("metric {0} is a {1}".format(name, metric.kind))
+            return metric
+
+    def __metrics(self, ):
+        with self._lock:
+            return self._metrics.items()
+
+# process wide registry
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+render = REGISTRY.render
+snapshot = REGISTRY.snapshot
+summarize = REGISTRY.summarize
@@ -3,76 +3,376 @@
 #
 # Runs a MJPG stream on provided port.
 #
+# The stream is offered in several quality tiers (resolution and JPEG
+# quality, see TIERS). Each tier is encoded once into a shared FrameBuffer,
+# fed by a camera recording on its own splitter port, started with the
+# supplied start_capture callback only while some client is using it. Each
+# client is served in its own thread and simply sends the most recent
+# frame from its tier's buffer, so any number of clients can view the
+# stream without fighting over the camera, and a slow client only drops
+# its own frames, it never holds up the camera or the other clients.
+#
+# The socket send buffer is kept small, so frames can not pile up in the
+# kernel and a slow link shows up as time spent sending. Each client's
+# throughput is measured, and its tier lowered when it spends most of its
+# time sending, and raised again when the next tier up is predicted to
+# fit. The client can cap its frame rate, or pin a tier, in the query
+# string:
+#   http://piaddress:8081/?fps=5
+#   http://piaddress:8081/?tier=low
+#
+# Frames sent and dropped (a newer frame arrived before the last one was
+# sent) are counted per tier, see metrics.py. Not per client, every
+# client that ever connected would add series for the life of the server.
+#
 # 2016-07-25
 # Carter Nelson
 #===========================================================================
 import threading
-import SimpleHTTPServer
+import BaseHTTPServer
 import SocketServer
-import io
+import socket
+import time
+import urlparse
+
+import metrics
+
+BOUNDARY = "picameramjpg"
+
+# Quality tiers, best first, as (name, resize, JPEG quality)
+TIERS = (('high',   (640,360),  85),
+         ('medium', (480,270),  60),
+         ('low',    (320,180),  40))
+SEND_BUFFER         = 32 * 1024     # socket send buffer, bytes
+SEND_TIMEOUT        = 10.0          # secs before a stalled client is dropped
+RATE_WINDOW         = 2.0           # secs of sending measured per tier decision
+LOWER_BUSY          = 0.85          # fraction of time sending to lower the tier
+RAISE_BUSY          = 0.5           # predicted fraction at the next tier to raise it
+RAISE_HOLD          = 4.0           # secs after lowering before raising again
+MAX_RAISE_HOLD      = 64.0          # hold doubles when a raise does not last
+AVERAGING           = 0.2           # weight of a new sample in running averages
+
+FRAMES_IN       = metrics.counter('mjpeg_frames_captured_total',
+                                  'MJPEG frames received from the camera', ['tier'])
+FRAMES_SENT     = metrics.counter('mjpeg_frames_sent_total',
+                                  'MJPEG frames sent, by tier', ['tier'])
+FRAMES_DROPPED  = metrics.counter('mjpeg_frames_dropped_total',
+                                  'MJPEG frames never sent, by tier', ['tier'])
+SEND_TIME       = metrics.histogram('mjpeg_frame_send_seconds',
+                                    'Time to send one MJPEG frame to a client')
+CONNECTIONS     = metrics.counter('mjpeg_connections_total',
+                                  'MJPEG client connections')
+TIER_CHANGES    = metrics.counter('mjpeg_tier_changes_total',
+                                  'MJPEG client tier changes, by new tier', ['tier'])
+
+class FrameBuffer(object):
+    """Holds the most recent MJPEG frame of a tier, shared by its clients."""
+
+    def __init__(self, name='', wake=None):
+        self.name = name
+        self.frame = None
+        self.count = 0
+        self.clients = 0
+        self.frame_bytes = None     # running average
+        self.interval = None        # running average secs between frames
+        self.condition = threading.Condition()
+        self._wake = wake
+        self._last_put = None
+        self._partial = []
+
+    def write(self, buf):
+        """File like interface, so the camera can record MJPEG directly into
+        the buffer. Frames are published when complete."""
+        self._partial.append(buf)
+        if buf.endswith('\xff\xd9'):
+            self.put(''.join(self._partial))
+            self._partial = []
+        return len(buf)
+
+    def flush(self, ):
+        pass
+
+    def put(self, jpeg):
+        """Store a new JPEG frame and wake up all waiting clients. The
+        multipart header is built here, once per frame, not per client."""
+        part = "--{0}\r\n".format(BOUNDARY) +\
+               "Content-Type: image/jpeg\r\n" +\
+               "Content-Length: {0}\r\n\r\n".format(len(jpeg)) +\
+               jpeg + "\r\n"
+        now = time.time()
+        with self.condition:
+            self.frame = part
+            self.count += 1
+            self.frame_bytes = self.__average(self.frame_bytes, len(part))
+            if not self._last_put == None:
+                self.interval = self.__average(self.interval, now - self._last_put)
+            self._last_put = now
+            self.condition.notify_all()
+        FRAMES_IN.inc(tier=self.name)
+
+    def get(self, last_count=0, timeout=1.0):
+        """Return (count, frame) for the newest frame. Waits up to timeout
+        for a frame newer than last_count."""
+        with self.condition:
+            if self.count == last_count:
+                self.condition.wait(timeout)
+            return self.count, self.frame
+
+    def fps(self, ):
+        """Return the measured frame rate, None if not known yet."""
+        if not self.interval:
+            return None
+        return 1.0 / self.interval
+
+    def reset(self, ):
+        """Forget the last frame, e.g. when its recording has stopped and it
+        would only get staler."""
+        with self.condition:
+            self.frame = None
+            self._last_put = None
+            self._partial = []
+
+    def add_client(self, ):
+        """Register a client."""
+        with self.condition:
+            self.clients += 1
+            self.condition.notify_all()
+        if not self._wake == None:
+            self._wake.set()
+
+    def remove_client(self, ):
+        """Unregister a client."""
+        with self.condition:
+            self.clients -= 1
+        if not self._wake == None:
+            self._wake.set()
+
+    def __average(self, average, value):
+        if average == None:
+            return float(value)
+        return average + AVERAGING * (value - average)
 
-keepStreaming = False
-camera = None
-resize = (640,360)
+class ClientRate(object):
+    """Measures how fast a client takes frames, and picks its tier. Tiers
+    are numbered best first, so raising the quality lowers the number."""
+
+    def __init__(self, tier=0, tiers=TIERS, fixed=False):
+        self.tier = tier
+        self.tiers = tiers
+        self.fixed = fixed
+        self.throughput = None      # bytes/sec while sending
+        self.busy = 0.0             # fraction of time spent sending
+        self._hold = RAISE_HOLD
+        self._hold_until = 0
+        self._raised = False
+        self._window_start = time.time()
+        self._bytes = 0
+        self._send_time = 0.0
+
+    def sent(self, size, elapsed):
+        """Record a frame of size bytes that took elapsed secs to send."""
+        self._bytes += size
+        self._send_time += elapsed
+
+    def update(self, buffers, fps):
+        """Return the tier the client should be on, sending fps frames per
+        sec. Decided once per RATE_WINDOW."""
+        now = time.time()
+        window = now - self._window_start
+        if window < RATE_WINDOW:
+            return self.tier
+        self.busy = self._send_time / window
+        if self._send_time > 0:
+            self.throughput = self._bytes / self._send_time
+        self._window_start = now
+        self._bytes = 0
+        self._send_time = 0.0
+        if self.fixed or self.throughput == None or not fps:
+            return self.tier
+        if self.busy > LOWER_BUSY and self.tier < len(self.tiers) - 1:
+            if self._raised:
+                # the last raise did not last, wait longer before the next
+                self._hold = min(MAX_RAISE_HOLD, self._hold * 2)
+            self._hold_until = now + self._hold
+            self._raised = False
+            self.tier += 1
+        elif self.tier > 0 and now >= self._hold_until:
+            if self._raised:
+                # the last raise lasted a window
+                self._raised = False
+                self._hold = RAISE_HOLD
+            frame_bytes = self.__frame_bytes(buffers, self.tier - 1)
+            if frame_bytes * fps / self.throughput < RAISE_BUSY:
+                self._raised = True
+                self.tier -= 1
+        return self.tier
+
+    def __frame_bytes(self, buffers, tier):
+        """Frame size of a tier. If it is not recording, scale the size of
+        the current tier by pixel count."""
+        if buffers[tier].frame_bytes:
+            return buffers[tier].frame_bytes
+        (w0, h0), (w1, h1) = self.tiers[self.tier][1], self.tiers[tier][1]
+        return (buffers[self.tier].frame_bytes or 0) * (w1 * h1) / float(w0 * h0)
+
+class MJPEGServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Threaded server, one thread per client."""
+    allow_reuse_address = True
+    daemon_threads = True
 
 class MJPEGThread(threading.Thread):
-    """Thread to server MJPEG stream."""
-    
+    """Thread to server MJPEG stream. A tier is recorded while it has
+    clients, by calling start_capture(frames, tier) and stop_capture(tier)."""
+
     def __init__(self, group=None, target=None, name=None, args=(), kwargs=None):
         threading.Thread.__init__(self, group=group, target=target, name=name)
-        
-        global camera, resize
-        camera = kwargs['camera']
-        resize = kwargs['resize']
+
+        self.start_capture = kwargs['start_capture']
+        self.stop_capture = kwargs['stop_capture']
         self.port = kwargs['port']
-        self.keepRunnning = False
+        self.tiers = kwargs.get('tiers', TIERS)
+        self.wake = threading.Event()
+        self.buffers = [FrameBuffer(tier[0], self.wake) for tier in self.tiers]
+        self.keepRunning = False
         self.streamRunning = False
+        self.started = threading.Event()
         self.server = None
-    
+        self._recording = set()
+
     def run(self, ):
         print "MJPEGThread starting"
-        self.server = SocketServer.TCPServer(("",self.port), MJPEGStreamHandler,
-            bind_and_activate=False)
-        self.server.allow_reuse_address = True
-        self.server.timeout = 0.1
-        self.server.server_bind()
-        self.server.server_activate()
+        self.server = MJPEGServer(("",self.port), MJPEGStreamHandler)
+        self.server.buffers = self.buffers
+        self.server.tiers = self.tiers
+        self.server.keepStreaming = True
+        server_thread = threading.Thread(target=self.server.serve_forever,
+                                         kwargs={'poll_interval':0.1})
+        server_thread.daemon = True
+        server_thread.start()
         self.keepRunning = True
-        self.streamRunning = True        
-        while self.keepRunning:   
-            self.server.handle_request()
+        self.streamRunning = True
+        self.started.set()
+        try:
+            while self.keepRunning:
+                self.wake.wait(0.25)
+                self.wake.clear()
+                self.__update_capture()
+        finally:
+            for tier in list(self._recording):
+                self.__stop_tier(tier)
         self.streamRunning = False
-        camera.close()
+        self.server.keepStreaming = False
+        self.server.shutdown()
         self.server.server_close()
         print "MJPEGThread done"
-            
+
+    def __update_capture(self, ):
+        """Record the tiers that have clients, and only those."""
+        for tier, frames in enumerate(self.buffers):
+            if frames.clients > 0 and tier not in self._recording:
+                self.start_capture(frames, tier)
+                self._recording.add(tier)
+            elif frames.clients <= 0 and tier in self._recording:
+                self.__stop_tier(tier)
+
+    def __stop_tier(self, tier):
+        self._recording.discard(tier)
+        try:
+            self.stop_capture(tier)
+        finally:
+            self.buffers[tier].reset()
+
     def stop(self, ):
-        global keepStreaming
-        keepStreaming = False
         self.keepRunning = False
-        
-class MJPEGStreamHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+        self.wake.set()
+
+class MJPEGStreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """Handler for MJPEG stream."""
-    
+
     def do_GET(self, ):
-        print "MJPEGStreamHandler GET"
-        global keepStreaming
-        keepStreaming = True
-        
-        stream = io.BytesIO()
-        
+        buffers = self.server.buffers
+        fps_cap, fixed_tier = self.__options()
+        CONNECTIONS.inc()
+
+        # a small send buffer, so a slow client can't queue up stale frames
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+        self.connection.settimeout(SEND_TIMEOUT)
         self.send_response(200)
-        self.send_header('Content-type','multipart/x-mixed-replace; boundary=--picameramjpg')
+        self.send_header('Content-type',
+                         'multipart/x-mixed-replace; boundary={0}'.format(BOUNDARY))
+        self.send_header('Cache-Control', 'no-cache')
         self.end_headers()
-        for frame in camera.capture_continuous(stream, 'jpeg',
-                                                    use_video_port = True,
-                                                    resize = resize):
-            if not keepStreaming:
-                break
-            self.wfile.write("--picameramjpg")
-            self.send_header('Content-type','image/jpeg')
-            self.send_header('Content-length',len(stream.getvalue()))
-            self.end_headers()
-            self.wfile.write(stream.getvalue())
-            stream.seek(0)
-            stream.truncate() 
\ No newline at end of file
+
+        rate = ClientRate(tier=fixed_tier or 0, tiers=self.server.tiers,
+                          fixed=not fixed_tier == None)
+        tier = rate.tier
+        pending = None
+        frames = buffers[tier]
+        frames.add_client()
+        try:
+            count = 0
+            last_send = 0
+            while self.server.keepStreaming:
+                if fps_cap:
+                    wait = last_send + 1.0 / fps_cap - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                if not pending == None and not buffers[pending].frame == None:
+                    # new tier is up, switch over
+                    frames.remove_client()
+                    tier, pending = pending, None
+                    frames = buffers[tier]
+                    count = 0
+                    TIER_CHANGES.inc(tier=frames.name)
+                new_count, frame = frames.get(count)
+                if new_count == count or frame == None:
+                    continue
+                if count > 0 and new_count - count > 1:
+                    FRAMES_DROPPED.inc(new_count - count - 1, tier=frames.name)
+                count = new_count
+                last_send = time.time()
+                self.connection.sendall(frame)
+                elapsed = time.time() - last_send
+                SEND_TIME.observe(elapsed)
+                FRAMES_SENT.inc(tier=frames.name)
+                rate.sent(len(frame), elapsed)
+                fps = frames.fps()
+                if fps_cap and fps:
+                    fps = min(fps, fps_cap)
+                wanted = rate.update(buffers, fps)
+                if not wanted == (tier if pending == None else pending):
+                    # keep sending this tier until the wanted one has a frame
+                    if not pending == None:
+                        buffers[pending].remove_client()
+                        pending = None
+                    if not wanted == tier:
+                        pending = wanted
+                        buffers[pending].add_client()
+        except socket.error:
+            # client went away, or stalled past SEND_TIMEOUT
+            pass
+        finally:
+            frames.remove_client()
+            if not pending == None:
+                buffers[pending].remove_client()
+
+    def __options(self, ):
+        """Return (fps cap, tier number) from the query string, None for
+        either if not given or not valid."""
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        fps_cap = None
+        fixed_tier = None
+        try:
+            fps_cap = float(query['fps'][0])
+            if not fps_cap > 0:
+                fps_cap = None
+        except (KeyError, ValueError):
+            pass
+        names = [t[0] for t in self.server.tiers]
+        if query.get('tier', [None])[0] in names:
+            fixed_tier = names.index(query['tier'][0])
+        return fps_cap, fixed_tier
+
+    def log_message(self, format, *args):
+        # quiet, one line per frame is too much
+        pass
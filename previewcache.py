@@ -0,0 +1,93 @@
+#===========================================================================
+# previewcache.py
+#
+# In memory cache of preview images.
+#
+# Each preview is encoded once at several sizes, so clients on a slow
+# link can download a smaller image. Entries are identified by a hash of
+# their content, which also serves as the ETag. The least recently used
+# previews are dropped when the cache gets too big.
+#
+# 2016-08-20
+# Carter Nelson
+#===========================================================================
+import threading
+import collections
+import hashlib
+import io
+import time
+
+import Image
+
+import metrics
+
+PREVIEW_SIZES = collections.OrderedDict([
+    ('thumb'    , (320, 180)),
+    ('screen'   , (960, 540)),
+    ('full'     , (1920, 1080)),
+])
+CACHE_MAX_BYTES = 8 * 1024 * 1024   # total size of all cached JPEGs
+JPEG_QUALITY = 85
+
+ENCODE_TIME = metrics.histogram('preview_encode_seconds',
+                                'Time to resize and encode a preview', ['size'])
+
+class PreviewCache(object):
+    """A class for caching preview images at several sizes."""
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, sizes=PREVIEW_SIZES):
+        self.max_bytes = max_bytes
+        self.sizes = sizes
+        self.total_bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, image):
+        """Encode the supplied PIL image at each size and add it to the cache.
+        Return the preview id."""
+        encoded = {}
+        for name, size in self.sizes.iteritems():
+            encode_start = time.time()
+            if image.size == size:
+                resized = image
+            else:
+                resized = image.resize(size, Image.ANTIALIAS)
+            stream = io.BytesIO()
+            resized.save(stream, 'JPEG', quality=JPEG_QUALITY)
+            encoded[name] = stream.getvalue()
+            ENCODE_TIME.observe(time.time() - encode_start, size=name)
+        preview_id = hashlib.sha1(encoded[self.sizes.keys()[-1]]).hexdigest()[:16]
+        entry = {}
+        for name, data in encoded.iteritems():
+            entry[name] = (data, '"{0}-{1}"'.format(preview_id, name))
+        with self._lock:
+            self.__remove(preview_id)
+            self._entries[preview_id] = entry
+            self.total_bytes += self.__entry_bytes(entry)
+            # always keep the newest
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                self.__remove(self._entries.keys()[0])
+        return preview_id
+
+    def get(self, preview_id, size):
+        """Return (data, etag) for the preview at the named size, or None if
+        it is not in the cache."""
+        with self._lock:
+            entry = self._entries.pop(preview_id, None)
+            if entry == None:
+                return None
+            self._entries[preview_id] = entry   # most recently used
+            return entry.get(size)
+
+    def urls(self, preview_id, prefix="/preview"):
+        """Return dictionary of URLs for each size of a preview."""
+        return dict((name, "{0}/{1}/{2}".format(prefix, preview_id, name))
+                        for name in self.sizes)
+
+    def __remove(self, preview_id):
+        entry = self._entries.pop(preview_id, None)
+        if not entry == None:
+            self.total_bytes -= self.__entry_bytes(entry)
+
+    def __entry_bytes(self, entry):
+        return sum(len(data) for data, etag in entry.itervalues())
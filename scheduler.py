@@ -0,0 +1,296 @@
+#===========================================================================
+# scheduler.py
+#
+# Runs timelapse jobs from a queue, unattended, one at a time.
+#
+# A job is a timelapse (delta_time, total_imgs, and the other timelapse
+# settings) with a schedule:
+#   * start  = wall clock time to start, default as soon as possible
+#   * window = daily window, ["HH:MM", "HH:MM"] local time, which may
+#              cross midnight, e.g. ["20:00", "06:00"] for every night.
+#              The job runs once in each window.
+#   * days   = how many windows to run, default until cancelled
+#   * until  = wall clock time to stop, and not start again after
+# A run stops when it has taken total_imgs frames, or at the end of its
+# window or at until. A windowed job without total_imgs takes frames for
+# the whole window.
+#
+# The scheduler sleeps until the next start, or end, deadline (see
+# clock.py), it does not poll. Start times are wall clock times, so they
+# are converted to monotonic deadlines each time the scheduler wakes, and
+# it must be woken with clock_changed() when the system time is set. How
+# late each run started is kept with the job.
+#
+# The timelapse itself is created by the runner supplied to the
+# scheduler, runner(job, start, end), which returns the started TimeLapser,
+# or None if the camera is busy with another timelapse. In that case the
+# job waits and notify() must be called when that timelapse finishes.
+# A job whose timelapse can't start (the runner raises) or ends with an
+# error is failed, and not run again.
+#
+# 2016-11-05
+# Carter Nelson
+#===========================================================================
+import time
+import threading
+import itertools
+
+import clock
+
+JOB_OPTIONS = ('delta_time', 'total_imgs', 'change_threshold', 'exposure_ramp',
+               'retain_frames')
+MAX_LATENESS_KEPT = 32      # start lateness of the last runs kept per job
+
+def parse_hhmm(text):
+    """Return minutes after midnight for "HH:MM"."""
+    try:
+        hours, minutes = [int(x) for x in text.split(":")]
+    except (AttributeError, ValueError):
+        raise ValueError("time must be HH:MM, not {0}".format(text))
+    if not (0 <= hours < 24 and 0 <= minutes < 60):
+        raise ValueError("time must be HH:MM, not {0}".format(text))
+    return hours * 60 + minutes
+
+class Job(object):
+    """A scheduled timelapse."""
+
+    def __init__(self, options, name=None, start=None, window=None, days=None,
+                 until=None):
+        self.id = None
+        self.options = options
+        self.name = name
+        self.start = start
+        self.window = window
+        self.days = days
+        self.until = until
+        self.state = 'queued'
+        self.runs = 0
+        self.sessions = []
+        self.error = None
+        self.start_lateness = []
+        self.last_start = None
+        self.added = time.time()
+        if not window == None:
+            self._begin = parse_hhmm(window[0])
+            length = (parse_hhmm(window[1]) - self._begin) % (24 * 60)
+            self._length = (length or 24 * 60) * 60
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return a Job from a dictionary, e.g. JSON from the web API.
+        Raises ValueError if it is not valid."""
+        options = {}
+        for k in JOB_OPTIONS:
+            if not data.get(k) == None:
+                options[k] = float(data[k]) if k == 'delta_time' else int(data[k])
+        if not options.get('delta_time', 0) > 0:
+            raise ValueError("delta_time must be more than 0")
+        window = data.get('window')
+        if not window == None and not len(window) == 2:
+            raise ValueError("window must be [\"HH:MM\", \"HH:MM\"]")
+        if not options.get('total_imgs') and window == None and \
+           data.get('until') == None:
+            raise ValueError("need total_imgs, a window or an until time")
+        days = data.get('days')
+        return cls(options, name=data.get('name'),
+                   start=None if data.get('start') == None else float(data['start']),
+                   window=window,
+                   days=None if days == None else int(days),
+                   until=None if data.get('until') == None else float(data['until']))
+
+    def next_run(self, now):
+        """Return (start, end) wall clock times of the next run, end None if
+        it only ends by total_imgs, or None if there are no more runs."""
+        if self.state in ('done', 'cancelled', 'failed'):
+            return None
+        if not self.until == None and now >= self.until:
+            return None
+        if not self.days == None and self.runs >= self.days:
+            return None
+        if self.window == None:
+            if self.runs > 0:
+                return None
+            return (self.start or now), self.until
+        for start, end in self.__windows(now):
+            if end <= now:
+                continue
+            if not self.last_start == None and start <= self.last_start:
+                continue
+            if not self.start == None:
+                if end <= self.start:
+                    continue
+                start = max(start, self.start)
+            if not self.until == None:
+                if start >= self.until:
+                    return None
+                end = min(end, self.until)
+            return start, end
+
+    def started(self, start, scheduled):
+        """Record a run that was due at scheduled and started at start. A
+        run due before the job was added is late from when it was added."""
+        self.state = 'running'
+        self.runs += 1
+        self.last_start = scheduled
+        self.start_lateness.append(max(0.0, start - max(scheduled, self.added)))
+        del self.start_lateness[:-MAX_LATENESS_KEPT]
+
+    def to_dict(self, now=None):
+        """Return dictionary of the job, for the web API."""
+        run = self.next_run(time.time() if now == None else now)
+        data = {
+            'id'            : self.id,
+            'name'          : self.name,
+            'state'         : self.state,
+            'start'         : self.start,
+            'window'        : self.window,
+            'days'          : self.days,
+            'until'         : self.until,
+            'runs'          : self.runs,
+            'sessions'      : self.sessions,
+            'error'         : self.error,
+            'start_lateness': self.start_lateness,
+            'next_start'    : None if run == None else run[0],
+            'next_end'      : None if run == None else run[1],
+        }
+        data.update(self.options)
+        return data
+
+    def __windows(self, now):
+        """Generate (start, end) of the daily windows, from the one that
+        began yesterday on."""
+        t = time.localtime(now)
+        for day in itertools.count(-1):
+            # mktime normalizes the day and works out DST
+            start = time.mktime((t.tm_year, t.tm_mon, t.tm_mday + day,
+                                 self._begin // 60, self._begin % 60, 0, 0, 0, -1))
+            yield start, start + self._length
+
+def frames_between(start, end, delta_time):
+    """Return how many frames delta_time apart fit from start to end."""
+    return max(1, int((end - start) / delta_time) + 1)
+
+class Scheduler(threading.Thread):
+    """Runs jobs, one at a time, in start time order, then queue order."""
+
+    def __init__(self, runner):
+        threading.Thread.__init__(self, name="Scheduler")
+        self.daemon = True
+        self.runner = runner
+        self.jobs = []
+        self.current = None         # (job, timelapse)
+        self.keep_running = True
+        self.waker = clock.Waker()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        """Queue a job. Return it, with its id set."""
+        with self._lock:
+            job.id = next(self._ids)
+            self.jobs.append(job)
+        self.waker.set()
+        return job
+
+    def cancel(self, job_id):
+        """Cancel a job, stopping it if it is running. Return the job, None
+        if there is no such job."""
+        with self._lock:
+            for job in self.jobs:
+                if job.id == job_id:
+                    break
+            else:
+                return None
+            job.state = 'cancelled'
+            if not self.current == None and self.current[0] is job:
+                self.current[1].stop()
+        self.waker.set()
+        return job
+
+    def get_jobs(self, ):
+        """Return list of job dictionaries."""
+        now = time.time()
+        with self._lock:
+            return [job.to_dict(now) for job in self.jobs]
+
+    def notify(self, *args):
+        """Wake the scheduler, e.g. when a timelapse finishes. Takes any
+        arguments, so it can be used as a callback."""
+        self.waker.set()
+
+    def clock_changed(self, ):
+        """Wake the scheduler after the system time is set, so it works out
+        its deadlines again."""
+        self.waker.set()
+
+    def stop(self, ):
+        """Stop the scheduler, and the timelapse of a running job."""
+        self.keep_running = False
+        with self._lock:
+            if not self.current == None:
+                self.current[1].stop()
+        self.waker.set()
+
+    def run(self, ):
+        while self.keep_running:
+            self.waker.clear()
+            with self._lock:
+                deadline = self.__step()
+            if deadline == None:
+                self.waker.wait()
+            else:
+                self.waker.wait_until(deadline)
+        self.waker.close()
+
+    def __step(self, ):
+        """Start or stop a run as due. Return the monotonic deadline to wake
+        up at, None to wait to be notified."""
+        now = time.time()
+        mono = clock.monotonic()
+        if not self.current == None:
+            job, timelapse = self.current
+            if timelapse.is_alive() and not timelapse.finished:
+                if self._end == None:
+                    return None
+                if now < self._end:
+                    return mono + self._end - now
+                timelapse.stop()
+                return None
+            self.current = None
+            if not timelapse.timelapse_name == None:
+                job.sessions.append(timelapse.timelapse_name)
+            if not timelapse.error == None and not job.state == 'cancelled':
+                job.state = 'failed'
+                job.error = str(timelapse.error)
+            if job.state == 'running':
+                job.state = 'waiting' if not job.next_run(now) == None else 'done'
+        due = []
+        for order, job in enumerate(self.jobs):
+            run = job.next_run(now)
+            if run == None:
+                if job.state in ('queued', 'waiting'):
+                    job.state = 'done'
+                continue
+            due.append((run[0], order, run[1], job))
+        if not due:
+            return None
+        start, order, end, job = min(due)
+        if start > now:
+            return mono + start - now
+        try:
+            timelapse = self.runner(job, now, end)
+        except Exception as e:
+            print "Scheduler: job {0} failed to start: {1}".format(job.id, e)
+            job.state = 'failed'
+            job.error = str(e)
+            # next job, right away
+            return mono
+        if timelapse == None:
+            # camera busy, wait for notify()
+            return None
+        job.started(now, start)
+        self.current = (job, timelapse)
+        self._end = end
+        if end == None:
+            return None
+        return mono + end - now
@@ -0,0 +1,161 @@
+#===========================================================================
+# sessionindex.py
+#
+# Persistent index of timelapse sessions and frames.
+#
+# Frames are added as they are written, so the sessions can be browsed
+# without ever listing the (very large) timelapse directories. Thumbnails
+# are built the first time they are asked for and then kept in the index.
+#
+# 2016-08-27
+# Carter Nelson
+#===========================================================================
+import threading
+import sqlite3
+import io
+
+import Image
+
+INDEX_FILE = "timelapse_index.db"
+THUMB_SIZE = (160, 120)
+THUMB_QUALITY = 75
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    name            TEXT PRIMARY KEY,
+    dir             TEXT,
+    start_time      REAL,
+    delta_time      REAL,
+    total_imgs      INTEGER,
+    mode            TEXT,
+    frame_count     INTEGER DEFAULT 0,
+    bytes           INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS frames (
+    session         TEXT,
+    number          INTEGER,
+    filename        TEXT,
+    time            REAL,
+    size            INTEGER,
+    exposure_speed  INTEGER,
+    thumb           BLOB,
+    PRIMARY KEY (session, number)
+);
+"""
+
+class SessionIndex(object):
+    """A class for indexing timelapse sessions in a SQLite database."""
+
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def add_session(self, name, dir, start_time, delta_time, total_imgs, mode):
+        """Add a timelapse session, replacing any existing one of the same
+        name."""
+        with self._lock:
+            self._db.execute("DELETE FROM frames WHERE session=?", (name,))
+            self._db.execute("INSERT OR REPLACE INTO sessions "
+                             "(name, dir, start_time, delta_time, total_imgs, mode) "
+                             "VALUES (?,?,?,?,?,?)",
+                             (name, dir, start_time, delta_time, total_imgs, mode))
+            self._db.commit()
+
+    def add_frame(self, session, number, filename, timestamp, size,
+                  exposure_speed=None):
+        """Add a frame to a session."""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO frames "
+                             "(session, number, filename, time, size, exposure_speed) "
+                             "VALUES (?,?,?,?,?,?)",
+                             (session, number, filename, timestamp, size,
+                              exposure_speed))
+            self._db.execute("UPDATE sessions SET frame_count=frame_count+1, "
+                             "bytes=bytes+? WHERE name=?", (size, session))
+            self._db.commit()
+
+    def remove_frame(self, session, number):
+        """Remove a frame from a session."""
+        with self._lock:
+            row = self._db.execute("SELECT size FROM frames "
+                                   "WHERE session=? AND number=?",
+                                   (session, number)).fetchone()
+            if row == None:
+                return
+            self._db.execute("DELETE FROM frames WHERE session=? AND number=?",
+                             (session, number))
+            self._db.execute("UPDATE sessions SET frame_count=frame_count-1, "
+                             "bytes=bytes-? WHERE name=?", (row['size'], session))
+            self._db.commit()
+
+    def get_session(self, name):
+        """Return dictionary of session info, or None if not found."""
+        with self._lock:
+            row = self._db.execute("SELECT * FROM sessions WHERE name=?",
+                                   (name,)).fetchone()
+        return None if row == None else dict(row)
+
+    def get_sessions(self, page=1, per_page=20):
+        """Return (total, sessions) for a page of sessions, newest first."""
+        with self._lock:
+            total = self._db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            rows = self._db.execute("SELECT * FROM sessions "
+                                    "ORDER BY start_time DESC LIMIT ? OFFSET ?",
+                                    (per_page, (page - 1) * per_page)).fetchall()
+        return total, [dict(row) for row in rows]
+
+    def get_frames(self, session, page=1, per_page=50):
+        """Return (total, frames) for a page of frames of a session."""
+        with self._lock:
+            total = self._db.execute("SELECT COUNT(*) FROM frames WHERE session=?",
+                                     (session,)).fetchone()[0]
+            rows = self._db.execute("SELECT session, number, filename, time, "
+                                    "size, exposure_speed FROM frames "
+                                    "WHERE session=? ORDER BY number "
+                                    "LIMIT ? OFFSET ?",
+                                    (session, per_page,
+                                     (page - 1) * per_page)).fetchall()
+        return total, [dict(row) for row in rows]
+
+    def get_frame(self, session, number):
+        """Return dictionary of frame info, or None if not found."""
+        with self._lock:
+            row = self._db.execute("SELECT session, number, filename, time, "
+                                   "size, exposure_speed FROM frames "
+                                   "WHERE session=? AND number=?",
+                                   (session, number)).fetchone()
+        return None if row == None else dict(row)
+
+    def get_thumbnail(self, session, number):
+        """Return the JPEG thumbnail for a frame, building it if needed.
+        Returns None if the frame is not in the index."""
+        with self._lock:
+            row = self._db.execute("SELECT filename, thumb FROM frames "
+                                   "WHERE session=? AND number=?",
+                                   (session, number)).fetchone()
+        if row == None:
+            return None
+        if not row['thumb'] == None:
+            return str(row['thumb'])
+        image = Image.open(row['filename'])
+        image.draft('RGB', THUMB_SIZE)      # let the JPEG decoder scale down
+        image.thumbnail(THUMB_SIZE, Image.ANTIALIAS)
+        stream = io.BytesIO()
+        image.save(stream, 'JPEG', quality=THUMB_QUALITY)
+        thumb = stream.getvalue()
+        with self._lock:
+            self._db.execute("UPDATE frames SET thumb=? WHERE session=? AND number=?",
+                             (sqlite3.Binary(thumb), session, number))
+            self._db.commit()
+        return thumb
+
+    def close(self, ):
+        """Close the index."""
+        with self._lock:
+            self._db.close()
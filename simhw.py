@@ -0,0 +1,491 @@
+#===========================================================================
+# simhw.py
+#
+# Simulated hardware backends, so campi, timelapser, mjpegger and the web
+# server can run on a machine without a camera, LCD or GPIO.
+#
+# install() puts fake versions of these modules in sys.modules, and must be
+# called before campi is imported:
+#   * picamera, picamera.array
+#   * RPi.GPIO
+#   * Adafruit_Nokia_LCD, Adafruit_GPIO.SPI
+#
+# The fakes sleep to mimic the cost of the real thing. The costs, and the
+# size of the frames produced, are set in CONFIG and can be changed with
+# install(**config) or configure(**config) at any time.
+#
+# 2016-09-24
+# Carter Nelson
+#===========================================================================
+import sys
+import types
+import threading
+import time
+import io
+
+import numpy as np
+
+CONFIG = {
+    'open_time'         : 0.5,      # secs to open the camera
+    'setting_time'      : 0.001,    # secs to set a camera property
+    'reconfigure_time'  : 0.1,      # secs to set resolution or framerate
+    'capture_time'      : 0.3,      # secs for a still port capture
+    'video_capture_time': 0.03,     # secs for a video port capture
+    'frame_bytes'       : None,     # pad JPEGs to this size, None = as encoded
+    'spi_time'          : 0.002,    # secs to push one LCD image
+    'exposure_speed'    : 10000,    # auto exposure result, usecs
+}
+
+LCD_WIDTH = 84
+LCD_HEIGHT = 48
+
+def configure(**config):
+    """Change simulation costs, see CONFIG."""
+    for k in config:
+        if k not in CONFIG:
+            raise ValueError("unknown simulation setting {0}".format(k))
+    CONFIG.update(config)
+
+def _frame(size):
+    """Return a synthetic RGB frame, a gradient that moves with time so
+    consecutive frames differ."""
+    width, height = size
+    shift = int(time.time() * 50) % 256
+    x = (np.arange(width, dtype=np.uint16) * 256 / max(1, width) + shift) % 256
+    y = np.arange(height, dtype=np.uint16) * 256 / max(1, height)
+    rgb = np.empty((height, width, 3), dtype=np.uint8)
+    rgb[:,:,0] = x[np.newaxis,:]
+    rgb[:,:,1] = y[:,np.newaxis]
+    rgb[:,:,2] = 128
+    return rgb
+
+_JPEG_CACHE = {}
+_JPEG_LOCK = threading.Lock()
+def _jpeg(size, quality=85):
+    """Return JPEG data of the specified size. Encoded once per size and
+    quality, so the simulation costs what CONFIG says, not what PIL takes."""
+    key = (tuple(size), quality)
+    with _JPEG_LOCK:
+        if key not in _JPEG_CACHE:
+            import Image
+            stream = io.BytesIO()
+            Image.fromarray(_frame(size)).save(stream, 'JPEG', quality=quality)
+            _JPEG_CACHE[key] = stream.getvalue()
+        data = _JPEG_CACHE[key]
+    frame_bytes = CONFIG['frame_bytes']
+    if not frame_bytes == None and frame_bytes > len(data):
+        # pad with a comment segment, keeping the EOI marker last
+        pad = frame_bytes - len(data) - 4
+        while pad > 0:
+            n = min(pad, 65533)
+            data = data[:2] + "\xff\xfe" + chr((n+2) >> 8) + chr((n+2) & 0xff) + \
+                   "\0"*n + data[2:]
+            pad -= n + 4
+    return data
+
+def _h264_headers(size):
+    """Return Annex B SPS and PPS, constrained baseline, for the size."""
+    def ue(v):
+        v = bin(v + 1)[2:]
+        return "0" * (len(v) - 1) + v
+    width, height = size
+    mbs_w, mbs_h = (width + 15) // 16, (height + 15) // 16
+    bits = ue(0) + ue(0) + ue(2) + ue(1) + "0" + ue(mbs_w - 1) + ue(mbs_h - 1) + \
+           "11"
+    crop_w, crop_h = (mbs_w * 16 - width) // 2, (mbs_h * 16 - height) // 2
+    if crop_w or crop_h:
+        bits += "1" + ue(0) + ue(crop_w) + ue(0) + ue(crop_h)
+    else:
+        bits += "0"
+    bits += "0" + "1"
+    bits += "0" * (-len(bits) % 8)
+    sps = "".join(chr(int(bits[i:i+8], 2)) for i in range(0, len(bits), 8))
+    return "\x00\x00\x00\x01\x67\x42\xc0\x28" + sps + \
+           "\x00\x00\x00\x01\x68\xce\x38\x80"
+
+def _h264_frame(size, key):
+    """Return an Annex B access unit, headers and IDR slice for a key frame,
+    else a P slice. Not decodable, only the framing is real."""
+    n = max(64, size[0] * size[1] // (20 if key else 200))
+    if key:
+        return _h264_headers(size) + "\x00\x00\x00\x01\x65\x88" + "\x5a" * n
+    return "\x00\x00\x00\x01\x41\x9a" + "\x5a" * n
+
+def _sleep(secs):
+    if secs > 0:
+        time.sleep(secs)
+
+#--------------------------------------------------------------------
+# picamera
+#--------------------------------------------------------------------
+class PiCameraError(Exception):
+    pass
+
+class PiCameraRuntimeError(PiCameraError, RuntimeError):
+    pass
+
+class PiCamera(object):
+    """Simulated picamera.PiCamera."""
+
+    def __init__(self, camera_num=0, stereo_mode='none', stereo_decimate=False,
+                 resolution=None, framerate=None, sensor_mode=0, led_pin=None,
+                 clock_mode='reset', framerate_range=None):
+        _sleep(CONFIG['open_time'])
+        self.sensor_mode = sensor_mode
+        self._resolution = tuple(resolution) if not resolution == None else (1920, 1080)
+        self._framerate = framerate if not framerate == None else 30
+        self.exposure_mode = 'auto'
+        self.iso = 0
+        self.awb_mode = 'auto'
+        self.awb_gains = (1.5, 1.2)
+        self._shutter_speed = 0
+        self.brightness = 50
+        self.contrast = 0
+        self.sharpness = 0
+        self.saturation = 0
+        self.hflip = False
+        self.vflip = False
+        self.analog_gain = 1
+        self.digital_gain = 1
+        self.closed = False
+        self._recorders = {}
+        self._key_frames = {}
+
+    def __setattr__(self, name, value):
+        if not name.startswith('_') and hasattr(self, '_recorders'):
+            _sleep(CONFIG['setting_time'])
+        object.__setattr__(self, name, value)
+
+    def __get_resolution(self):
+        return self._resolution
+    def __set_resolution(self, value):
+        self.__reconfigure()
+        self._resolution = tuple(value)
+    resolution = property(__get_resolution, __set_resolution)
+
+    def __get_framerate(self):
+        return self._framerate
+    def __set_framerate(self, value):
+        self.__reconfigure()
+        self._framerate = value
+    framerate = property(__get_framerate, __set_framerate)
+
+    def __get_shutter_speed(self):
+        return self._shutter_speed
+    def __set_shutter_speed(self, value):
+        self._shutter_speed = int(value)
+    shutter_speed = property(__get_shutter_speed, __set_shutter_speed)
+
+    @property
+    def exposure_speed(self):
+        if self._shutter_speed:
+            return self._shutter_speed
+        return CONFIG['exposure_speed']
+
+    @property
+    def recording(self):
+        return len(self._recorders) > 0
+
+    def __reconfigure(self, ):
+        if self.recording:
+            raise PiCameraRuntimeError(
+                "Recording is currently running")
+        _sleep(CONFIG['reconfigure_time'])
+
+    def capture(self, output, format=None, use_video_port=False, resize=None,
+                splitter_port=0, bayer=False, **options):
+        self.__check_open()
+        if use_video_port:
+            _sleep(CONFIG['video_capture_time'])
+        else:
+            _sleep(CONFIG['capture_time'])
+        size = tuple(resize) if not resize == None else self._resolution
+        if format == None:
+            format = 'jpeg'
+        if isinstance(output, PiRGBArray):
+            output.array = _frame(size)
+            return
+        if format == 'jpeg':
+            data = _jpeg(size, options.get('quality', 85))
+        elif format == 'rgb':
+            data = _frame(size).tostring()
+        elif format == 'yuv':
+            fw = (size[0] + 31) // 32 * 32
+            fh = (size[1] + 15) // 16 * 16
+            y = np.zeros((fh, fw), dtype=np.uint8)
+            y[:size[1], :size[0]] = _frame(size)[:,:,0]
+            data = y.tostring() + "\x80" * (fw * fh // 2)
+        else:
+            raise PiCameraError("unsupported format {0}".format(format))
+        if isinstance(output, basestring):
+            with open(output, "wb") as file:
+                file.write(data)
+        else:
+            output.write(data)
+
+    def capture_continuous(self, output, format=None, use_video_port=False,
+                           resize=None, splitter_port=0, burst=False,
+                           bayer=False, **options):
+        while True:
+            start = time.time()
+            self.capture(output, format, use_video_port, resize, splitter_port,
+                         **options)
+            if use_video_port:
+                _sleep(1.0 / float(self._framerate) - (time.time() - start))
+            yield output
+
+    def start_recording(self, output, format=None, resize=None, splitter_port=1,
+                        **options):
+        self.__check_open()
+        if splitter_port in self._recorders:
+            raise PiCameraRuntimeError(
+                "The camera is already using port {0}".format(splitter_port))
+        size = tuple(resize) if not resize == None else self._resolution
+        stop = threading.Event()
+        if format == 'h264':
+            key = threading.Event()
+            thread = threading.Thread(target=self.__record_h264,
+                                      args=(output, size,
+                                            options.get('intra_period', 60),
+                                            key, stop))
+        else:
+            key = None
+            thread = threading.Thread(target=self.__record,
+                                      args=(output, size, options.get('quality', 85), stop))
+        thread.daemon = True
+        self._recorders[splitter_port] = (thread, stop)
+        self._key_frames[splitter_port] = key
+        thread.start()
+
+    def stop_recording(self, splitter_port=1):
+        if splitter_port not in self._recorders:
+            raise PiCameraNotRecording(
+                "There is no recording in progress on port {0}".format(splitter_port))
+        thread, stop = self._recorders.pop(splitter_port)
+        self._key_frames.pop(splitter_port, None)
+        stop.set()
+        thread.join()
+
+    def wait_recording(self, timeout=0, splitter_port=1):
+        _sleep(timeout)
+
+    def request_key_frame(self, splitter_port=1):
+        if splitter_port not in self._recorders:
+            raise PiCameraNotRecording(
+                "There is no recording in progress on port {0}".format(splitter_port))
+        if not self._key_frames[splitter_port] == None:
+            self._key_frames[splitter_port].set()
+
+    def __record(self, output, size, quality, stop):
+        period = 1.0 / float(self._framerate)
+        next_time = time.time()
+        while not stop.is_set():
+            output.write(_jpeg(size, quality))
+            next_time += period
+            stop.wait(max(0, next_time - time.time()))
+
+    def __record_h264(self, output, size, intra_period, key, stop):
+        period = 1.0 / float(self._framerate)
+        next_time = time.time()
+        n = 0
+        while not stop.is_set():
+            is_key = n % intra_period == 0 or key.is_set()
+            if is_key:
+                key.clear()
+                n = 0
+            output.write(_h264_frame(size, is_key))
+            n += 1
+            next_time += period
+            stop.wait(max(0, next_time - time.time()))
+
+    def __check_open(self, ):
+        if self.closed:
+            raise PiCameraClosed("Camera is closed")
+
+    def close(self, ):
+        for port in list(self._recorders):
+            self.stop_recording(port)
+        self.closed = True
+
+class PiCameraNotRecording(PiCameraRuntimeError):
+    pass
+
+class PiCameraClosed(PiCameraRuntimeError):
+    pass
+
+class PiRGBArray(object):
+    """Simulated picamera.array.PiRGBArray."""
+
+    def __init__(self, camera, size=None):
+        self.camera = camera
+        self.size = size
+        self.array = None
+
+    def truncate(self, size=None):
+        self.array = None
+
+#--------------------------------------------------------------------
+# RPi.GPIO
+#--------------------------------------------------------------------
+class GPIO(object):
+    """Simulated RPi.GPIO, as a namespace. Inputs read HIGH (pulled up,
+    button not pressed) unless set with press()/release()."""
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+    PUD_UP = 22
+    PUD_DOWN = 21
+    PUD_OFF = 20
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    _lock = threading.Lock()
+    _levels = {}
+    _callbacks = {}
+
+    @staticmethod
+    def setwarnings(flag):
+        pass
+
+    @staticmethod
+    def setmode(mode):
+        pass
+
+    @staticmethod
+    def setup(pin, direction, pull_up_down=20, initial=None):
+        with GPIO._lock:
+            if direction == GPIO.OUT:
+                GPIO._levels[pin] = GPIO.LOW if initial == None else initial
+            else:
+                GPIO._levels[pin] = GPIO.LOW if pull_up_down == GPIO.PUD_DOWN \
+                                             else GPIO.HIGH
+
+    @staticmethod
+    def input(pin):
+        with GPIO._lock:
+            return GPIO._levels.get(pin, GPIO.HIGH)
+
+    @staticmethod
+    def output(pin, value):
+        with GPIO._lock:
+            GPIO._levels[pin] = value
+
+    @staticmethod
+    def add_event_detect(pin, edge, callback=None, bouncetime=None):
+        with GPIO._lock:
+            GPIO._callbacks[pin] = callback
+
+    @staticmethod
+    def remove_event_detect(pin):
+        with GPIO._lock:
+            GPIO._callbacks.pop(pin, None)
+
+    @staticmethod
+    def cleanup(channel=None):
+        with GPIO._lock:
+            GPIO._levels.clear()
+            GPIO._callbacks.clear()
+
+    @staticmethod
+    def press(pin):
+        """Simulate a button press, pulling pin LOW."""
+        GPIO.__set_input(pin, GPIO.LOW)
+
+    @staticmethod
+    def release(pin):
+        """Simulate a button release, pin back HIGH."""
+        GPIO.__set_input(pin, GPIO.HIGH)
+
+    @staticmethod
+    def __set_input(pin, level):
+        with GPIO._lock:
+            GPIO._levels[pin] = level
+            callback = GPIO._callbacks.get(pin)
+        if not callback == None:
+            callback(pin)
+
+#--------------------------------------------------------------------
+# Adafruit_Nokia_LCD, Adafruit_GPIO.SPI
+#--------------------------------------------------------------------
+class SpiDev(object):
+    """Simulated Adafruit_GPIO.SPI.SpiDev."""
+
+    def __init__(self, port, device, max_speed_hz=500000):
+        self.port = port
+        self.device = device
+        self.max_speed_hz = max_speed_hz
+
+class PCD8544(object):
+    """Simulated Adafruit_Nokia_LCD.PCD8544. The last displayed image is
+    kept in shown, and the number of SPI pushes in pushes."""
+
+    def __init__(self, dc, rst, sclk=None, din=None, cs=None, gpio=None,
+                 spi=None):
+        self._buffer = None
+        self.shown = None
+        self.pushes = 0
+
+    def begin(self, contrast=40, bias=4):
+        pass
+
+    def clear(self, ):
+        self._buffer = None
+
+    def image(self, image):
+        self._buffer = image.copy()
+
+    def display(self, ):
+        _sleep(CONFIG['spi_time'])
+        self.shown = self._buffer
+        self.pushes += 1
+
+    def set_contrast(self, contrast):
+        pass
+
+#--------------------------------------------------------------------
+# installation
+#--------------------------------------------------------------------
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    module.__file__ = __file__
+    return module
+
+def install(**config):
+    """Put the simulated backends in sys.modules. Must be called before
+    campi is imported. If the old style PIL modules (import Image) are not
+    available, the Pillow ones are aliased in their place."""
+    configure(**config)
+    gpio = _module('RPi.GPIO', **dict((k, v) for k, v in GPIO.__dict__.items()
+                                           if not k.startswith('__')))
+    for name in ('setwarnings', 'setmode', 'setup', 'input', 'output',
+                 'add_event_detect', 'remove_event_detect', 'cleanup',
+                 'press', 'release'):
+        setattr(gpio, name, getattr(GPIO, name))
+    rpi = _module('RPi', GPIO=gpio)
+    array = _module('picamera.array', PiRGBArray=PiRGBArray)
+    picamera = _module('picamera', PiCamera=PiCamera, PiCameraError=PiCameraError,
+                       PiCameraRuntimeError=PiCameraRuntimeError, array=array)
+    spi = _module('Adafruit_GPIO.SPI', SpiDev=SpiDev)
+    adafruit_gpio = _module('Adafruit_GPIO', SPI=spi)
+    lcd = _module('Adafruit_Nokia_LCD', PCD8544=PCD8544,
+                  LCDWIDTH=LCD_WIDTH, LCDHEIGHT=LCD_HEIGHT)
+    sys.modules.update({
+        'RPi'               : rpi,
+        'RPi.GPIO'          : gpio,
+        'picamera'          : picamera,
+        'picamera.array'    : array,
+        'Adafruit_GPIO'     : adafruit_gpio,
+        'Adafruit_GPIO.SPI' : spi,
+        'Adafruit_Nokia_LCD': lcd,
+    })
+    for name in ('Image', 'ImageDraw', 'ImageFont'):
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = __import__('PIL.'+name, fromlist=[name])
@@ -0,0 +1,154 @@
+#===========================================================================
+# stacker.py
+#
+# Running accumulator for stacking frames.
+#
+# Frames are added one at a time and folded into the accumulator, so
+# memory use does not depend on the number of frames. Modes:
+#   * mean  = average, reduces noise (one float32 buffer)
+#   * max   = brightest value per pixel, for star trails (one uint8 buffer)
+#   * sigma = average with outliers (satellites, planes, hot pixels)
+#             rejected, pixels further than sigma standard deviations
+#             from the mean of the frames before are left out of that
+#             pixel's average, up to MAX_SIGMA_FRAMES frames
+#
+# Memory, per pixel and color, is 4 bytes in mean mode and 9 in sigma
+# mode: exact integer sums, of all values (uint16) and their squares
+# (uint32) for the mean and variance, and of the kept values (uint16) and
+# their count (uint8). That is about 56MB at 1920x1080, 136MB at full
+# resolution. Sigma mode works a strip of STRIP_ROWS rows at a time, so
+# its float temporaries are small.
+#
+# In sigma mode the mean and variance are estimated from few frames at
+# first, so the limit is widened to match (Student's t), and the standard
+# deviation has a floor, so pixels that are the same in the first frames,
+# e.g. dark ones, are not all rejected after. Pure noise has about the
+# same fraction rejected as the sigma says, 0.3% at 3.
+#
+# 2016-10-08
+# Carter Nelson
+#===========================================================================
+import math
+
+import numpy as np
+
+STACK_MODES = ('mean', 'max', 'sigma')
+SIGMA = 3.0             # rejection threshold for sigma mode
+SIGMA_WARMUP = 4        # frames before rejection starts
+SIGMA_FLOOR = 1.0       # min standard deviation for rejection, pixel levels
+MAX_SIGMA_FRAMES = 255  # sigma mode limit, so sums fit uint16 and counts uint8
+STRIP_ROWS = 64         # rows at a time in sigma mode
+
+def sigma_limit(sigma, frames):
+    """Return the rejection limit, in standard deviations estimated from
+    frames, for a new value that is sigma out for a normal distribution.
+    Cornish-Fisher expansion of the Student's t quantile."""
+    nu = frames - 1.0
+    t = sigma + (sigma**3 + sigma) / (4 * nu) + \
+        (5 * sigma**5 + 16 * sigma**3 + 3 * sigma) / (96 * nu**2)
+    return t * math.sqrt(1.0 + 1.0 / frames)
+
+class Stacker(object):
+    """A class for stacking frames into one."""
+
+    def __init__(self, mode='mean', sigma=SIGMA):
+        if mode not in STACK_MODES:
+            raise ValueError("stack mode must be one of {0}".format(STACK_MODES))
+        self.mode = mode
+        self.sigma = sigma
+        self.count = 0
+        self.rejected = 0
+        self._acc = None
+        self._s1 = None
+        self._s2 = None
+        self._kept = None
+
+    def add(self, frame):
+        """Fold a frame, a uint8 numpy array, into the stack."""
+        if not self._acc is None and not frame.shape == self._acc.shape:
+            raise ValueError("frame shape {0} does not match stack {1}".format(
+                                                    frame.shape, self._acc.shape))
+        if self.mode == 'sigma' and self.count >= MAX_SIGMA_FRAMES:
+            raise ValueError("sigma mode stacks at most {0} frames".format(
+                                                            MAX_SIGMA_FRAMES))
+        self.count += 1
+        if self.mode == 'max':
+            if self._acc is None:
+                self._acc = frame.copy()
+            else:
+                np.maximum(self._acc, frame, out=self._acc)
+        elif self.mode == 'mean':
+            if self._acc is None:
+                self._acc = frame.astype(np.float32)
+            else:
+                self._acc += frame
+        else:
+            self.__add_sigma(frame)
+
+    def __add_sigma(self, frame):
+        """Sum the values that are not outliers, then add all of them to the
+        sums for the mean and variance, a strip of rows at a time."""
+        if self._acc is None:
+            self._acc = frame.astype(np.uint16)
+            self._kept = np.ones(frame.shape, dtype=np.uint8)
+            self._s1 = frame.astype(np.uint16)
+            self._s2 = frame.astype(np.uint32)
+            self._s2 *= self._s2
+            return
+        before = self.count - 1
+        limit = None
+        if before >= SIGMA_WARMUP:
+            limit = sigma_limit(self.sigma, before)
+        for top in range(0, frame.shape[0], STRIP_ROWS):
+            rows = slice(top, top + STRIP_ROWS)
+            value = frame[rows]
+            acc = self._acc[rows]
+            kept = self._kept[rows]
+            s1 = self._s1[rows]
+            s2 = self._s2[rows]
+            if limit == None:
+                acc += value
+                kept += 1
+            else:
+                mean = s1.astype(np.float32)
+                mean /= before
+                var = s2.astype(np.float32)
+                var /= before
+                var -= mean * mean
+                var *= before / (before - 1.0)
+                np.maximum(var, SIGMA_FLOOR ** 2, out=var)
+                np.sqrt(var, out=var)
+                var *= limit
+                mean -= value
+                np.abs(mean, out=mean)
+                keep = mean <= var
+                self.rejected += int(keep.size - np.count_nonzero(keep))
+                np.add(acc, value, out=acc, where=keep)
+                kept += keep
+            s1 += value
+            square = value.astype(np.uint32)
+            square *= square
+            s2 += square
+
+    def result(self, ):
+        """Return the stacked frame as a uint8 numpy array."""
+        if self._acc is None:
+            return None
+        if self.mode == 'max':
+            return self._acc.copy()
+        if self.mode == 'sigma':
+            return self.__sigma_result()
+        stacked = self._acc / self.count
+        np.rint(stacked, out=stacked)
+        np.clip(stacked, 0, 255, out=stacked)
+        return stacked.astype(np.uint8)
+
+    def __sigma_result(self, ):
+        """Return the mean of the kept values, a strip of rows at a time."""
+        stacked = np.empty(self._acc.shape, dtype=np.uint8)
+        for top in range(0, stacked.shape[0], STRIP_ROWS):
+            rows = slice(top, top + STRIP_ROWS)
+            mean = self._acc[rows] / self._kept[rows].astype(np.float32)
+            np.rint(mean, out=mean)
+            stacked[rows] = np.clip(mean, 0, 255)
+        return stacked
@@ -0,0 +1,245 @@
+#===========================================================================
+# storage.py
+#
+# Storage manager for timelapse frames.
+#
+#   * predicts bytes per frame from resolution and JPEG quality, refined
+#     with the actual sizes once frames are written, and whether a
+#     timelapse will fit in the free space
+#   * picks the first available of several roots, e.g. a USB stick
+#     before the SD card
+#   * never overwrites, a new session directory always gets a unique name
+#   * batches syncs, one per sync_frames frames or sync_interval secs,
+#     instead of leaving it all to the kernel or syncing every file. A
+#     failed sync doesn't fail the write that triggered it, the frame is
+#     written, it is counted in sync_errors and kept as last_sync_error
+#   * optional ring buffer retention, the oldest frames are removed to
+#     keep at most retain_frames, or to stay above the reserve space
+#   * copies = how many times each frame is stored, 2 if the frames also
+#     go into an AVI, which is written outside the manager but still
+#     counted in the predictions and against the reserve
+#
+# 2016-10-01
+# Carter Nelson
+#===========================================================================
+import os
+import errno
+import time
+import threading
+import collections
+import ctypes
+import ctypes.util
+
+RESERVE_BYTES = 64 * 1024 * 1024    # free space always left alone
+SYNC_FRAMES = 16                    # sync after this many frames
+SYNC_INTERVAL = 10.0                # or this many secs
+FREE_CACHE_TIME = 1.0               # secs to cache free space
+HEADER_BYTES = 32 * 1024            # JPEG headers, EXIF and its thumbnail
+# approximate JPEG bytes per pixel for the Pi camera, by quality
+QUALITY_BPP = ((0, 0.03), (50, 0.12), (75, 0.2), (85, 0.3), (95, 0.55), (100, 0.95))
+
+def estimate_frame_bytes(resolution, quality):
+    """Return estimated JPEG size in bytes for the resolution and quality."""
+    width, height = resolution
+    for (q0, b0), (q1, b1) in zip(QUALITY_BPP, QUALITY_BPP[1:]):
+        if quality <= q1:
+            bpp = b0 + (b1 - b0) * (quality - q0) / float(q1 - q0)
+            break
+    else:
+        bpp = QUALITY_BPP[-1][1]
+    return int(width * height * bpp) + HEADER_BYTES
+
+def select_root(roots):
+    """Return the first usable root. All but the last must be mount points,
+    so an unmounted USB stick's empty mount directory is not used. The last
+    root is the fallback and is always returned."""
+    for root in roots[:-1]:
+        if os.path.ismount(root) and os.access(root, os.W_OK):
+            return root
+    return roots[-1]
+
+def _syncfs():
+    """Return libc syncfs(fd), or None if not available."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        return libc.syncfs
+    except (OSError, AttributeError):
+        return None
+SYNCFS = _syncfs()
+
+class StorageManager(object):
+    """A class for writing timelapse frames to storage."""
+
+    def __init__(self, root, reserve_bytes=RESERVE_BYTES, retain_frames=0,
+                 sync_frames=SYNC_FRAMES, sync_interval=SYNC_INTERVAL, copies=1):
+        self.root = root
+        self.copies = copies
+        self.reserve_bytes = reserve_bytes
+        self.retain_frames = retain_frames
+        self.sync_frames = sync_frames
+        self.sync_interval = sync_interval
+        self.estimated_frame_bytes = None
+        self.frames_removed = 0
+        self.syncs = 0
+        self.sync_errors = 0
+        self.last_sync_error = None
+        self.on_remove = None
+        self._frames = collections.deque()
+        self._bytes_written = 0
+        self._frames_written = 0
+        self._unsynced = []
+        self._last_sync = time.time()
+        self._free = None
+        self._free_time = 0
+        self._lock = threading.Lock()
+
+    def make_dir(self, name):
+        """Create a new directory for name under the root. If it exists, a
+        suffix is added. Return (name, path) of the directory created."""
+        base = name
+        n = 1
+        while True:
+            path = os.path.join(self.root, name)
+            try:
+                os.mkdir(path)
+                return name, path
+            except OSError as e:
+                if not e.errno == errno.EEXIST:
+                    raise
+            n += 1
+            name = "{0}_{1}".format(base, n)
+
+    def free_bytes(self, ):
+        """Return bytes available for frames, i.e. free space less the
+        reserve. Cached for FREE_CACHE_TIME secs."""
+        now = time.time()
+        if self._free == None or now - self._free_time >= FREE_CACHE_TIME:
+            st = os.statvfs(self.root)
+            self._free = st.f_bavail * st.f_frsize
+            self._free_time = now
+        return max(0, self._free - self.reserve_bytes)
+
+    def frame_bytes(self, ):
+        """Return bytes per frame, the mean of the frames written so far, or
+        the estimate if none have been."""
+        if self._frames_written:
+            return self._bytes_written / self._frames_written
+        return self.estimated_frame_bytes
+
+    def predict(self, total_imgs, frame_bytes=None):
+        """Return dictionary predicting if total_imgs frames will fit."""
+        if frame_bytes == None:
+            frame_bytes = self.frame_bytes()
+        if frame_bytes:
+            frame_bytes *= self.copies
+        free = self.free_bytes()
+        max_imgs = free / frame_bytes if frame_bytes else None
+        return {
+            'root'          : self.root,
+            'free_bytes'    : free,
+            'frame_bytes'   : frame_bytes,
+            'needed_bytes'  : total_imgs * frame_bytes if frame_bytes else None,
+            'max_imgs'      : max_imgs,
+            'fits'          : self.retain_frames > 0 or max_imgs == None or
+                              total_imgs <= max_imgs,
+        }
+
+    def remaining_imgs(self, ):
+        """Return how many more frames fit, None if unknown or if retention
+        makes space as needed."""
+        frame_bytes = self.frame_bytes()
+        if not frame_bytes or self.retain_frames > 0:
+            return None
+        return self.free_bytes() / (frame_bytes * self.copies)
+
+    def write(self, filename, data, key=None):
+        """Write frame data to filename. key is passed to on_remove(key) if
+        the frame is later removed by retention. Raises IOError(ENOSPC) if
+        there is no room and nothing can be removed."""
+        with self._lock:
+            self.__make_room(len(data) * self.copies)
+            with open(filename, "wb") as file:
+                file.write(data)
+            self._frames.append((filename, len(data), key))
+            self._bytes_written += len(data)
+            self._frames_written += 1
+            if not self._free == None:
+                self._free -= len(data) * self.copies
+            self._unsynced.append(filename)
+            if len(self._unsynced) >= self.sync_frames or \
+               time.time() - self._last_sync >= self.sync_interval:
+                self.__sync()
+            if self.retain_frames > 0:
+                while len(self._frames) > self.retain_frames:
+                    self.__remove_oldest()
+
+    def sync(self, ):
+        """Flush written frames to storage."""
+        with self._lock:
+            self.__sync()
+
+    def close(self, ):
+        """Sync anything not yet synced."""
+        self.sync()
+
+    def __make_room(self, size):
+        while self.free_bytes() < size:
+            if self.retain_frames <= 0 or not self._frames:
+                raise IOError(errno.ENOSPC, "no space left for frames", self.root)
+            self.__remove_oldest()
+            self._free = None
+
+    def __remove_oldest(self, ):
+        filename, size, key = self._frames.popleft()
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        if filename in self._unsynced:
+            self._unsynced.remove(filename)
+        self.frames_removed += 1
+        if not self.on_remove == None:
+            self.on_remove(key)
+
+    def __sync(self, ):
+        """Sync the pending frames. The pending list is cleared whatever the
+        outcome, a failure is recorded, not raised."""
+        unsynced = self._unsynced
+        self._unsynced = []
+        self._last_sync = time.time()
+        if not unsynced:
+            return
+        try:
+            if SYNCFS == None or not self.__syncfs(unsynced[-1]):
+                for filename in unsynced:
+                    self.__fsync(filename)
+        except IOError as e:
+            self.sync_errors += 1
+            self.last_sync_error = e
+            print "StorageManager: sync failed: {0}".format(e)
+        self.syncs += 1
+
+    def __syncfs(self, filename):
+        """Sync the whole filesystem holding filename, one call for the
+        batch. Return True if it worked."""
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            return SYNCFS(fd) == 0
+        finally:
+            os.close(fd)
+
+    def __fsync(self, filename):
+        """Sync one file. Raises IOError if it fails."""
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror, filename)
+        finally:
+            os.close(fd)
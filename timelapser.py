@@ -3,12 +3,193 @@
 #
 # Timelapse thread class.
 #
+# Frames are captured into memory and handed off to a FrameWriter thread,
+# so SD card latency does not eat into the capture interval.
+#
+# Two capture modes:
+#   * still = a full still capture per frame (default)
+#   * video = frames streamed from the video port at a fixed rate and
+#             fixed exposure, decimated to delta_time (sub-second intervals)
+#
+# In still mode, frames that have not changed since the last kept frame
+# can be skipped (see changedetect.py), and exposure can be ramped to
+# follow the light (see exposure.py). Both use one small luma sample per
+# interval.
+#
+# Frames are written through a StorageManager (see storage.py), which
+# picks a unique directory, batches syncs and can do ring buffer
+# retention. The timelapse stops if storage runs out.
+#
+# Frames are timed against a grid of monotonic deadlines, start + n *
+# delta_time (see clock.py), so timing does not drift, and is not thrown
+# off when the system time is set. The thread sleeps until each deadline.
+# If an interval overruns, the deadlines it covered are missed, not made
+# up for, so later frames stay on the grid. Missed intervals don't count
+# towards total_imgs, so the timelapse ends that much later, and they are
+# counted in the status and the info file. How late each frame starts
+# is logged to the timing file, and the lateness and jitter (its standard
+# deviation) are in the status.
+#
+# Timing metrics for the run (see metrics.py) are appended to the info
+# file when the timelapse ends.
+#
 # 2016-07-16
 # Carter Nelson
 #===========================================================================
 import threading
+import Queue
 import time
 import os
+import io
+import math
+import errno
+import traceback
+from fractions import Fraction
+
+import aviwriter
+import changedetect
+import clock
+import exposure
+import metrics
+import storage
+
+WRITE_QUEUE_SIZE = 8    # max captured frames held in memory awaiting write
+WRITE_PUT_TIMEOUT = 1.0 # secs between checks the writer is alive, when queue is full
+VIDEO_MAX_FRAMERATE = 30    # max video port frame rate for video mode
+
+ACQUIRE_TIME    = metrics.histogram('timelapse_acquire_seconds',
+                                    'Time to acquire a frame, capture and hand off',
+                                    ['mode'])
+WRITE_TIME      = metrics.histogram('timelapse_write_seconds',
+                                    'Time to write a frame file')
+WRITE_BYTES     = metrics.counter('timelapse_write_bytes_total',
+                                  'Bytes of frame files written')
+WRITE_STALLS    = metrics.counter('timelapse_write_stalls_total',
+                                  'Captures that waited for the write queue')
+WRITE_ERRORS    = metrics.counter('timelapse_write_errors_total',
+                                  'Frame files that failed to write')
+FRAMES          = metrics.counter('timelapse_frames_total',
+                                  'Timelapse intervals, by outcome',
+                                  ['result'])
+LATENESS        = metrics.histogram('timelapse_lateness_seconds',
+                                    'Time from a frame deadline to its capture start',
+                                    ['mode'])
+
+class FrameWriter(threading.Thread):
+    """A class for writing captured frames to storage in a separate thread."""
+    
+    def __init__(self, maxsize=WRITE_QUEUE_SIZE, storage=None):
+        threading.Thread.__init__(self, name="FrameWriter")
+        self.daemon = True
+        self.storage = storage
+        self.storage_full = False
+        self.queue = Queue.Queue(maxsize)
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.write_stalls = 0
+        self.write_errors = 0
+        self.last_write_time = None
+        self.callback = None
+        
+    def put(self, filename, data, info=None):
+        """Queue frame data to be written to filename. If the queue is full
+        this blocks until there is room, i.e. backpressure on the capture.
+        After the frame is written, callback(filename, data, info) is called
+        if a callback has been set. Return False if the writer has died."""
+        if self.queue.full():
+            self.write_stalls += 1
+            WRITE_STALLS.inc()
+        return self.__put((filename, data, info))
+    
+    def __put(self, item):
+        """Queue item, unless the writer dies while the queue is full."""
+        while True:
+            try:
+                self.queue.put(item, timeout=WRITE_PUT_TIMEOUT)
+                return True
+            except Queue.Full:
+                if not self.is_alive():
+                    print "FrameWriter: writer died, frame dropped"
+                    return False
+        
+    def run(self, ):
+        """Write frames as they arrive until closed."""
+        while True:
+            item = self.queue.get()
+            if item == None:
+                break
+            filename, data, info = item
+            write_start = time.time()
+            try:
+                if self.storage == None:
+                    with open(filename, "wb") as file:
+                        file.write(data)
+                else:
+                    key = None if info == None else info.get('number')
+                    self.storage.write(filename, data, key)
+            except Exception as e:
+                self.__error(e)
+                continue
+            self.last_write_time = time.time() - write_start
+            WRITE_TIME.observe(self.last_write_time)
+            WRITE_BYTES.inc(len(data))
+            self.frames_written += 1
+            self.bytes_written += len(data)
+            if not self.callback == None:
+                try:
+                    self.callback(filename, data, info)
+                except Exception as e:
+                    self.__error(e)
+    
+    def __error(self, e):
+        """Count a failed write, or callback, and keep going."""
+        if getattr(e, 'errno', None) == errno.ENOSPC:
+            self.storage_full = True
+        self.write_errors += 1
+        WRITE_ERRORS.inc()
+        print "FrameWriter error: {0}".format(e)
+            
+    def close(self, ):
+        """Write any queued frames and terminate the thread."""
+        if self.is_alive() and self.__put(None):
+            self.join()
+        
+    def depth(self, ):
+        """Return number of frames waiting to be written."""
+        return self.queue.qsize()
+
+def video_framerate(delta_time):
+    """Return the video port frame rate for delta_time, one frame per
+    interval, so the kept frames are evenly spaced, up to the max frame
+    rate. All frames are kept if delta_time is 0."""
+    if delta_time <= 0:
+        return Fraction(VIDEO_MAX_FRAMERATE)
+    return min(Fraction(VIDEO_MAX_FRAMERATE),
+               1 / Fraction(delta_time).limit_denominator(1000))
+
+class Lateness(object):
+    """Running statistics of how late frames start, in secs."""
+    
+    def __init__(self, ):
+        self.count = 0
+        self.last = None
+        self.max = 0.0
+        self.mean = 0.0
+        self._m2 = 0.0
+        
+    def add(self, value):
+        self.count += 1
+        self.last = value
+        self.max = max(self.max, value)
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        
+    def jitter(self, ):
+        """Return the standard deviation of the lateness."""
+        if self.count == 0:
+            return None
+        return math.sqrt(self._m2 / self.count)
 
 class TimeLapser(threading.Thread):
     """A class for performing timelapse capture in a separate thread."""
@@ -17,38 +198,72 @@ class TimeLapser(threading.Thread):
         threading.Thread.__init__(self, group=group, target=target, name=name)
 
         self.dir = None
+        self.infofile = None
         
         self.camera = kwargs['camera']
         self.delta_time = kwargs['delta_time']
         self.total_imgs = kwargs['total_imgs']
+        self.mode = kwargs.get('mode', 'still')
+        self.framerate = kwargs.get('framerate', None)
+        self.index = kwargs.get('index', None)
+        self.make_video = kwargs.get('make_video', False)
+        self.video = None
+        self.change_threshold = kwargs.get('change_threshold', 0)
+        self.detector = None
+        self.ramp_options = kwargs.get('ramp', None)     # ExposureRamp kwargs
+        self.ramp = None
+        self.storage = kwargs.get('storage', None)
+        if self.storage == None:
+            self.storage = storage.StorageManager(os.getcwd(),
+                                            copies=2 if self.make_video else 1)
+        if self.storage.estimated_frame_bytes == None:
+            self.storage.estimated_frame_bytes = storage.estimate_frame_bytes(
+                                            self.camera.settings['resolution'],
+                                            self.camera.settings['quality'])
+        self.storage.on_remove = self.__frame_removed
+        self.on_finish = kwargs.get('on_finish', None)
         
         self.start_time = None
-        self.finish_time = None
-        self.wait_time = None
-        self.remaining_time = None
         self.image_count = 0
+        self.interval_count = 0
+        self.missed_count = 0
+        self.lateness = Lateness()
         self.keep_running = False
         self.timelapse_name = None
-        self.waiter = threading.Event()
+        self.error = None
+        self.finished = False   # set before on_finish, the thread may still be alive
+        self.waiter = clock.Waker()
+        self._start_mono = None
+        self._end_mono = None
+        self._timing = None
+        self.writer = FrameWriter(kwargs.get('queue_size', WRITE_QUEUE_SIZE),
+                                  self.storage)
+        self.writer.callback = self.__frame_written
         
     def run(self, ):
         """Take a series of images."""
-        self.timelapse_name = time.strftime("%Y%m%d_%H%M",time.localtime())
-        self.dir = os.path.join(os.getcwd(), self.timelapse_name)
+        metrics_start = metrics.snapshot()
         try:
-            os.mkdir(self.dir)
-        except OSError:
-            # directory exist
-            # not likely in real world scenario ?
-            # ignore and overwrite, for now
-            pass
+            self.__run()
+        except Exception as e:
+            self.error = e
+            print "TimeLapser error: {0}".format(e)
+            traceback.print_exc()
+        finally:
+            self.__finish(metrics_start)
+        
+    def __run(self, ):
+        name = time.strftime("%Y%m%d_%H%M",time.localtime())
+        self.timelapse_name, self.dir = self.storage.make_dir(name)
 
         infofile = self.timelapse_name+"_info.txt"
         infofile = os.path.join(self.dir, infofile)
+        self.infofile = infofile
         with open(infofile, "w") as file:
             file.write("TIMELAPSE NAME = {0}\n".format(self.timelapse_name))
             file.write("TOTAL IMGS = {0}\n".format(self.total_imgs))
             file.write("DELTA TIME = {0}\n".format(self.delta_time))
+            file.write("MODE = {0}\n".format(self.mode))
             file.write("-"*15+"\n")
             file.write("Camera Settings\n")
             file.write("-"*15+"\n")
@@ -57,48 +272,273 @@ class TimeLapser(threading.Thread):
                 file.write(txt)
             
         self.start_time  = time.time()
-        self.remaining_time = self.delta_time * (self.total_imgs - 1)
-        self.finish_time = self.start_time + self.remaining_time
+        
+        if not self.index == None:
+            self.index.add_session(self.timelapse_name, self.dir, self.start_time,
+                                   self.delta_time, self.total_imgs, self.mode)
+
+        if self.make_video:
+            videofile = os.path.join(self.dir, self.timelapse_name+".avi")
+            self.video = aviwriter.AVIWriter(videofile)
+        if self.change_threshold > 0 and self.mode == 'still':
+            logfile = os.path.join(self.dir, self.timelapse_name+"_skip.csv")
+            self.detector = changedetect.ChangeDetector(self.change_threshold,
+                                                        logfile=logfile)
+        if not self.ramp_options == None and self.mode == 'still':
+            logfile = os.path.join(self.dir, self.timelapse_name+"_exposure.csv")
+            self.ramp = exposure.ExposureRamp(logfile=logfile, **self.ramp_options)
+            self.ramp.start(self.camera, self.camera.capture_luma())
+            self.ramp.apply(self.camera)
+        timingfile = os.path.join(self.dir, self.timelapse_name+"_timing.csv")
+        self._timing = open(timingfile, "w")
+        self._timing.write("interval,deadline,lateness,acquire_time,result\n")
 
         self.keep_running = True
         self.image_count = 0
+        self.interval_count = 0
+        self.writer.start()
+        
+        if self.mode == 'video':
+            self.__run_video()
+        else:
+            self.__run_stills()
+        
+    def __finish(self, metrics_start):
+        """Close everything, however the run ended, then call on_finish."""
+        self.keep_running = False
+        self._end_mono = clock.monotonic()
+        try:
+            self.writer.close()
+            self.storage.close()
+            for part in (self.video, self.detector, self.ramp, self._timing):
+                if not part == None:
+                    part.close()
+            if not self.infofile == None:
+                self.__write_metrics(metrics_start)
+        except Exception as e:
+            if self.error == None:
+                self.error = e
+            print "TimeLapser error closing: {0}".format(e)
+        finally:
+            self.waiter.close()
+            self.finished = True
+            if not self.on_finish == None:
+                self.on_finish(self)
         
+    def __write_metrics(self, before):
+        """Append a summary of the metrics for this run to the info file."""
+        with open(self.infofile, "a") as file:
+            file.write("-"*15+"\n")
+            file.write("Metrics\n")
+            file.write("-"*15+"\n")
+            file.write("MISSED INTERVALS = {0}\n".format(self.missed_count))
+            for line in metrics.summarize(before):
+                file.write(line+"\n")
+        
+    def __run_stills(self, ):
+        """Take a full still capture for each frame."""
+        self._start_mono = clock.monotonic()
         while self.keep_running:
-            self.image_count += 1
-            filename = self.timelapse_name+"_%04d.jpg" % self.image_count
-            filename = os.path.join(self.dir, filename)
+            deadline = self.__deadline(self.interval_count)
+            self.interval_count += 1
             acquire_start = time.time()
-            self.camera.capture(filename)
-            acquire_finish = time.time()
-            acquire_time = acquire_finish - acquire_start
-            remaining_imgs = self.total_imgs - self.image_count
-            self.wait_time = self.delta_time - acquire_time
-            self.remaining_time = self.wait_time + self.delta_time * remaining_imgs
-            if remaining_imgs == 0:
-                self.keep_running = False
-                self.remaining_time = 0
-                self.wait_time = 0
-            while self.keep_running and self.wait_time > 0: 
-                self.wait_time = self.delta_time - (time.time() - acquire_start) 
-                self.remaining_time = self.wait_time + self.delta_time * remaining_imgs
-                self.waiter.wait(0.25)                        
-        self.keep_running = False
+            lateness = self.__started(deadline, 'still')
+            luma = None
+            if not self.detector == None or not self.ramp == None:
+                luma = self.camera.capture_luma()
+            if not self.ramp == None:
+                if self.ramp.update(luma, acquire_start):
+                    self.ramp.apply(self.camera)
+            if self.__frame_changed(luma, acquire_start):
+                self.image_count += 1
+                stream = io.BytesIO()
+                self.camera.capture(stream)
+                self.__save_frame(stream.getvalue(), acquire_start)
+                result = 'kept'
+            else:
+                result = 'skipped'
+            FRAMES.inc(result=result)
+            acquire_time = time.time() - acquire_start
+            ACQUIRE_TIME.observe(acquire_time, mode='still')
+            self.__log_timing(deadline, lateness, acquire_time, result)
+            self.__skip_missed()
+            if self.__taken() >= self.total_imgs or not self.keep_running:
+                break
+            self.waiter.wait_until(self.__deadline(self.interval_count))
+        
+    def __run_video(self, ):
+        """Stream frames from the video port and keep one every delta_time."""
+        framerate = self.framerate
+        if framerate == None:
+            framerate = video_framerate(self.delta_time)
+        # frames arrive on their own grid, keep the one nearest each deadline
+        early = 0.5 / float(framerate)
+        frames = self.camera.capture_video_frames(framerate)
+        try:
+            for frame in frames:
+                if not self.keep_running:
+                    break
+                now = clock.monotonic()
+                if self._start_mono == None:
+                    # exposure has settled, start the clock on first frame
+                    self._start_mono = now
+                    self.start_time = time.time()
+                deadline = self.__deadline(self.interval_count)
+                if now < deadline - early:
+                    # decimate
+                    continue
+                self.interval_count += 1
+                lateness = self.__started(deadline, 'video')
+                self.image_count += 1
+                self.__save_frame(frame, time.time())
+                FRAMES.inc(result='kept')
+                acquire_time = clock.monotonic() - now
+                ACQUIRE_TIME.observe(acquire_time, mode='video')
+                self.__log_timing(deadline, lateness, acquire_time, 'kept')
+                self.__skip_missed()
+                if self.__taken() >= self.total_imgs:
+                    break
+        finally:
+            frames.close()
+    
+    def __deadline(self, interval):
+        """Return the monotonic deadline of an interval, counting from 0."""
+        return self._start_mono + interval * self.delta_time
+    
+    def __started(self, deadline, mode):
+        """Record how late a frame started. Return the lateness, always 0
+        back to back."""
+        lateness = 0.0
+        if self.delta_time > 0:
+            lateness = max(0.0, clock.monotonic() - deadline)
+        self.lateness.add(lateness)
+        LATENESS.observe(lateness, mode=mode)
+        return lateness
+    
+    def __taken(self, ):
+        """Return the number of intervals taken, kept or skipped, i.e. not
+        missed."""
+        return self.interval_count - self.missed_count
+    
+    def __skip_missed(self, ):
+        """Skip deadlines that have passed, all but the last one, which is
+        taken late. None are missed with no delta_time, back to back."""
+        if self.delta_time <= 0:
+            return
+        now = clock.monotonic()
+        while self.__deadline(self.interval_count + 1) <= now:
+            self.interval_count += 1
+            self.missed_count += 1
+            self.__log_timing(self.__deadline(self.interval_count - 1), None, None,
+                              'missed')
+            FRAMES.inc(result='missed')
+    
+    def __log_timing(self, deadline, lateness, acquire_time, result):
+        self._timing.write("{0},{1:.3f},{2},{3},{4}\n".format(
+                self.interval_count, deadline - self._start_mono,
+                "" if lateness == None else "{0:.4f}".format(lateness),
+                "" if acquire_time == None else "{0:.4f}".format(acquire_time),
+                result))
+    
+    def __frame_changed(self, luma, timestamp):
+        """Return True if the scene has changed enough to keep a frame, or
+        if change detection is off."""
+        if self.detector == None:
+            return True
+        keep, diff = self.detector.check(luma, self.interval_count, timestamp)
+        return keep
+    
+    def __save_frame(self, data, timestamp):
+        """Hand captured frame data off to the writer."""
+        info = {'number'            : self.image_count,
+                'time'              : timestamp,
+                'exposure_speed'    : self.camera.settings.get('exposure_speed')}
+        if not self.writer.put(self.__frame_filename(), data, info):
+            print "TimeLapser: frame writer died, stopping"
+            self.error = IOError("frame writer died")
+            self.keep_running = False
+        elif self.writer.storage_full:
+            print "TimeLapser: out of storage, stopping"
+            self.keep_running = False
+        
+    def __frame_written(self, filename, data, info):
+        """Writer callback, add frame to the video and the index."""
+        if not self.video == None:
+            self.video.add_frame(data)
+        if not self.index == None:
+            self.index.add_frame(self.timelapse_name, info['number'], filename,
+                                 info['time'], len(data), info['exposure_speed'])
+    
+    def __frame_removed(self, number):
+        """Storage callback, a frame was removed by retention."""
+        if not self.index == None and not number == None:
+            self.index.remove_frame(self.timelapse_name, number)
+    
+    def __frame_filename(self, ):
+        """Return full path file name for current frame."""
+        filename = self.timelapse_name+"_%04d.jpg" % self.image_count
+        return os.path.join(self.dir, filename)
                 
     def stop(self, ):
         """Stop the timelapse and terminate the thread."""
         self.keep_running = False
         self.waiter.set()       
       
+    def get_space_end_time(self, ):
+        """Return predicted time storage runs out, or None if it will not
+        (retention) or can not be predicted."""
+        remaining_imgs = self.storage.remaining_imgs()
+        if remaining_imgs == None or not self.is_alive():
+            return None
+        # skipped frames take no space
+        return time.time() + remaining_imgs * self.delta_time * \
+                    max(1, self.interval_count) / max(1, self.image_count)
+      
+    def get_times(self, ):
+        """Return (wait_time, remaining_time, finish_time) in secs, the wait
+        until the next frame, until the last one, and the wall clock time of
+        the last one."""
+        now = clock.monotonic()
+        if self._start_mono == None:
+            remaining_time = self.delta_time * (self.total_imgs - 1)
+            return 0, remaining_time, time.time() + remaining_time
+        finish = self.__deadline(self.total_imgs - 1 + self.missed_count)
+        if not self._end_mono == None:
+            return 0, 0, clock.wall_time(min(self._end_mono, finish))
+        wait_time = max(0, self.__deadline(self.interval_count) - now)
+        return wait_time, max(0, finish - now), clock.wall_time(finish)
+      
     def get_status(self, ):
         """Return current status of timelapse."""
+        space_end_time = self.get_space_end_time()
+        wait_time, remaining_time, finish_time = self.get_times()
         return {
             'timelapse_name'    : self.timelapse_name ,
             'image_count'       : self.image_count ,
+            'skipped_count'     : self.interval_count - self.image_count -
+                                  self.missed_count ,
+            'missed_count'      : self.missed_count ,
             'delta_time'        : self.delta_time ,
             'total_imgs'        : self.total_imgs ,
             'start_time'        : self.start_time ,
-            'finish_time'       : self.finish_time ,
-            'wait_time'         : self.wait_time ,
-            'remaining_time'    : self.remaining_time ,
+            'finish_time'       : finish_time ,
+            'wait_time'         : wait_time ,
+            'remaining_time'    : remaining_time ,
+            'lateness'          : self.lateness.last ,
+            'max_lateness'      : self.lateness.max ,
+            'jitter'            : self.lateness.jitter() ,
             'is_alive'          : self.is_alive(),
-        }
\ No newline at end of file
+            'error'             : None if self.error == None else str(self.error),
+            'mode'              : self.mode ,
+            'queue_depth'       : self.writer.depth(),
+            'frames_written'    : self.writer.frames_written,
+            'write_stalls'      : self.writer.write_stalls,
+            'storage_root'      : self.storage.root,
+            'free_mb'           : self.storage.free_bytes() / (1024 * 1024),
+            'frames_removed'    : self.storage.frames_removed,
+            'sync_errors'       : self.storage.sync_errors,
+            'space_end_time'    : None if space_end_time == None
+                                       else int(space_end_time),
+            'shutter_speed'     : self.camera.settings['shutter_speed'],
+            'iso'               : self.camera.settings['iso'],
+        }